@@ -0,0 +1,372 @@
+#!/usr/bin/env python
+
+# Copyright 2012 Rackspace Hosting, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Measures client throughput and latency against the in-memory mock registry
+in txServiceRegistry/test/mock_twisted_server.py and writes the results as
+JSON, so they can be compared release to release.
+
+    PYTHONPATH=. python benchmarks/benchmark.py --output=results.json
+"""
+
+import sys
+import time
+
+try:
+    import simplejson as json
+except:
+    import json
+
+from optparse import OptionParser
+
+import twisted
+from twisted.internet import reactor
+from twisted.internet.defer import gatherResults, maybeDeferred, succeed
+from twisted.python import log
+
+from txServiceRegistry.client import Client, HeartBeater
+from txServiceRegistry.heartbeat import HeartbeatScheduler
+from txServiceRegistry.test import mock_twisted_server
+
+SCENARIOS = ['services.list', 'configuration.get', 'services.heartbeat',
+             'heartbeat.encode', 'heartbeater.memory']
+
+
+def percentile(sortedValues, percent):
+    if not sortedValues:
+        return None
+
+    index = int(round(percent / 100.0 * (len(sortedValues) - 1)))
+
+    return sortedValues[index]
+
+
+def summarize(latencies, duration):
+    latencies = sorted(latencies)
+    count = len(latencies)
+
+    return {'requests': count,
+            'seconds': duration,
+            'requestsPerSecond': count / duration if duration else None,
+            'p50Ms': percentile(latencies, 50) * 1000,
+            'p99Ms': percentile(latencies, 99) * 1000,
+            'maxMs': latencies[-1] * 1000}
+
+
+def runLoad(makeRequest, total, concurrency):
+    """
+    Call makeRequest total times, with at most concurrency calls in flight.
+
+    @return: A Deferred which fires with the summary of the run.
+    """
+    latencies = []
+    remaining = [total]
+
+    def worker(_=None):
+        if remaining[0] <= 0:
+            return succeed(None)
+
+        remaining[0] -= 1
+        began = time.time()
+
+        def cbDone(_):
+            latencies.append(time.time() - began)
+
+            return worker()
+
+        d = maybeDeferred(makeRequest)
+        d.addCallback(cbDone)
+
+        return d
+
+    start = time.time()
+    d = gatherResults([worker() for i in range(min(total, concurrency))])
+    d.addCallback(lambda _: summarize(latencies, time.time() - start))
+
+    return d
+
+
+def benchmarkServicesList(client, options):
+    return runLoad(client.services.list, options.requests,
+                   options.concurrency)
+
+
+def benchmarkConfigurationGet(client, options):
+    return runLoad(lambda: client.configuration.get('configId'),
+                   options.requests, options.concurrency)
+
+
+def benchmarkHeartbeats(client, options):
+    """
+    Create options.heartbeaters services and heartbeat each of them
+    options.heartbeats times, all of them concurrently.
+    """
+    heartbeaters = []
+
+    def create(i):
+        d = client.services.create('bench-%s' % (i), 30)
+        d.addCallback(lambda result: heartbeaters.append(result[1]))
+
+        return d
+
+    def heartbeatLoop(heartbeater):
+        counter = [options.heartbeats]
+        latencies = []
+        template = client.services.getHeartbeatTemplate(
+            heartbeater.serviceId)
+
+        def beat(_=None):
+            if counter[0] <= 0:
+                return latencies
+
+            counter[0] -= 1
+            began = time.time()
+
+            def cbBeat(result):
+                heartbeater.nextToken = result['token']
+                latencies.append(time.time() - began)
+
+                return beat()
+
+            d = client.services.heartbeat(heartbeater.serviceId,
+                                          heartbeater.nextToken, template)
+            d.addCallback(cbBeat)
+
+            return d
+
+        return beat()
+
+    def cbCreated(_):
+        start = time.time()
+        d = gatherResults([heartbeatLoop(h) for h in heartbeaters])
+        d.addCallback(lambda results: summarize(
+            [latency for result in results for latency in result],
+            time.time() - start))
+        d.addCallback(cbSummary, start)
+
+        return d
+
+    def cbSummary(summary, start):
+        summary['heartbeaters'] = len(heartbeaters)
+        summary['createSeconds'] = start - createStart
+
+        return summary
+
+    createStart = time.time()
+    d = gatherResults([create(i) for i in range(options.heartbeaters)])
+    d.addCallback(cbCreated)
+
+    return d
+
+
+def benchmarkHeartbeatEncoding(client, options):
+    """
+    Compare building and encoding a heartbeat request from scratch with
+    rendering it from a pre-rendered template.
+    """
+    codec = client.services.codec
+    serviceId = 'bench-service'
+    token = u'6bc8d050-f86a-11e1-a89e-ca2ffe480b20'
+    count = options.requests * 10
+
+    start = time.time()
+
+    for i in xrange(count):
+        path = '/services/%s/heartbeat' % (serviceId)
+        body = codec.encode({'token': token})
+
+    plainSeconds = time.time() - start
+
+    template = client.services.getHeartbeatTemplate(serviceId)
+    start = time.time()
+
+    for i in xrange(count):
+        path = template.path
+        body = template.render(token)
+
+    templateSeconds = time.time() - start
+
+    return succeed({'heartbeats': count,
+                    'plainMicroseconds': plainSeconds / count * 1e6,
+                    'templateMicroseconds': templateSeconds / count * 1e6})
+
+
+def getHeartBeaterSize(heartbeater, shared):
+    size = sys.getsizeof(heartbeater) + sys.getsizeof(heartbeater.__dict__)
+
+    for value in heartbeater.__dict__.itervalues():
+        if id(value) not in shared:
+            size += sys.getsizeof(value)
+
+    return size
+
+
+def benchmarkHeartBeaterMemory(client, options):
+    """
+    Estimate the number of bytes owned by each HeartBeater, not counting
+    the objects it shares with the client, and used per service by a
+    HeartbeatScheduler.
+    """
+    heartbeaters = []
+    scheduler = HeartbeatScheduler(client.services)
+
+    for i in range(options.heartbeaters):
+        heartbeater = HeartBeater(client.agent, client.baseUrl,
+                                  'bench-%s' % (i), 30)
+        heartbeater.nextToken = '6bc8d050-f86a-11e1-a89e-%012d' % (i)
+        heartbeaters.append(heartbeater)
+        scheduler.addHeartBeater(heartbeater)
+
+    first, second = heartbeaters[0], heartbeaters[-1]
+    shared = set([id(value) for value in first.__dict__.itervalues()]) & \
+        set([id(value) for value in second.__dict__.itervalues()])
+    sizes = [getHeartBeaterSize(h, shared) for h in heartbeaters]
+
+    return succeed({'heartbeaters': len(heartbeaters),
+                    'bytesPerHeartBeater': sum(sizes) / len(sizes),
+                    'bytesPerScheduledService':
+                    scheduler.getMemoryFootprint()})
+
+
+BENCHMARKS = {
+    'services.list': benchmarkServicesList,
+    'configuration.get': benchmarkConfigurationGet,
+    'services.heartbeat': benchmarkHeartbeats,
+    'heartbeat.encode': benchmarkHeartbeatEncoding,
+    'heartbeater.memory': benchmarkHeartBeaterMemory
+}
+
+
+def createClient(url, coalesceRequests):
+    client = Client('user', 'api_key', baseUrl=url,
+                    coalesceRequests=coalesceRequests)
+    client.agent._getAuthHeaders = \
+        lambda: succeed({'X-Auth-Token': 'authToken',
+                         'X-Tenant-Id': 'tenantId'})
+
+    return client
+
+
+def run(options, scenarios):
+    results = {}
+
+    if options.url:
+        url = options.url
+        port = None
+    else:
+        port = mock_twisted_server.listen()
+        url = 'http://127.0.0.1:%s/' % (port.getHost().port)
+
+    client = createClient(url, options.coalesce)
+
+    def runNext(_=None):
+        if not scenarios:
+            return results
+
+        name = scenarios.pop(0)
+        d = BENCHMARKS[name](client, options)
+        d.addCallback(lambda summary: results.__setitem__(name, summary))
+        d.addCallback(runNext)
+
+        return d
+
+    def cbDone(result):
+        if port is not None:
+            port.stopListening()
+
+        if client.pool is not None:
+            client.pool.closeCachedConnections()
+
+        return result
+
+    d = runNext()
+    d.addBoth(cbDone)
+
+    return d
+
+
+def main():
+    usage = 'usage: %prog [options]'
+    parser = OptionParser(usage=usage)
+    parser.add_option('--url', dest='url', default=None,
+                      help='Registry URL to benchmark instead of starting '
+                           'the in-process mock server')
+    parser.add_option('--requests', dest='requests', type='int',
+                      default=2000, help='Requests per scenario')
+    parser.add_option('--concurrency', dest='concurrency', type='int',
+                      default=50, help='Concurrent requests')
+    parser.add_option('--heartbeaters', dest='heartbeaters', type='int',
+                      default=200, help='Number of concurrent HeartBeaters')
+    parser.add_option('--heartbeats', dest='heartbeats', type='int',
+                      default=10, help='Heartbeats sent by each HeartBeater')
+    parser.add_option('--scenarios', dest='scenarios',
+                      default=','.join(SCENARIOS),
+                      help='Comma separated scenarios to run: %s' %
+                           (', '.join(SCENARIOS)))
+    parser.add_option('--coalesce', dest='coalesce', default=False,
+                      action='store_true',
+                      help='Coalesce identical concurrent GET requests')
+    parser.add_option('--output', dest='output', default=None,
+                      help='File to write the JSON results to, defaults '
+                           'to stdout')
+    (options, args) = parser.parse_args()
+
+    scenarios = [name.strip() for name in options.scenarios.split(',')]
+
+    for name in scenarios:
+        if name not in BENCHMARKS:
+            parser.error('Unknown scenario: %s' % (name))
+
+    report = {'timestamp': int(time.time()),
+              'python': sys.version.split()[0],
+              'twisted': twisted.__version__,
+              'options': {'requests': options.requests,
+                          'concurrency': options.concurrency,
+                          'heartbeaters': options.heartbeaters,
+                          'heartbeats': options.heartbeats,
+                          'coalesce': options.coalesce},
+              'results': None}
+    exitCode = [0]
+
+    def cbResults(results):
+        report['results'] = results
+        output = json.dumps(report, indent=4, sort_keys=True)
+
+        if options.output:
+            with open(options.output, 'w') as f:
+                f.write(output + '\n')
+        else:
+            print output
+
+    def ebResults(failure):
+        exitCode[0] = 1
+        log.err(failure)
+
+    def start():
+        # Scenarios which don't make requests finish synchronously, so the
+        # reactor must already be running to be stopped.
+        d = run(options, scenarios)
+        d.addCallbacks(cbResults, ebResults)
+        d.addBoth(lambda _: reactor.stop())
+
+    log.startLogging(sys.stderr, setStdout=False)
+    reactor.callWhenRunning(start)
+    reactor.run()
+    sys.exit(exitCode[0])
+
+
+if __name__ == '__main__':
+    main()
@@ -98,6 +98,29 @@ class TestCommand(Command):
         sys.exit(retcode)
 
 
+class BenchmarkCommand(Command):
+    description = "Run benchmarks against the in-process mock API server"
+    user_options = [('output=', 'o', 'File to write the JSON results to')]
+
+    def initialize_options(self):
+        self.output = None
+
+    def finalize_options(self):
+        pass
+
+    def run(self):
+        cwd = os.getcwd()
+        args = [sys.executable, '%s/benchmarks/benchmark.py' % (cwd)]
+
+        if self.output:
+            args.append('--output=%s' % (self.output))
+
+        env = dict(os.environ)
+        env['PYTHONPATH'] = cwd
+        retcode = call(args, env=env)
+        sys.exit(retcode)
+
+
 setup(
     name='txServiceRegistry',
     version='0.2.0',
@@ -114,7 +137,8 @@ setup(
     cmdclass={
         'pep8': Pep8Command,
         'apidocs': ApiDocsCommand,
-        'test': TestCommand
+        'test': TestCommand,
+        'benchmark': BenchmarkCommand
     },
     packages=get_packages('txServiceRegistry'),
     package_dir={
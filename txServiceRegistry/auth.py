@@ -0,0 +1,258 @@
+# Copyright 2012 Rackspace Hosting, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import calendar
+import httplib
+import re
+try:
+    import simplejson as json
+except:
+    import json
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, succeed
+from twisted.python import log
+from twisted.web.http_headers import Headers
+
+from txKeystone import KeystoneAgent
+from txKeystone.keystone import KeystoneAuthenticationError, \
+    MalformedJSONError, StringIOReceiver
+
+# Number of seconds before the token expires at which it is refreshed.
+DEFAULT_REFRESH_MARGIN = 300
+# Number of seconds to wait before trying again when a background refresh
+# fails while the current token is still valid.
+DEFAULT_REFRESH_RETRY_DELAY = 30
+MIN_REFRESH_DELAY = 1
+
+EXPIRES_RE = re.compile(r'^(\d{4})-(\d{2})-(\d{2})T(\d{2}):(\d{2}):(\d{2})'
+                        r'(?:\.\d+)?(Z|[+-]\d{2}:?\d{2})?$')
+
+
+def parseExpires(value):
+    """
+    Parse the expiration time of a Keystone token, such as
+    '2012-09-14T18:54:55.000-05:00', into a UNIX timestamp. Times without an
+    offset are assumed to be in UTC.
+
+    @return: The timestamp, or None if the value can't be parsed.
+    """
+    match = EXPIRES_RE.match(value or '')
+
+    if not match:
+        return None
+
+    groups = match.groups()
+    timestamp = calendar.timegm([int(group) for group in groups[:6]])
+    offset = groups[6]
+
+    if offset and offset != 'Z':
+        sign = -1 if offset[0] == '-' else 1
+        offset = offset[1:].replace(':', '')
+        timestamp -= sign * (int(offset[:2]) * 3600 + int(offset[2:]) * 60)
+
+    return timestamp
+
+
+class RefreshingKeystoneAgent(KeystoneAgent):
+    """
+    A L{KeystoneAgent} which keeps track of the token expiration time and
+    gets a new token in the background before the current one expires, so
+    requests don't have to wait for authentication or be rejected with a
+    401 once the token expires.
+
+    Concurrent requests which need a token while none is valid share a
+    single authentication request.
+    """
+    def __init__(self, agent, auth_url, auth_cred, auth_type='api_key',
+                 verbose=False, refreshMargin=DEFAULT_REFRESH_MARGIN,
+                 clock=None):
+        """
+        @param refreshMargin: Number of seconds before the token expires at
+        which a new one is requested.
+        @type refreshMargin: C{int}
+        @param clock: Provider of IReactorTime, defaults to the reactor.
+
+        See L{KeystoneAgent} for the other parameters.
+        """
+        KeystoneAgent.__init__(self, agent, auth_url, auth_cred,
+                               auth_type=auth_type, verbose=verbose)
+        self.refreshMargin = refreshMargin
+        self.expires = None
+        self._clock = clock or reactor
+        self._authenticating = None
+        self._waiters = []
+        self._refreshId = None
+        self._stats = {'authentications': 0,
+                       'refreshes': 0,
+                       'failures': 0}
+
+    def hasValidToken(self):
+        if self._state != self.AUTHENTICATED:
+            return False
+
+        return self.expires is None or self._clock.seconds() < self.expires
+
+    def invalidateToken(self, token=None):
+        """
+        Forget the current token, e.g. because the API rejected it. The next
+        request gets a new one.
+
+        @param token: The rejected token. Nothing is forgotten if the token
+        has already been replaced by a new one.
+        @type token: C{str}
+        """
+        if token is not None and token != self.auth_headers['X-Auth-Token']:
+            return
+
+        self.auth_headers = {'X-Auth-Token': None, 'X-Tenant-Id': None}
+        self.expires = None
+
+        if self._state == self.AUTHENTICATED:
+            self._state = self.NOT_AUTHENTICATED
+
+        self._cancelRefresh()
+
+    def stopRefreshing(self):
+        """
+        Stop refreshing the token in the background. Tokens are still
+        requested when they are needed.
+        """
+        self._cancelRefresh()
+
+    def getStats(self):
+        """
+        Return the number of authentications, background refreshes and
+        failed authentications, and the token expiration time.
+
+        @rtype: C{dict}
+        """
+        stats = dict(self._stats)
+        stats['expires'] = self.expires
+
+        return stats
+
+    def _getAuthHeaders(self):
+        if self.hasValidToken():
+            return succeed(self.auth_headers)
+
+        if self._state == self.AUTHENTICATED:
+            # The token expired before it could be refreshed.
+            self.invalidateToken()
+
+        d = Deferred()
+        self._waiters.append(d)
+        self._authenticate()
+
+        return d
+
+    def _authenticate(self):
+        if self._authenticating is not None:
+            return self._authenticating
+
+        if self._state != self.AUTHENTICATED:
+            self._state = self.AUTHENTICATING
+
+        self._stats['authentications'] += 1
+        d = self.agent.request('POST',
+                               self.auth_url,
+                               Headers({
+                                   'Content-type': ['application/json']
+                               }),
+                               self._getAuthRequestBodyProducer())
+        d.addCallback(self._cbAuthResponse)
+        d.addCallbacks(self._cbAuthenticated, self._ebAuthenticate)
+        self._authenticating = d
+
+        return d
+
+    def _cbAuthResponse(self, response):
+        if response.code != httplib.OK:
+            raise KeystoneAuthenticationError('Keystone authentication '
+                                              'credentials rejected')
+
+        body = Deferred()
+        response.deliverBody(StringIOReceiver(body))
+        body.addCallback(self._parseAuthBody)
+
+        return body
+
+    def _parseAuthBody(self, body):
+        try:
+            token = json.loads(body)['access']['token']
+            headers = {'X-Tenant-Id': token['tenant']['id'].encode('ascii'),
+                       'X-Auth-Token': token['id'].encode('ascii')}
+        except (ValueError, KeyError, TypeError):
+            raise MalformedJSONError('Malformed keystone response received.')
+
+        return headers, parseExpires(token.get('expires'))
+
+    def _cbAuthenticated(self, result):
+        self.auth_headers, self.expires = result
+        self._state = self.AUTHENTICATED
+        self._authenticating = None
+        self._scheduleRefresh()
+        waiters, self._waiters = self._waiters, []
+
+        for waiter in waiters:
+            waiter.callback(self.auth_headers)
+
+    def _ebAuthenticate(self, failure):
+        self._authenticating = None
+        self._stats['failures'] += 1
+        waiters, self._waiters = self._waiters, []
+
+        if self.hasValidToken():
+            # A background refresh failed, keep using the current token
+            # and try again later.
+            log.err(failure, 'Refreshing the auth token failed')
+            self._scheduleRefresh(DEFAULT_REFRESH_RETRY_DELAY)
+        else:
+            self._state = self.NOT_AUTHENTICATED
+
+        for waiter in waiters:
+            waiter.errback(failure)
+
+    def _refresh(self):
+        self._refreshId = None
+        self._stats['refreshes'] += 1
+        self._authenticate()
+
+    def _scheduleRefresh(self, delay=None):
+        self._cancelRefresh()
+
+        if self.expires is None:
+            return
+
+        remaining = self.expires - self._clock.seconds()
+
+        if delay is None:
+            delay = remaining - self.refreshMargin
+
+            if delay <= 0:
+                # The token lives shorter than the margin, refresh it half
+                # way through instead.
+                delay = remaining / 2.0
+
+        if delay >= remaining:
+            return
+
+        delay = max(MIN_REFRESH_DELAY, delay)
+        self._refreshId = self._clock.callLater(delay, self._refresh)
+
+    def _cancelRefresh(self):
+        if self._refreshId is not None and self._refreshId.active():
+            self._refreshId.cancel()
+
+        self._refreshId = None
@@ -0,0 +1,59 @@
+# Copyright 2012 Rackspace Hosting, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from twisted.internet.defer import DeferredSemaphore, gatherResults
+
+DEFAULT_MAX_PARALLEL = 10
+
+
+def isErrorResponse(result):
+    """
+    Return True if a result is a parsed API error response, which has a type
+    and a code, e.g. {'type': 'notFoundError', 'code': 404, ...}.
+    """
+    return isinstance(result, dict) and 'type' in result and \
+        'code' in result
+
+
+def runMany(function, keys, maxParallel=DEFAULT_MAX_PARALLEL):
+    """
+    Call function(key) for every key, with at most maxParallel calls in
+    flight at once.
+
+    @return: A Deferred which fires with a dict mapping every key to a
+    (success, result) tuple. The call failed if the Deferred it returned
+    failed, in which case the result is the L{Failure}, or if it returned
+    an API error response.
+    @rtype: L{Deferred}
+    """
+    semaphore = DeferredSemaphore(maxParallel)
+    results = {}
+
+    def cbResult(result, key):
+        results[key] = (not isErrorResponse(result), result)
+
+    def ebResult(failure, key):
+        results[key] = (False, failure)
+
+    def run(key):
+        d = semaphore.run(function, key)
+        d.addCallbacks(cbResult, ebResult, callbackArgs=(key,),
+                       errbackArgs=(key,))
+
+        return d
+
+    d = gatherResults([run(key) for key in keys])
+    d.addCallback(lambda _: results)
+
+    return d
@@ -0,0 +1,531 @@
+# Copyright 2012 Rackspace Hosting, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from copy import deepcopy
+import os
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, maybeDeferred
+from twisted.python import log
+from twisted.python.failure import Failure
+
+from serialization import DEFAULT_CODEC
+
+# Number of seconds GET responses are cached for, by path prefix. Paths which
+# don't match any prefix (e.g. /events) are never cached.
+DEFAULT_TTLS = {
+    '/configuration': 30,
+    '/services': 10,
+    '/limits': 60
+}
+DEFAULT_MAX_SIZE = 1000
+DEFAULT_SNAPSHOT_INTERVAL = 30
+
+NOT_CACHED = object()
+
+# Indexes into a cache entry. Entries are lists which are also the nodes of
+# the doubly linked list that keeps track of the least recently used one.
+PREV, NEXT, KEY, VALUE, EXPIRES, PATH = range(6)
+
+
+def getRequestKey(path, options=None):
+    """
+    Return a hashable key identifying a GET request.
+    """
+    return (path, tuple(sorted((options or {}).items())))
+
+
+def isInvalidatingWrite(method, path):
+    """
+    Return True if a request changes the resource at path, so the cached
+    responses for it and its parents must be dropped. Heartbeats only keep
+    a service alive and don't change anything which is cached.
+    """
+    return method != 'GET' and not path.endswith('/heartbeat')
+
+
+def getParentPaths(path):
+    """
+    Return path and all of its parent paths, with and without a trailing
+    slash, i.e. all the paths p for which isPathPrefix(p, path) is True.
+    """
+    paths = set([path])
+    index = path.find('/')
+
+    while index != -1:
+        if index:
+            paths.add(path[:index])
+
+        paths.add(path[:index + 1])
+        index = path.find('/', index + 1)
+
+    return paths
+
+
+def parseSnapshotEntry(entry):
+    """
+    Return the (key, value, expires) tuple of an entry of a cache snapshot,
+    or None if it isn't a [path, options, value, expires] list.
+    """
+    if not isinstance(entry, list) or len(entry) != 4:
+        return None
+
+    path, options, value, expires = entry
+
+    if not isinstance(path, basestring) or not isinstance(options, list) or \
+            isinstance(expires, bool) or \
+            not isinstance(expires, (int, long, float)):
+        return None
+
+    for option in options:
+        if not isinstance(option, list) or len(option) != 2 or \
+                not isinstance(option[0], basestring) or \
+                isinstance(option[1], (list, dict)):
+            return None
+
+    try:
+        path = str(path)
+    except UnicodeError:
+        return None
+
+    return getRequestKey(path, dict(options)), value, expires
+
+
+def isPathPrefix(prefix, path):
+    """
+    Return True if prefix is path itself or one of its parent paths.
+    """
+    if prefix == path:
+        return True
+
+    return path.startswith(prefix.rstrip('/') + '/')
+
+
+class ResponseCache(object):
+    """
+    A TTL and LRU bounded cache of parsed GET responses, keyed on the path
+    and the query options.
+
+    Values are copied on the way in and out, so callers are free to modify
+    the results they get.
+
+    With maxStaleness, responses are kept for that many seconds after they
+    expire. lookup() still returns them, flagged as stale, so the client can
+    answer right away and refresh them in the background. This keeps reads
+    working while the registry is slow or down, for a bounded time.
+
+    With snapshotPath, the cache is also written to a file every
+    snapshotInterval seconds and loaded from it on creation, so a restarted
+    process can serve stale responses before it reaches the registry. Call
+    flush() on shutdown to write the last changes.
+    """
+    def __init__(self, ttls=None, maxSize=DEFAULT_MAX_SIZE, clock=None,
+                 maxStaleness=None, snapshotPath=None,
+                 snapshotInterval=DEFAULT_SNAPSHOT_INTERVAL,
+                 codec=DEFAULT_CODEC):
+        """
+        @param ttls: Mapping of path prefixes to the number of seconds
+        responses for those paths are cached. The longest matching prefix
+        wins and paths without a match are not cached.
+        @type ttls: C{dict}
+        @param maxSize: Maximum number of cached responses. The least
+        recently used response is evicted when the cache is full.
+        @type maxSize: C{int}
+        @param clock: Provider of IReactorTime, defaults to the reactor.
+        @param maxStaleness: Optional number of seconds expired responses
+        can still be served for while they are being refreshed.
+        @type maxStaleness: C{float}
+        @param snapshotPath: Optional path of the file the cache is saved
+        to and loaded from.
+        @type snapshotPath: C{str}
+        @param snapshotInterval: Minimum number of seconds between two
+        writes of the snapshot.
+        @type snapshotInterval: C{float}
+        @param codec: Codec used to encode the snapshot.
+        @type codec: L{JSONCodec}
+        """
+        self.ttls = DEFAULT_TTLS if ttls is None else ttls
+        self.maxSize = maxSize
+        self.maxStaleness = maxStaleness or 0
+        self.snapshotPath = snapshotPath
+        self.snapshotInterval = snapshotInterval
+        self.codec = codec
+        self._clock = clock or reactor
+        self._entries = {}
+        self._paths = {}
+        self._root = []
+        self._root[:] = [self._root, self._root, None, None, None, None]
+        self._revalidating = set()
+        self._snapshotId = None
+        self._dirty = False
+        self._stats = {'hits': 0,
+                       'misses': 0,
+                       'staleHits': 0,
+                       'evictions': 0,
+                       'expirations': 0,
+                       'invalidations': 0,
+                       'snapshotWrites': 0}
+
+        if snapshotPath is not None:
+            self.loadSnapshot()
+
+    def getTTL(self, path):
+        """
+        Return the number of seconds responses for path are cached, or None
+        if they are not cached.
+        """
+        match = None
+
+        for prefix in self.ttls:
+            if isPathPrefix(prefix, path) and \
+                    (match is None or len(prefix) > len(match)):
+                match = prefix
+
+        if match is None:
+            return None
+
+        return self.ttls[match]
+
+    def getKey(self, path, options=None):
+        """
+        Return the cache key for a GET request, or None if responses for path
+        are not cached.
+        """
+        if not self.getTTL(path):
+            return None
+
+        return getRequestKey(path, options)
+
+    def get(self, key):
+        """
+        Return a copy of the cached value, or NOT_CACHED if there is no
+        fresh value.
+        """
+        return self._lookup(key, False)[0]
+
+    def lookup(self, key):
+        """
+        Return a (value, stale) tuple with a copy of the cached value, which
+        is stale if it expired less than maxStaleness seconds ago. The value
+        is NOT_CACHED if there is none.
+        """
+        return self._lookup(key, True)
+
+    def set(self, key, value):
+        path = key[0]
+        ttl = self.getTTL(path)
+
+        if not ttl:
+            return
+
+        self._insert(key, deepcopy(value), self._clock.seconds() + ttl)
+        self._changed()
+
+    def startRevalidation(self, key):
+        """
+        Return True if the caller should refresh the stale value for key,
+        i.e. if nobody is refreshing it already. finishRevalidation() must
+        be called once the refresh is over.
+        """
+        if key in self._revalidating:
+            return False
+
+        self._revalidating.add(key)
+
+        return True
+
+    def finishRevalidation(self, key):
+        self._revalidating.discard(key)
+
+    def invalidate(self, path):
+        """
+        Drop the cached responses for path and for all of its parent paths,
+        which list it.
+        """
+        for cachedPath in getParentPaths(path):
+            for key in list(self._paths.get(cachedPath, ())):
+                self._stats['invalidations'] += 1
+                self._removeEntry(self._entries[key])
+                self._changed()
+
+    def clear(self):
+        self._entries = {}
+        self._paths = {}
+        self._root[:] = [self._root, self._root, None, None, None, None]
+        self._changed()
+
+    def loadSnapshot(self):
+        """
+        Add the responses saved in the snapshot file to the cache. Those
+        which expired more than maxStaleness seconds ago are skipped, and so
+        are invalid entries.
+
+        @return: The number of responses which were loaded.
+        @rtype: C{int}
+        """
+        try:
+            with open(self.snapshotPath, 'r') as f:
+                data = f.read()
+        except IOError:
+            return 0
+
+        try:
+            entries = self.codec.decode(data)
+        except ValueError:
+            log.err(None, 'Invalid cache snapshot %s' % (self.snapshotPath))
+            return 0
+
+        if not isinstance(entries, list):
+            log.msg('Invalid cache snapshot %s: not a list' %
+                    (self.snapshotPath))
+            return 0
+
+        now = self._clock.seconds()
+        loaded = 0
+        invalid = 0
+
+        # Entries are saved from the least to the most recently used, so
+        # adding them in that order restores the LRU order.
+        for entry in entries:
+            parsed = parseSnapshotEntry(entry)
+
+            if parsed is None:
+                invalid += 1
+                continue
+
+            key, value, expires = parsed
+
+            if expires + self.maxStaleness <= now:
+                continue
+
+            self._insert(key, value, expires)
+            loaded += 1
+
+        if invalid:
+            log.msg('Skipped %s invalid entries of cache snapshot %s' %
+                    (invalid, self.snapshotPath))
+
+        return loaded
+
+    def flush(self):
+        """
+        Write the snapshot file now if the cache changed since it was last
+        written.
+        """
+        if self._snapshotId is not None:
+            if self._snapshotId.active():
+                self._snapshotId.cancel()
+
+            self._snapshotId = None
+
+        if self.snapshotPath is None or not self._dirty:
+            return
+
+        entries = []
+        entry = self._root[NEXT]
+
+        while entry is not self._root:
+            path, options = entry[KEY]
+            entries.append([path, options, entry[VALUE], entry[EXPIRES]])
+            entry = entry[NEXT]
+
+        temporaryPath = self.snapshotPath + '.tmp'
+
+        with open(temporaryPath, 'w') as f:
+            f.write(self.codec.encode(entries))
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.rename(temporaryPath, self.snapshotPath)
+        self._dirty = False
+        self._stats['snapshotWrites'] += 1
+
+    def getStats(self):
+        """
+        Return hit, miss, eviction, expiration and invalidation counters and
+        the current number of cached responses.
+
+        @rtype: C{dict}
+        """
+        stats = dict(self._stats)
+        stats['size'] = len(self._entries)
+
+        return stats
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _lookup(self, key, allowStale):
+        entry = self._entries.get(key)
+
+        if entry is None:
+            self._stats['misses'] += 1
+            return NOT_CACHED, False
+
+        now = self._clock.seconds()
+        stale = entry[EXPIRES] <= now
+
+        if stale:
+            if entry[EXPIRES] + self.maxStaleness <= now:
+                self._stats['expirations'] += 1
+                self._stats['misses'] += 1
+                self._removeEntry(entry)
+                self._changed()
+                return NOT_CACHED, False
+
+            if not allowStale:
+                self._stats['misses'] += 1
+                return NOT_CACHED, False
+
+            self._stats['staleHits'] += 1
+        else:
+            self._stats['hits'] += 1
+
+        self._unlink(entry)
+        self._link(entry)
+
+        return deepcopy(entry[VALUE]), stale
+
+    def _insert(self, key, value, expires):
+        if self.maxSize <= 0:
+            return
+
+        entry = self._entries.get(key)
+
+        if entry is not None:
+            self._removeEntry(entry)
+
+        while len(self._entries) >= self.maxSize:
+            self._stats['evictions'] += 1
+            self._removeEntry(self._root[NEXT])
+
+        path = key[0]
+        entry = [None, None, key, value, expires, path]
+        self._entries[key] = entry
+        self._paths.setdefault(path, set()).add(key)
+        self._link(entry)
+
+    def _changed(self):
+        if self.snapshotPath is None:
+            return
+
+        self._dirty = True
+
+        if self._snapshotId is None:
+            self._snapshotId = self._clock.callLater(self.snapshotInterval,
+                                                     self.flush)
+
+    def _link(self, entry):
+        # Most recently used entries are at the end of the list.
+        last = self._root[PREV]
+        entry[PREV] = last
+        entry[NEXT] = self._root
+        last[NEXT] = entry
+        self._root[PREV] = entry
+
+    def _unlink(self, entry):
+        entry[PREV][NEXT] = entry[NEXT]
+        entry[NEXT][PREV] = entry[PREV]
+
+    def _removeEntry(self, entry):
+        self._unlink(entry)
+        key = entry[KEY]
+        del self._entries[key]
+        keys = self._paths[entry[PATH]]
+        keys.discard(key)
+
+        if not keys:
+            del self._paths[entry[PATH]]
+
+
+class RequestCoalescer(object):
+    """
+    Deduplicates identical concurrent requests: while a request for a key is
+    in flight, further requests for the same key wait for it and get a copy
+    of its result instead of being sent.
+    """
+    def __init__(self):
+        self._inFlight = {}
+        self._stats = {'requests': 0,
+                       'coalesced': 0}
+
+    def run(self, key, function, *args, **kwargs):
+        """
+        Call function unless a call for key is already in flight.
+
+        Every caller gets its own Deferred. Cancelling it only stops that
+        caller from waiting, and the call is cancelled once no caller waits
+        for it anymore.
+
+        @return: A Deferred which fires with the result of the call.
+        @rtype: L{Deferred}
+        """
+        entry = self._inFlight.get(key)
+
+        if entry is None:
+            self._stats['requests'] += 1
+            entry = self._inFlight[key] = {'call': None, 'waiters': []}
+        else:
+            self._stats['coalesced'] += 1
+
+        d = Deferred(lambda d: self._cancelWaiter(key, entry, d))
+        entry['waiters'].append(d)
+
+        if entry['call'] is None:
+            entry['call'] = call = maybeDeferred(function, *args, **kwargs)
+            call.addBoth(self._fanOut, key, entry)
+
+        return d
+
+    def isInFlight(self, key):
+        return key in self._inFlight
+
+    def getStats(self):
+        """
+        Return the number of requests which were sent and the number of
+        requests which waited for an identical one instead.
+
+        @rtype: C{dict}
+        """
+        stats = dict(self._stats)
+        stats['inFlight'] = len(self._inFlight)
+
+        return stats
+
+    def _cancelWaiter(self, key, entry, waiter):
+        entry['waiters'].remove(waiter)
+
+        if not entry['waiters']:
+            if self._inFlight.get(key) is entry:
+                del self._inFlight[key]
+
+            entry['call'].cancel()
+
+    def _fanOut(self, result, key, entry):
+        if self._inFlight.get(key) is entry:
+            del self._inFlight[key]
+
+        waiters = entry['waiters']
+
+        if isinstance(result, Failure):
+            for waiter in waiters:
+                waiter.errback(result)
+        elif waiters:
+            # Copies are made before the first caller gets the original and
+            # possibly modifies it.
+            copies = [deepcopy(result) for waiter in waiters[1:]]
+            waiters[0].callback(result)
+
+            for waiter, value in zip(waiters[1:], copies):
+                waiter.callback(value)
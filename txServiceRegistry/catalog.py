@@ -0,0 +1,273 @@
+# Copyright 2012 Rackspace Hosting, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from twisted.internet import reactor
+
+from events import EventsTailer, DEFAULT_POLL_INTERVAL
+from resolver import Resolver
+
+SERVICE_JOIN = 'service.join'
+SERVICE_TIMEOUT = 'service.timeout'
+SERVICE_REMOVE = 'service.remove'
+
+
+class TagIndex(object):
+    """
+    An inverted index from tags, and metadata key/value pairs, to the IDs of
+    the services which have them. It is updated incrementally as services
+    are added and removed, so lookups never scan the catalog.
+    """
+    def __init__(self, indexMetadata=True):
+        """
+        @param indexMetadata: Whether metadata key/value pairs are indexed
+        as well as tags.
+        @type indexMetadata: C{bool}
+        """
+        self.indexMetadata = indexMetadata
+        self._tags = {}
+        self._metadata = {}
+
+    def add(self, service):
+        serviceId = service['id']
+
+        for tag in service.get('tags') or []:
+            self._tags.setdefault(tag, set()).add(serviceId)
+
+        if self.indexMetadata:
+            for item in (service.get('metadata') or {}).iteritems():
+                self._metadata.setdefault(item, set()).add(serviceId)
+
+    def remove(self, service):
+        serviceId = service['id']
+
+        for tag in service.get('tags') or []:
+            self._discard(self._tags, tag, serviceId)
+
+        if self.indexMetadata:
+            for item in (service.get('metadata') or {}).iteritems():
+                self._discard(self._metadata, item, serviceId)
+
+    def clear(self):
+        self._tags = {}
+        self._metadata = {}
+
+    def getIdsForTag(self, tag):
+        """
+        Return the set of IDs of the services which have the given tag. The
+        returned set must not be modified.
+        """
+        return self._tags.get(tag, frozenset())
+
+    def getIdsForMetadata(self, key, value):
+        """
+        Return the set of IDs of the services whose metadata maps key to
+        value. The returned set must not be modified.
+        """
+        return self._metadata.get((key, value), frozenset())
+
+    def getTags(self):
+        return self._tags.keys()
+
+    def _discard(self, index, key, serviceId):
+        ids = index.get(key)
+
+        if ids is None:
+            return
+
+        ids.discard(serviceId)
+
+        if not ids:
+            del index[key]
+
+
+class ServiceCatalog(object):
+    """
+    An in-process mirror of the service catalog.
+
+    start() takes one full snapshot of the services and then keeps it
+    current by tailing the events feed, so lookups are served from memory.
+    Returned service dicts are shared with the catalog and must not be
+    modified. The version attribute is incremented on every change, so
+    callers can cache what they derive from the catalog.
+    """
+    def __init__(self, servicesClient, eventsClient,
+                 pollInterval=DEFAULT_POLL_INTERVAL, maxStaleness=None,
+                 pageLimit=None, indexMetadata=True, clock=None):
+        """
+        @param servicesClient: Client used to take the snapshot.
+        @type servicesClient: L{ServicesClient}
+        @param eventsClient: Client used to tail the events feed.
+        @type eventsClient: L{EventsClient}
+        @param pollInterval: Number of seconds between two events polls.
+        @type pollInterval: C{float}
+        @param maxStaleness: Number of seconds without a successful sync
+        after which the catalog is considered stale. Defaults to three poll
+        intervals.
+        @type maxStaleness: C{float}
+        @param pageLimit: Page size used for the snapshot.
+        @type pageLimit: C{int}
+        @param indexMetadata: Whether services can be looked up by metadata
+        key/value pairs.
+        @type indexMetadata: C{bool}
+        @param clock: Provider of IReactorTime, defaults to the reactor.
+        """
+        self.servicesClient = servicesClient
+        self.maxStaleness = maxStaleness or pollInterval * 3
+        self.pageLimit = pageLimit
+        self.lastSnapshotTime = None
+        self.version = 0
+        self._clock = clock or reactor
+        self._services = {}
+        self.index = TagIndex(indexMetadata)
+        self.tailer = EventsTailer(eventsClient, self.handleEvent,
+                                   interval=pollInterval, clock=self._clock)
+
+    def start(self):
+        """
+        Take a snapshot and start following the events feed.
+
+        @return: A Deferred which fires once the snapshot has been loaded.
+        @rtype: L{Deferred}
+        """
+        # Find the end of the feed first so no event which happens while the
+        # snapshot is being taken is missed. Replaying such events on top of
+        # the snapshot is harmless.
+        d = self.tailer.seekToEnd()
+        d.addCallback(lambda _: self.refresh())
+        d.addCallback(lambda _: self.tailer.start())
+
+        return d
+
+    def stop(self):
+        """
+        Stop following the events feed.
+        """
+        self.tailer.stop()
+
+    def refresh(self):
+        """
+        Replace the catalog with a fresh snapshot of all the services.
+        """
+        def cbServices(services):
+            self._clear()
+
+            for service in services:
+                self._add(service)
+
+            self.lastSnapshotTime = self._clock.seconds()
+
+            return len(services)
+
+        iterator = self.servicesClient.iterAll(limit=self.pageLimit,
+                                               prefetch=True)
+        d = iterator.collect()
+        d.addCallback(cbServices)
+
+        return d
+
+    def handleEvent(self, event):
+        """
+        Apply a single event from the events feed to the catalog.
+        """
+        eventType = event.get('type')
+        payload = event.get('payload') or {}
+
+        if eventType == SERVICE_JOIN:
+            self._add(payload)
+        elif eventType in (SERVICE_TIMEOUT, SERVICE_REMOVE):
+            self._remove(payload.get('id'))
+
+    def get(self, serviceId):
+        """
+        Return the service with the given ID, or None if it isn't in the
+        catalog.
+        """
+        return self._services.get(serviceId)
+
+    def listForTag(self, tag):
+        """
+        Return all the services which have the given tag.
+        """
+        return self._getServices(self.index.getIdsForTag(tag))
+
+    def listForMetadata(self, key, value):
+        """
+        Return all the services whose metadata maps key to value.
+        """
+        return self._getServices(self.index.getIdsForMetadata(key, value))
+
+    def createResolver(self, tag, **kwargs):
+        """
+        Create a L{Resolver} which picks services with the given tag from
+        this catalog. Keyword arguments are passed to L{Resolver}.
+
+        @rtype: L{Resolver}
+        """
+        return Resolver(self, tag, **kwargs)
+
+    def getServiceIds(self):
+        return self._services.keys()
+
+    def getStaleness(self):
+        """
+        Return the number of seconds since the catalog was last known to be
+        in sync with the registry, or None if it was never synced.
+        """
+        lastSync = max(self.lastSnapshotTime, self.tailer.lastPollTime)
+
+        if lastSync is None:
+            return None
+
+        return self._clock.seconds() - lastSync
+
+    def isStale(self):
+        staleness = self.getStaleness()
+
+        return staleness is None or staleness > self.maxStaleness
+
+    def __len__(self):
+        return len(self._services)
+
+    def __contains__(self, serviceId):
+        return serviceId in self._services
+
+    def _getServices(self, serviceIds):
+        services = self._services
+
+        return [services[serviceId] for serviceId in serviceIds]
+
+    def _add(self, service):
+        serviceId = service.get('id')
+
+        if serviceId is None:
+            return
+
+        # A join for a service which is already in the catalog replaces it,
+        # its tags and metadata may have changed.
+        self._remove(serviceId)
+        self._services[serviceId] = service
+        self.index.add(service)
+        self.version += 1
+
+    def _remove(self, serviceId):
+        service = self._services.pop(serviceId, None)
+
+        if service is not None:
+            self.index.remove(service)
+            self.version += 1
+
+    def _clear(self):
+        self._services = {}
+        self.index.clear()
+        self.version += 1
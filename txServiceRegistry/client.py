@@ -14,23 +14,39 @@
 
 from cStringIO import StringIO
 import httplib
-try:
-    import simplejson as json
-except:
-    import json
-from copy import deepcopy
+from copy import copy, deepcopy
 import random
 
 from twisted.internet import reactor
-from twisted.internet.defer import Deferred
+from twisted.internet.defer import CancelledError, Deferred, fail, succeed
+from twisted.internet.error import ConnectError
 from twisted.internet.protocol import Protocol
 from twisted.python import log
-from twisted.web.client import Agent, HTTPConnectionPool
+from twisted.python.failure import Failure
+from twisted.web.client import Agent
 from urllib import urlencode
 
-from txKeystone import KeystoneAgent
-
-from utils import StringProducer
+from utils import StringProducer, ValuesStreamDecoder, discardResponse
+from serialization import DEFAULT_CODEC, EncodedBody, HeartbeatTemplate
+from auth import RefreshingKeystoneAgent, DEFAULT_REFRESH_MARGIN
+from pagination import PageIterator
+from bulk import runMany, DEFAULT_MAX_PARALLEL
+from registration import BulkRegistration, ServiceRegistration, \
+    RetryStrategy
+from catalog import ServiceCatalog
+from events import EventsTailer, FileMarkerStore
+from watcher import ConfigurationWatcher
+from cache import NOT_CACHED, RequestCoalescer, getRequestKey, \
+    isInvalidatingWrite
+from ratelimit import getPriority
+from concurrency import ConcurrencyLimiter, getEndpointClass
+from endpoints import EndpointSelector, NoHealthyEndpointError, \
+    IDEMPOTENT_METHODS
+from heartbeat import HeartbeatScheduler, HeartbeatError, \
+    calculateInterval, getLatestSendTime, getRetryDelay, \
+    updateRoundTripTime, DEFAULT_MAX_IN_FLIGHT, DEFAULT_RETRY_DELAY
+from pool import StatsHTTPConnectionPool, DEFAULT_MAX_PERSISTENT_PER_HOST, \
+    DEFAULT_CACHED_CONNECTION_TIMEOUT
 
 US_AUTH_URL = 'https://identity.api.rackspacecloud.com/v2.0/tokens'
 UK_AUTH_URL = 'https://lon.identity.api.rackspacecloud.com/v2.0/tokens'
@@ -41,32 +57,75 @@ MAX_HEARTBEAT_TIMEOUT = 30
 MAX_401_RETRIES = 1
 
 
+class RequestTimeoutError(Exception):
+    """
+    A request didn't finish before its deadline.
+    """
+
+
 class ResponseReceiver(Protocol):
     """
     Receives the response, and the response body is delivered to dataReceived
     as it arrives.
     When the body has been completely delivered, connectionLost is called.
+
+    If a valueCallback is passed, entries of the "values" array are decoded
+    while the body is still arriving and are passed to the callback one by
+    one instead of being returned as part of the result.
     """
-    def __init__(self, finished, heartbeater=None):
+    def __init__(self, finished, heartbeater=None, valueCallback=None,
+                 metrics=None, codec=DEFAULT_CODEC):
         """
         @param finished: Deferred to callback with result in connectionLost
         @type finished: L{Deferred}
         @param heartbeater: Optional HeartBeater object created when a
         session is created.
         @type heartbeater: L{HeartBeater}
+        @param valueCallback: Optional callable which is called with every
+        entry of the "values" array as soon as it has been received.
+        @type valueCallback: C{callable}
+        @param metrics: Optional metrics of the request, the number of
+        received bytes is added to it.
+        @type metrics: L{RequestMetrics}
+        @param codec: Codec used to decode the body.
+        @type codec: L{JSONCodec}
         """
         self.finished = finished
-        self.remaining = StringIO()
         self.heartbeater = heartbeater
+        self.metrics = metrics
+        self.codec = codec
+        self.error = None
+
+        if valueCallback:
+            self.decoder = ValuesStreamDecoder(valueCallback,
+                                               decode=codec.decode)
+            self.remaining = None
+        else:
+            self.decoder = None
+            self.remaining = StringIO()
 
     def dataReceived(self, receivedBytes):
         """
-        Writes received response body to self.remaining as it arrives.
+        Writes received response body to self.remaining as it arrives, or
+        feeds it to the streaming decoder.
         @param receivedBytes: Response body bytes to be written
         to self.remaining
         @type receivedBytes: C{str}
         """
-        self.remaining.write(receivedBytes)
+        if self.metrics is not None:
+            self.metrics.bytesIn += len(receivedBytes)
+
+        if self.decoder is None:
+            self.remaining.write(receivedBytes)
+            return
+
+        if self.error:
+            return
+
+        try:
+            self.decoder.feed(receivedBytes)
+        except Exception, e:
+            self.error = e
 
     def connectionLost(self, reason):
         """
@@ -74,16 +133,23 @@ class ResponseReceiver(Protocol):
         @param reason: Either a twisted.web.client.ResponseDone exception or
         a twisted.web.http.PotentialDataLoss exception.
         """
-        self.remaining.reset()
+        if self.error:
+            self.finished.errback(self.error)
+            return
 
         try:
-            result = json.load(self.remaining)
+            if self.decoder is None:
+                result = self.codec.decode(self.remaining.getvalue())
+            else:
+                result = self.decoder.finish()
         except Exception, e:
             self.finished.errback(e)
             return
 
         returnValue = result
-        if self.heartbeater:
+        # Error responses, e.g. serviceWithThisIdExists, are returned as they
+        # are.
+        if self.heartbeater and 'token' in result:
             self.heartbeater.nextToken = result['token']
             returnValue = (result, self.heartbeater)
 
@@ -96,9 +162,88 @@ class BaseClient(object):
     ConfigurationClient, and AccountClient to inherit from so they can call
     BaseClient.request()
     """
-    def __init__(self, agent, baseUrl):
+    def __init__(self, agent, baseUrl, cache=None, coalescer=None,
+                 rateLimiter=None, instrumentation=None,
+                 concurrencyLimiter=None, codec=None, endpoints=None,
+                 timeout=None):
+        """
+        @param agent: An instance of txKeystoneAgent.KeystoneAgent
+        @type agent: L{KeystoneAgent}
+        @param baseUrl:  The base Service Registry URL.
+        @type baseUrl: C{str}
+        @param cache: Optional cache for GET responses, shared by all the
+        clients created by the same L{Client}.
+        @type cache: L{ResponseCache}
+        @param coalescer: Optional coalescer which makes identical concurrent
+        GET requests share a single HTTP request.
+        @type coalescer: L{RequestCoalescer}
+        @param rateLimiter: Optional rate limiter which queues requests to
+        keep them under the account rate limit.
+        @type rateLimiter: L{RateLimiter}
+        @param instrumentation: Optional collector of request metrics.
+        @type instrumentation: L{Instrumentation}
+        @param concurrencyLimiter: Optional limiter of the number of requests
+        in flight.
+        @type concurrencyLimiter: L{ConcurrencyLimiter}
+        @param codec: Codec used to encode request bodies and decode response
+        bodies, defaults to the json module.
+        @type codec: L{JSONCodec}
+        @param endpoints: Optional selector of the registry endpoint every
+        request is sent to, which replaces baseUrl.
+        @type endpoints: L{EndpointSelector}
+        @param timeout: Optional number of seconds after which requests fail
+        with L{RequestTimeoutError}. See withTimeout().
+        @type timeout: C{float}
+        """
         self.agent = agent
         self.baseUrl = baseUrl
+        self.cache = cache
+        self.coalescer = coalescer
+        self.rateLimiter = rateLimiter
+        self.instrumentation = instrumentation
+        self.concurrencyLimiter = concurrencyLimiter
+        self.codec = codec or DEFAULT_CODEC
+        self.endpoints = endpoints
+        self.timeout = timeout
+        self._clock = reactor
+        self._tenantId = None
+        self._tenantUrl = None
+
+    def _getClientOptions(self):
+        """
+        Return the keyword arguments needed to create another client which
+        shares this client's state.
+        """
+        return {'cache': self.cache,
+                'coalescer': self.coalescer,
+                'rateLimiter': self.rateLimiter,
+                'instrumentation': self.instrumentation,
+                'concurrencyLimiter': self.concurrencyLimiter,
+                'codec': self.codec,
+                'endpoints': self.endpoints,
+                'timeout': self.timeout}
+
+    def withTimeout(self, timeout):
+        """
+        Return a copy of this client whose requests time out after the given
+        number of seconds, e.g. client.services.withTimeout(2).get(id).
+
+        The deadline covers the whole call: waiting for the rate and
+        concurrency limiters, authentication, connecting, and receiving the
+        response headers and body. When it passes, the call fails with
+        L{RequestTimeoutError} and its Deferred is cancelled. That aborts
+        the request, unless an identical coalesced call still waits for it:
+        a request which hasn't been sent yet isn't sent, and the connection
+        of one which has is closed as soon as possible. The request keeps
+        its concurrency limiter slot until then.
+
+        @param timeout: Number of seconds, or None for no timeout.
+        @type timeout: C{float}
+        """
+        client = copy(self)
+        client.timeout = timeout
+
+        return client
 
     def _get_options_object(self, marker=None, limit=None):
         options = {}
@@ -111,9 +256,174 @@ class BaseClient(object):
 
         return options
 
+    def _list(self, path, options, valueCallback=None):
+        if valueCallback is None:
+            return self.request('GET', path, options=options)
+
+        return self.request('GET', path, options=options,
+                            valueCallback=valueCallback)
+
+    def _iterate(self, listFunction, marker=None, limit=None,
+                 prefetch=False):
+        def fetchPage(marker, limit):
+            return listFunction(marker=marker, limit=limit)
+
+        return PageIterator(fetchPage, marker, limit, prefetch)
+
+    def _requestWithFailover(self, method, tenantId, relativeUrl, body,
+                             tried=(), attempt=None):
+        """
+        Send a request to the endpoint chosen by self.endpoints and send it
+        to the next one if it fails. Idempotent requests are also sent to
+        the next endpoint after a 5xx response, or when the endpoint hasn't
+        answered after its attemptTimeout. Both requests are then in flight:
+        the first successful response is used and the other request is
+        cancelled. Other requests are only sent again if they couldn't be
+        sent at all.
+        """
+        endpoint = self.endpoints.choose(method, tried)
+
+        if endpoint is None:
+            raise NoHealthyEndpointError('No healthy endpoint for %s %s' %
+                                         (method, relativeUrl))
+
+        idempotent = method in IDEMPOTENT_METHODS
+        started = self.endpoints.seconds()
+        result = Deferred(lambda _: stop())
+        # Requests in flight: the one sent to this endpoint and the one sent
+        # to the next endpoints once this one failed or took too long.
+        pending = []
+        # Set once result has fired or been cancelled, the requests which
+        # are still in flight are cancelled then.
+        done = []
+        timedOut = []
+        timeoutCall = None
+        bodyProducer = None
+
+        if body is not None:
+            bodyProducer = StringProducer(body)
+
+        def stop():
+            done.append(True)
+
+            if timeoutCall is not None and timeoutCall.active():
+                timeoutCall.cancel()
+
+            for request in pending:
+                request.cancel()
+
+        def deliver(value):
+            stop()
+
+            if isinstance(value, Failure):
+                result.errback(value)
+            else:
+                result.callback(value)
+
+        def failOver():
+            if attempt is not None and attempt.get('cancelled'):
+                return
+
+            try:
+                d = self._requestWithFailover(method, tenantId, relativeUrl,
+                                              body, tried + (endpoint,),
+                                              attempt)
+            except NoHealthyEndpointError:
+                return
+
+            pending.append(d)
+            d.addBoth(cbNextResponse, d)
+
+        def failed(value, request):
+            pending.remove(request)
+
+            if not pending:
+                deliver(value)
+            elif not isinstance(value, Failure):
+                # The other request is used instead.
+                discardResponse(value)
+
+        def cbResponse(value):
+            if done:
+                if not isinstance(value, Failure):
+                    discardResponse(value)
+
+                return
+
+            if timeoutCall is not None and timeoutCall.active():
+                timeoutCall.cancel()
+
+            if isinstance(value, Failure):
+                canFailOver = idempotent or value.check(ConnectError)
+            elif value.code < 500:
+                self.endpoints.recordSuccess(endpoint,
+                                             self.endpoints.seconds() -
+                                             started)
+                deliver(value)
+                return
+            else:
+                canFailOver = idempotent
+
+            if timedOut:
+                # The failure has been recorded and the request sent to the
+                # next endpoint already.
+                failed(value, d)
+                return
+
+            self.endpoints.recordFailure(endpoint)
+
+            if canFailOver:
+                failOver()
+                failed(value, d)
+            else:
+                deliver(value)
+
+        def cbNextResponse(value, request):
+            if done:
+                return
+
+            if not isinstance(value, Failure) and value.code < 500:
+                deliver(value)
+            else:
+                failed(value, request)
+
+        def onTimeout():
+            timedOut.append(True)
+            self.endpoints.recordFailure(endpoint)
+            # Keeps waiting for this endpoint if there's no other one to try.
+            failOver()
+
+        d = self.agent.request(method=method,
+                               uri=endpoint.url + tenantId + relativeUrl,
+                               headers=None,
+                               bodyProducer=bodyProducer)
+        pending.append(d)
+
+        if attempt is not None:
+            attempt.setdefault('requests', []).append(d)
+
+        if idempotent and self.endpoints.attemptTimeout is not None:
+            timeoutCall = self.endpoints.callLater(
+                self.endpoints.attemptTimeout, onTimeout)
+
+        d.addBoth(cbResponse)
+
+        return result
+
     def getIdFromUrl(self, url):
         return url.split('/')[-1]
 
+    def _getTenantUrl(self, tenantId):
+        """
+        Return the base URL of the tenant, which only changes if the tenant
+        of the auth token does.
+        """
+        if tenantId != self._tenantId:
+            self._tenantUrl = self.baseUrl + tenantId
+            self._tenantId = tenantId
+
+        return self._tenantUrl
+
     def cbRequest(self,
                   response,
                   method,
@@ -121,30 +431,60 @@ class BaseClient(object):
                   options,
                   payload,
                   heartbeater=None,
-                  retry_count=0):
-        if retry_count < MAX_401_RETRIES:
-            retry_count += 1
-
-            if response.code == httplib.UNAUTHORIZED:
-                return self.request(method,
-                                    path,
-                                    options,
-                                    payload,
-                                    heartbeater,
-                                    retry_count)
-            finished = Deferred()
-            # If response has no body, callback with True
-            if response.code == httplib.NO_CONTENT:
-                finished.callback(True)
+                  retry_count=0,
+                  valueCallback=None,
+                  metrics=None,
+                  attempt=None):
+        if response.code == httplib.UNAUTHORIZED:
+            if retry_count >= MAX_401_RETRIES:
+                raise APIError('API returned 401')
+
+            if metrics is not None:
+                # The retry is recorded as a request of its own.
+                self.instrumentation.finishRequest(metrics)
+
+            # The token was rejected before it expired, make sure the retry
+            # uses a new one unless it has been replaced already.
+            if hasattr(self.agent, 'invalidateToken'):
+                token = None
+
+                if attempt is not None:
+                    token = attempt.get('token')
+
+                self.agent.invalidateToken(token)
+
+            d = self.request(method,
+                             path,
+                             options,
+                             payload,
+                             heartbeater,
+                             retry_count + 1,
+                             valueCallback)
+
+            if attempt is not None:
+                attempt['retry'] = d
 
-                return finished
+            return d
 
-            response.deliverBody(ResponseReceiver(finished,
-                                                  heartbeater))
+        finished = Deferred()
+        # If response has no body, callback with True
+        if response.code == httplib.NO_CONTENT:
+            finished.callback(True)
 
             return finished
-        else:
-            raise APIError('API returned 401')
+
+        receiver = ResponseReceiver(finished,
+                                    heartbeater,
+                                    valueCallback,
+                                    metrics,
+                                    self.codec)
+
+        if attempt is not None:
+            attempt['receiver'] = receiver
+
+        response.deliverBody(receiver)
+
+        return finished
 
     def request(self,
                 method,
@@ -152,7 +492,8 @@ class BaseClient(object):
                 options=None,
                 payload=None,
                 heartbeater=None,
-                retry_count=0):
+                retry_count=0,
+                valueCallback=None):
         """
         Make a request to the Service Registry API.
         @param method: HTTP method ('POST', 'GET', etc.).
@@ -161,65 +502,395 @@ class BaseClient(object):
         @type path: C{str}
         @param options: Options to be encoded as query parameters in the URL.
         @type options: C{dict}
-        @param payload: Optional body
+        @param payload: Optional body, either an object which is encoded or
+        an L{EncodedBody} which is sent as it is, e.g. from a
+        L{HeartbeatTemplate}.
         @type payload: C{dict}
         @param heartbeater: Optional heartbeater passed in when
         creating a session.
         @type heartbeater: L{HeartBeater}
+        @param valueCallback: Optional callable which is called with every
+        entry of the "values" array of a list response while it is being
+        received. The result will then contain an empty "values" list.
+        @type valueCallback: C{callable}
+        """
+        cacheKey = None
+        isPlainGet = (method == 'GET' and heartbeater is None and
+                      valueCallback is None)
+
+        if self.cache is not None:
+            if isPlainGet:
+                cacheKey = self.cache.getKey(path, options)
+
+            if cacheKey is not None:
+                cached, stale = self.cache.lookup(cacheKey)
+
+                if cached is not NOT_CACHED:
+                    if stale:
+                        self._revalidate(path, options, cacheKey)
+
+                    return succeed(cached)
+
+        d = self._send(method, path, options, payload, heartbeater,
+                       retry_count, valueCallback, cacheKey)
+
+        if self.timeout is not None:
+            d = self._addTimeout(d, method, path)
+
+        return d
+
+    def _send(self, method, path, options, payload, heartbeater,
+              retry_count, valueCallback, cacheKey):
+        isPlainGet = (method == 'GET' and heartbeater is None and
+                      valueCallback is None)
+
+        # 401 retries are part of a request which is already in flight, so
+        # they must not wait for it.
+        if self.coalescer is not None and isPlainGet and retry_count == 0:
+            return self.coalescer.run(getRequestKey(path, options),
+                                      self._sendRequest, method, path,
+                                      options, payload, heartbeater,
+                                      retry_count, valueCallback, cacheKey)
+
+        return self._sendRequest(method, path, options, payload, heartbeater,
+                                 retry_count, valueCallback, cacheKey)
+
+    def _revalidate(self, path, options, cacheKey):
+        """
+        Refresh a stale cached response in the background. The stale
+        response stays in the cache if the refresh fails, until it is older
+        than the maximum staleness of the cache.
         """
-        def _request(authHeaders, options, payload, heartbeater, retry_count):
+        if not self.cache.startRevalidation(cacheKey):
+            return
+
+        def finish(_):
+            self.cache.finishRevalidation(cacheKey)
+
+        d = self._send('GET', path, options, None, None, 0, None, cacheKey)
+
+        if self.timeout is not None:
+            d = self._addTimeout(d, 'GET', path)
+
+        d.addErrback(log.err, 'Refreshing %s failed' % (path))
+        d.addBoth(finish)
+
+    def _sendRequest(self, method, path, options, payload, heartbeater,
+                     retry_count, valueCallback, cacheKey):
+        status = []
+        metrics = None
+
+        if self.instrumentation is not None:
+            metrics = self.instrumentation.startRequest(method, path,
+                                                        retry_count)
+
+        def recordStatus(response):
+            status.append(response.code)
+
+            return response
+
+        def recordResponse(response):
+            now = self.instrumentation.seconds()
+            metrics.status = response.code
+            metrics.response = now - metrics.responseStarted
+            metrics.bodyStarted = now
+
+            return response
+
+        def recordAuth(authHeaders):
+            now = self.instrumentation.seconds()
+            metrics.auth = now - metrics.authStarted
+            metrics.responseStarted = now
+
+            return authHeaders
+
+        def recordQueueWait():
+            now = self.instrumentation.seconds()
+            metrics.queueWait = now - metrics.started
+            metrics.authStarted = now
+
+        def finishRequest(result):
+            if not metrics.finished:
+                if metrics.bodyStarted is not None:
+                    metrics.body = (self.instrumentation.seconds() -
+                                    metrics.bodyStarted)
+
+                error = None
+
+                if isinstance(result, Failure):
+                    error = result.type.__name__
+
+                self.instrumentation.finishRequest(metrics, error)
+
+            return result
+
+        def cacheResult(result):
+            # Error responses are also parsed and returned as results, so
+            # only successful responses are cached.
+            if 200 <= status[0] < 300:
+                self.cache.set(cacheKey, result)
+
+            return result
+
+        def _request(authHeaders, options, payload, heartbeater, retry_count,
+                     attempt):
+            if attempt.get('cancelled'):
+                raise CancelledError()
+
             tenantId = authHeaders['X-Tenant-Id']
-            requestUrl = self.baseUrl + tenantId + path
+            attempt['token'] = authHeaders['X-Auth-Token']
+            relativeUrl = path
+
             if options:
-                requestUrl += '?' + urlencode(options)
-            payload = StringProducer(json.dumps(payload)) if payload else None
+                relativeUrl += '?' + urlencode(options)
+
+            body = None
+
+            if payload:
+                if isinstance(payload, EncodedBody):
+                    body = payload.data
+                else:
+                    body = self.codec.encode(payload)
+
+                if metrics is not None:
+                    metrics.bytesOut = len(body)
+
+            if self.endpoints is None:
+                bodyProducer = None
+
+                if body is not None:
+                    bodyProducer = StringProducer(body)
+
+                d = self.agent.request(
+                    method=method,
+                    uri=self._getTenantUrl(tenantId) + relativeUrl,
+                    headers=None,
+                    bodyProducer=bodyProducer)
+                attempt.setdefault('requests', []).append(d)
+            else:
+                d = self._requestWithFailover(method, tenantId, relativeUrl,
+                                              body, attempt=attempt)
+
+            d.addCallback(self._cbCheckCancelled, attempt)
+
+            if cacheKey is not None:
+                d.addCallback(recordStatus)
+
+            if metrics is not None:
+                d.addCallback(recordResponse)
 
-            d = self.agent.request(method=method,
-                                   uri=requestUrl,
-                                   headers=None,
-                                   bodyProducer=payload)
             d.addCallback(self.cbRequest,
                           method,
                           path,
                           options,
                           payload,
                           heartbeater,
-                          retry_count)
+                          retry_count,
+                          valueCallback,
+                          metrics,
+                          attempt)
+
+            if cacheKey is not None:
+                d.addCallback(cacheResult)
+
+            return d
+
+        # State shared with _abortRequest() once the request is cancelled.
+        attempt = {}
+
+        # 401 retries already hold a slot of the concurrency limiter.
+        limited = self.concurrencyLimiter is not None and retry_count == 0
+        queued = limited or self.rateLimiter is not None
+
+        def send(_=None):
+            if metrics is not None:
+                if queued:
+                    recordQueueWait()
+                else:
+                    metrics.authStarted = metrics.started
+
+            if attempt.get('cancelled'):
+                # Cancelled while it was queued.
+                return fail(CancelledError())
+
+            d = self.agent.getAuthHeaders()
+
+            if metrics is not None:
+                d.addCallback(recordAuth)
+
+            d.addCallback(_request, options, payload, heartbeater,
+                          retry_count, attempt)
 
             return d
 
-        d = self.agent.getAuthHeaders()
-        d.addCallback(_request, options, payload, heartbeater, retry_count)
+        if not queued:
+            d = send()
+        else:
+            if self.rateLimiter is None:
+                d = succeed(None)
+            else:
+                priority = getPriority(method, path, options)
+                d = self.rateLimiter.acquire(priority)
+
+            if limited:
+                endpointClass = getEndpointClass(method, path)
+                d.addCallback(lambda _: self.concurrencyLimiter.run(
+                    endpointClass, send))
+            else:
+                d.addCallback(send)
+
+        if metrics is not None:
+            d.addBoth(finishRequest)
+
+        # Invalidate once the change has been made, so the old value can't
+        # be fetched and cached again while it is in flight. 401 retries are
+        # covered by the original request.
+        if self.cache is not None and retry_count == 0 and \
+                isInvalidatingWrite(method, path):
+            d.addBoth(self._cbInvalidateCache, path)
+
+        # Cancelling the returned Deferred aborts the request instead of
+        # cancelling d, which could cancel the authentication shared with
+        # other requests. d fails as soon as the request has been aborted,
+        # which frees its concurrency limiter slot.
+        result = Deferred(lambda _: self._abortRequest(attempt))
+
+        def finished(value):
+            if result.called:
+                # Cancelled, the caller isn't waiting anymore.
+                return None
+
+            if isinstance(value, Failure):
+                result.errback(value)
+            else:
+                result.callback(value)
+
+        d.addBoth(finished)
+
+        return result
+
+    def _abortRequest(self, attempt):
+        """
+        Abort a request whose Deferred has been cancelled: it isn't sent if
+        it hasn't been yet, its response is dropped if it hasn't arrived and
+        its connection is closed if the body is being received.
+        """
+        attempt['cancelled'] = True
+        receiver = attempt.get('receiver')
+        retry = attempt.get('retry')
+
+        for request in attempt.get('requests', ()):
+            # Stops connecting if the connection isn't made yet. The Agent
+            # can't abort a request which has been sent, but cancelling it
+            # makes it fail right away with CancelledError.
+            request.cancel()
+
+        if receiver is not None and receiver.transport is not None:
+            # Closes the connection, which ends the body with an error.
+            receiver.transport.stopProducing()
+
+        if retry is not None:
+            retry.cancel()
+
+    def _cbCheckCancelled(self, response, attempt):
+        if attempt.get('cancelled'):
+            # The Agent can't abort a request which has been sent, so its
+            # connection is closed as soon as the response arrives.
+            discardResponse(response, abort=True)
+            raise CancelledError()
+
+        return response
+
+    def _addTimeout(self, d, method, path):
+        """
+        Make d fail with L{RequestTimeoutError} if it hasn't fired after
+        self.timeout seconds, see withTimeout().
+        """
+        timeout = self.timeout
+        timedOut = []
+
+        def onTimeout():
+            timedOut.append(True)
+
+            if self.instrumentation is not None:
+                self.instrumentation.recordTimeout(method, path)
+
+            d.cancel()
+
+        def finished(result):
+            if timeoutCall.active():
+                timeoutCall.cancel()
+
+            if timedOut and isinstance(result, Failure) and \
+                    result.check(CancelledError):
+                raise RequestTimeoutError(
+                    '%s %s timed out after %s seconds' % (method, path,
+                                                          timeout))
+
+            return result
+
+        timeoutCall = self._clock.callLater(timeout, onTimeout)
+        d.addBoth(finished)
 
         return d
 
+    def _cbInvalidateCache(self, result, path):
+        self.cache.invalidate(path)
+
+        return result
+
 
 class EventsClient(BaseClient):
-    def __init__(self, agent, baseUrl):
-        super(EventsClient, self).__init__(agent, baseUrl)
+    def __init__(self, agent, baseUrl, **kwargs):
+        super(EventsClient, self).__init__(agent, baseUrl, **kwargs)
         self.eventsPath = '/events'
 
-    def list(self, marker=None, limit=None):
+    def list(self, marker=None, limit=None, valueCallback=None):
         options = self._get_options_object(marker, limit)
 
-        return self.request('GET', self.eventsPath, options=options)
+        return self._list(self.eventsPath, options, valueCallback)
+
+    def iterAll(self, marker=None, limit=None, prefetch=False):
+        """
+        Return a L{PageIterator} over all the events, following
+        metadata.next_marker. If prefetch is True, the next page is
+        requested while the current one is being processed.
+        """
+        return self._iterate(self.list, marker, limit, prefetch)
 
 
 class ServicesClient(BaseClient):
-    def __init__(self, agent, baseUrl):
-        super(ServicesClient, self).__init__(agent, baseUrl)
+    def __init__(self, agent, baseUrl, **kwargs):
+        super(ServicesClient, self).__init__(agent, baseUrl, **kwargs)
         self.servicesPath = '/services'
 
-    def list(self, marker=None, limit=None):
+    def list(self, marker=None, limit=None, valueCallback=None):
         options = self._get_options_object(marker, limit)
 
-        return self.request('GET', self.servicesPath, options=options)
+        return self._list(self.servicesPath, options, valueCallback)
+
+    def iterAll(self, marker=None, limit=None, prefetch=False):
+        """
+        Return a L{PageIterator} over all the services, following
+        metadata.next_marker. If prefetch is True, the next page is
+        requested while the current one is being processed.
+        """
+        return self._iterate(self.list, marker, limit, prefetch)
 
-    def listForTag(self, tag, marker=None, limit=None):
+    def listForTag(self, tag, marker=None, limit=None, valueCallback=None):
         options = self._get_options_object(marker, limit)
         options['tag'] = tag
 
-        return self.request('GET', self.servicesPath, options=options)
+        return self._list(self.servicesPath, options, valueCallback)
+
+    def iterAllForTag(self, tag, marker=None, limit=None, prefetch=False):
+        """
+        Return a L{PageIterator} over all the services with the given tag.
+        """
+        def listFunction(marker, limit):
+            return self.listForTag(tag, marker=marker, limit=limit)
+
+        return self._iterate(listFunction, marker, limit, prefetch)
 
     def get(self, serviceId):
         path = '%s/%s' % (self.servicesPath, serviceId)
@@ -232,18 +903,39 @@ class ServicesClient(BaseClient):
         payload['heartbeat_timeout'] = heartbeatTimeout
         heartbeater = HeartBeater(self.agent,
                                   self.baseUrl,
-                                  None,
-                                  heartbeatTimeout)
+                                  serviceId,
+                                  heartbeatTimeout,
+                                  **self._getClientOptions())
 
         return self.request('POST', self.servicesPath, payload=payload,
                             heartbeater=heartbeater)
 
-    def heartbeat(self, serviceId, token):
+    def heartbeat(self, serviceId, token, template=None):
+        """
+        Heartbeat a service.
+
+        @param template: Optional pre-rendered heartbeat request of the
+        service, returned by getHeartbeatTemplate().
+        @type template: L{HeartbeatTemplate}
+        """
+        if template is not None:
+            return self.request('POST', template.path,
+                                payload=template.renderBody(token))
+
         path = '%s/%s/heartbeat' % (self.servicesPath, serviceId)
         payload = {'token': token}
 
         return self.request('POST', path, payload=payload)
 
+    def getHeartbeatTemplate(self, serviceId):
+        """
+        Return a L{HeartbeatTemplate} for a service, which makes sending its
+        heartbeats cheaper.
+        """
+        path = '%s/%s/heartbeat' % (self.servicesPath, serviceId)
+
+        return HeartbeatTemplate(path, self.codec)
+
     def update(self, serviceId, payload):
         path = '%s/%s' % (self.servicesPath, serviceId)
 
@@ -255,84 +947,242 @@ class ServicesClient(BaseClient):
         return self.request('DELETE', path)
 
     def register(self, serviceId, heartbeatTimeout, payload=None,
-                 retryDelay=2):
-        retryCount = MAX_HEARTBEAT_TIMEOUT / retryDelay
-        success = False
-        retryCounter = 0
-        registerResult = Deferred()
-        lastErr = None
-
-        def doRegister(serviceId, heartbeatTimeout, retryCounter,
-                       success, lastErr, result=None):
-            if success and (retryCounter < retryCount):
-                registerResult.callback(result)
-                return registerResult
-            elif (not success) and (retryCounter == retryCount):
-                registerResult.errback(lastErr)
-
-                return registerResult
-
-            def cbCreate(result, retryCounter, success):
-                # Create service returns a string service ID when it has
-                # succeeded, so if the result is a dict, it should be a
-                # parsed response body containing an error
-                if isinstance(result, dict):
-                    lastErr = result
-                    if result['type'] == 'serviceWithThisIdExists':
-                        retryCounter += 1
-                        reactor.callLater(retryDelay, doRegister,
-                                          serviceId, heartbeatTimeout,
-                                          retryCounter, success,
-                                          lastErr)
-
-                        return registerResult
-                    else:
-                        registerResult.errback(lastErr)
-
-                        return registerResult
-                else:
-                    return doRegister(serviceId, heartbeatTimeout,
-                                      retryCounter, True, None, result)
+                 retryDelay=None, retryStrategy=None, watchEvents=False):
+        """
+        Create a service, retrying while a service with the same ID still
+        exists, e.g. because the previous instance hasn't timed out yet.
 
-            d = self.create(serviceId, heartbeatTimeout, payload)
-            d.addCallback(cbCreate, retryCounter, success)
+        @param serviceId: ID of the service.
+        @type serviceId: C{str}
+        @param heartbeatTimeout: Heartbeat timeout of the service.
+        @type heartbeatTimeout: C{int}
+        @param payload: Optional payload of the service.
+        @type payload: C{dict}
+        @param retryDelay: Fixed number of seconds between retries. Ignored
+        if a retryStrategy is passed.
+        @type retryDelay: C{int}
+        @param retryStrategy: Strategy used to schedule retries, defaults to
+        exponential backoff with jitter for up to MAX_HEARTBEAT_TIMEOUT
+        seconds.
+        @type retryStrategy: L{RetryStrategy}
+        @param watchEvents: Whether to watch the events feed for the removal
+        of the old service and retry as soon as it happens.
+        @type watchEvents: C{bool}
+        @return: A Deferred which fires with the (response, L{HeartBeater})
+        tuple returned by create(), or fails with L{RegistrationError}.
+        @rtype: L{Deferred}
+        """
+        if retryStrategy is None:
+            if retryDelay is None:
+                retryStrategy = RetryStrategy(timeout=MAX_HEARTBEAT_TIMEOUT)
+            else:
+                retryStrategy = RetryStrategy(initialDelay=retryDelay,
+                                              multiplier=1, jitter=0,
+                                              timeout=MAX_HEARTBEAT_TIMEOUT)
 
-            return d
+        eventsClient = None
+
+        if watchEvents:
+            eventsClient = EventsClient(self.agent, self.baseUrl,
+                                        **self._getClientOptions())
+
+        registration = ServiceRegistration(self, serviceId, heartbeatTimeout,
+                                           payload, retryStrategy,
+                                           eventsClient)
+
+        return registration.run()
 
-        return doRegister(serviceId, heartbeatTimeout, retryCounter, success,
-                          lastErr)
+    def registerMany(self, services, maxParallel=DEFAULT_MAX_PARALLEL,
+                     retryDelay=2, timeout=MAX_HEARTBEAT_TIMEOUT):
+        """
+        Register many services at once, retrying the ones which still exist
+        every retryDelay seconds.
+
+        @param services: (serviceId, heartbeatTimeout) or (serviceId,
+        heartbeatTimeout, payload) tuples.
+        @type services: C{list}
+        @param maxParallel: Maximum number of concurrent create requests.
+        @type maxParallel: C{int}
+        @param retryDelay: Number of seconds between retries.
+        @type retryDelay: C{int}
+        @param timeout: Number of seconds after which services which still
+        exist aren't retried anymore.
+        @type timeout: C{int}
+        @return: A Deferred which fires with a dict mapping every service ID
+        to a (success, result) tuple. On success, the result is the
+        (response, L{HeartBeater}) tuple returned by create().
+        @rtype: L{Deferred}
+        """
+        registration = BulkRegistration(self, services, timeout, retryDelay,
+                                        maxParallel)
+
+        return registration.run()
+
+    def createMany(self, services, maxParallel=DEFAULT_MAX_PARALLEL):
+        """
+        Create many services at once, without retrying. See registerMany().
+        """
+        registration = BulkRegistration(self, services, 0, None, maxParallel)
+
+        return registration.run()
 
 
 class ConfigurationClient(BaseClient):
-    def __init__(self, agent, baseUrl):
-        super(ConfigurationClient, self).__init__(agent, baseUrl)
+    def __init__(self, agent, baseUrl, **kwargs):
+        super(ConfigurationClient, self).__init__(agent, baseUrl, **kwargs)
         self.configurationPath = '/configuration'
 
-    def list(self, marker=None, limit=None):
+    def list(self, marker=None, limit=None, valueCallback=None):
         options = self._get_options_object(marker, limit)
 
-        return self.request('GET', self.configurationPath, options=options)
+        return self._list(self.configurationPath, options, valueCallback)
+
+    def iterAll(self, marker=None, limit=None, prefetch=False):
+        """
+        Return a L{PageIterator} over all the configuration values, following
+        metadata.next_marker. If prefetch is True, the next page is
+        requested while the current one is being processed.
+        """
+        return self._iterate(self.list, marker, limit, prefetch)
+
+    def listForNamespace(self, namespace, marker=None, limit=None,
+                         valueCallback=None):
+        """
+        List the configuration values in a namespace, e.g. '/api/'.
+        """
+        options = self._get_options_object(marker, limit)
+        path = self._getNamespacePath(namespace)
+
+        return self._list(path, options, valueCallback)
+
+    def iterAllForNamespace(self, namespace, marker=None, limit=None,
+                            prefetch=False):
+        """
+        Return a L{PageIterator} over all the configuration values in a
+        namespace.
+        """
+        def listFunction(marker, limit):
+            return self.listForNamespace(namespace, marker=marker,
+                                         limit=limit)
+
+        return self._iterate(listFunction, marker, limit, prefetch)
+
+    def getNamespace(self, namespace, limit=None):
+        """
+        Fetch all the configuration values in a namespace with as few
+        requests as possible.
+
+        @return: A Deferred which fires with a dict mapping configuration
+        value IDs to values.
+        @rtype: L{Deferred}
+        """
+        def cbValues(values):
+            return dict([(value['id'], value['value']) for value in values])
+
+        d = self.iterAllForNamespace(namespace, limit=limit,
+                                     prefetch=True).collect()
+        d.addCallback(cbValues)
+
+        return d
 
     def get(self, configurationId):
         path = '%s/%s' % (self.configurationPath, configurationId)
 
         return self.request('GET', path)
 
+    def getMany(self, configurationIds, maxParallel=DEFAULT_MAX_PARALLEL,
+                namespace=None):
+        """
+        Get many configuration values at once.
+
+        @param configurationIds: IDs of the configuration values.
+        @type configurationIds: C{list}
+        @param maxParallel: Maximum number of concurrent requests.
+        @type maxParallel: C{int}
+        @param namespace: Optional namespace which contains the values, e.g.
+        '/api/'. If it's passed, the whole namespace is listed first and only
+        the values which aren't part of it are requested one by one.
+        @type namespace: C{str}
+        @return: A Deferred which fires with a dict mapping every ID to a
+        (success, result) tuple, where the result is the configuration value
+        as returned by get() or the error.
+        @rtype: L{Deferred}
+        """
+        configurationIds = list(configurationIds)
+
+        if namespace is None:
+            return runMany(self.get, configurationIds, maxParallel)
+
+        def cbNamespace(values):
+            results = {}
+            missing = []
+
+            for configurationId in configurationIds:
+                if configurationId in values:
+                    results[configurationId] = (True, values[configurationId])
+                else:
+                    missing.append(configurationId)
+
+            d = runMany(self.get, missing, maxParallel)
+            d.addCallback(lambda fetched: results.update(fetched))
+            d.addCallback(lambda _: results)
+
+            return d
+
+        def cbValues(values):
+            return dict([(value['id'], value) for value in values])
+
+        d = self.iterAllForNamespace(namespace, prefetch=True).collect()
+        d.addCallback(cbValues)
+        d.addCallback(cbNamespace)
+
+        return d
+
     def set(self, configurationId, value):
         path = '%s/%s' % (self.configurationPath, configurationId)
         payload = {'value': value}
 
         return self.request('PUT', path, payload=payload)
 
+    def setMany(self, values, maxParallel=DEFAULT_MAX_PARALLEL):
+        """
+        Set many configuration values at once.
+
+        @param values: Mapping of configuration value IDs to values.
+        @type values: C{dict}
+        @param maxParallel: Maximum number of concurrent requests.
+        @type maxParallel: C{int}
+        @return: A Deferred which fires with a dict mapping every ID to a
+        (success, result) tuple.
+        @rtype: L{Deferred}
+        """
+        def setValue(configurationId):
+            return self.set(configurationId, values[configurationId])
+
+        return runMany(setValue, values.keys(), maxParallel)
+
     def remove(self, configurationId):
         path = '%s/%s' % (self.configurationPath, configurationId)
 
         return self.request('DELETE', path)
 
+    def removeMany(self, configurationIds, maxParallel=DEFAULT_MAX_PARALLEL):
+        """
+        Remove many configuration values at once.
+
+        @return: A Deferred which fires with a dict mapping every ID to a
+        (success, result) tuple.
+        @rtype: L{Deferred}
+        """
+        return runMany(self.remove, configurationIds, maxParallel)
+
+    def _getNamespacePath(self, namespace):
+        return '%s/%s/' % (self.configurationPath, namespace.strip('/'))
+
 
 class AccountClient(BaseClient):
-    def __init__(self, agent, baseUrl):
-        super(AccountClient, self).__init__(agent, baseUrl)
+    def __init__(self, agent, baseUrl, **kwargs):
+        super(AccountClient, self).__init__(agent, baseUrl, **kwargs)
         self.limitsPath = '/limits'
 
     def getLimits(self):
@@ -340,38 +1190,54 @@ class AccountClient(BaseClient):
 
 
 class HeartBeater(BaseClient):
-    def __init__(self, agent, baseUrl, sessionId, heartbeatTimeout):
+    def __init__(self, agent, baseUrl, serviceId, heartbeatTimeout,
+                 retryDelay=DEFAULT_RETRY_DELAY, onAtRisk=None, clock=None,
+                 **kwargs):
         """
-        HeartBeater will start heartbeating a session once start() is called,
-        and stop heartbeating the session when stop() is called.
+        HeartBeater will start heartbeating a service once start() is called,
+        and stop heartbeating the service when stop() is called.
+
+        To heartbeat many services from a single timer, hand the HeartBeater
+        to HeartbeatScheduler.addHeartBeater() instead of starting it.
 
         @param agent: An instance of txKeystoneAgent.KeystoneAgent
         @type agent: L{KeystoneAgent}
         @param baseUrl:  The base Service Registry URL.
         @type baseUrl: C{str}
-        @param sessionId: The ID of the session to heartbeat.
-        @type sessionId: C{str}
-        @param heartbeatTimeout: The amount of time after which a session will
+        @param serviceId: The ID of the service to heartbeat.
+        @type serviceId: C{str}
+        @param heartbeatTimeout: The amount of time after which a service will
         time out if a heartbeat is not received.
         @type heartbeatTimeout: C{int}
+        @param retryDelay: Number of seconds before a failed heartbeat is
+        retried, as long as there's time left before the service times out.
+        @type retryDelay: C{float}
+        @param onAtRisk: Optional callable which is called with the service
+        ID and the number of seconds left before the service times out
+        whenever a heartbeat fails.
+        @type onAtRisk: C{callable}
+        @param clock: Provider of IReactorTime, defaults to the reactor.
         """
-        super(HeartBeater, self).__init__(agent, baseUrl)
-        self.sessionId = sessionId
+        super(HeartBeater, self).__init__(agent, baseUrl, **kwargs)
+        self.serviceId = serviceId
         self.heartbeatTimeout = heartbeatTimeout
         self.heartbeatInterval = self._calculateInterval(heartbeatTimeout)
+        self.retryDelay = retryDelay
+        self.onAtRisk = onAtRisk
         self.nextToken = None
+        self.deadline = None
+        self.rtt = None
+        self.failures = 0
+        self._clock = clock or reactor
+        self._timeoutId = None
         self._stopped = False
+        self._template = HeartbeatTemplate(
+            '/services/%s/heartbeat' % (serviceId), self.codec)
 
     def _calculateInterval(self, heartbeatTimeout):
-        if heartbeatTimeout < 15:
-            return heartbeatTimeout * 0.6
-        else:
-            return heartbeatTimeout * 0.8
+        return calculateInterval(heartbeatTimeout)
 
     def _startHeartbeating(self):
-        path = '/sessions/%s/heartbeat' % self.sessionId
-        payload = {'token': self.nextToken}
-
         if self._stopped:
             return
 
@@ -380,26 +1246,66 @@ class HeartBeater(BaseClient):
         if interval > 5:
             interval = interval + random.randrange(-3, 1)
 
+        sent = self._clock.seconds()
+
         def cbRequest(result):
-            self.nextToken = result['token']
+            if 'token' not in result:
+                raise HeartbeatError(result)
 
-        d = self.request('POST', path, payload=payload)
+            now = self._clock.seconds()
+            self.nextToken = result['token']
+            self.rtt = updateRoundTripTime(self.rtt, now - sent)
+            self.deadline = sent + self.heartbeatTimeout
+            self._reschedule(getLatestSendTime(self.deadline, self.rtt))
+
+        def ebRequest(failure):
+            now = self._clock.seconds()
+            self.failures += 1
+            log.err(failure, 'Heartbeating service %s failed' %
+                    (self.serviceId))
+            delay = getRetryDelay(self.deadline, self.rtt, now,
+                                  self.retryDelay)
+
+            if delay is not None:
+                self._reschedule(now + delay)
+
+            if self.onAtRisk is not None:
+                self.onAtRisk(self.serviceId, self.deadline - now)
+
+        self._timeoutId = self._clock.callLater(interval,
+                                                self._startHeartbeating)
+        d = self.request('POST', self._template.path,
+                         payload=self._template.renderBody(self.nextToken))
         d.addCallback(cbRequest)
-        self._timeoutId = reactor.callLater(interval, self._startHeartbeating)
+        d.addErrback(ebRequest)
+
+    def _reschedule(self, latest):
+        """
+        Move the next heartbeat to the given time if it's due later.
+        """
+        if self._timeoutId is None or not self._timeoutId.active():
+            return
+
+        if self._timeoutId.getTime() > latest:
+            self._timeoutId.reset(max(0, latest - self._clock.seconds()))
 
     def start(self):
         """
-        Start heartbeating the session. Will continue to heartbeat
+        Start heartbeating the service. Will continue to heartbeat
         until stop() is called.
         """
+        self.deadline = self._clock.seconds() + self.heartbeatTimeout
+
         return self._startHeartbeating()
 
     def stop(self):
         """
-        Stop heartbeating the session.
+        Stop heartbeating the service.
         """
         self._stopped = True
-        self._timeoutId.cancel()
+
+        if self._timeoutId is not None and self._timeoutId.active():
+            self._timeoutId.cancel()
 
 
 class APIError(Exception):
@@ -411,7 +1317,16 @@ class Client(object):
     The main client to be instantiated by the user.
     """
     def __init__(self, username, apiKey, region='us', baseUrl=DEFAULT_API_URL,
-                 agent=None):
+                 agent=None, pool=None,
+                 maxPersistentPerHost=DEFAULT_MAX_PERSISTENT_PER_HOST,
+                 cachedConnectionTimeout=DEFAULT_CACHED_CONNECTION_TIMEOUT,
+                 retryAutomatically=True, cache=None, coalesceRequests=True,
+                 maxHeartbeatsInFlight=DEFAULT_MAX_IN_FLIGHT,
+                 rateLimiter=None, instrumentation=None,
+                 tokenRefreshMargin=DEFAULT_REFRESH_MARGIN,
+                 maxConcurrentRequests=None, maxConcurrentPerClass=None,
+                 maxQueuedRequests=None, codec=None, baseUrls=None,
+                 endpointTimeout=None, timeout=None):
         """
         @param username: Rackspace username.
         @type username: C{str}
@@ -421,19 +1336,184 @@ class Client(object):
         @type region: C{str}
         @param baseUrl: The base Service Registry URL.
         @type baseUrl: C{str}
-        @param agent: twisted.web.client.Agent
+        @param agent: twisted.web.client.Agent. If an agent is passed, the
+        connection pool options are ignored and the agent's own pool is used.
         @type agent: L{Agent}
+        @param pool: Connection pool used by the default agent. A
+        L{StatsHTTPConnectionPool} configured with the options below is
+        created if no pool is passed.
+        @type pool: L{HTTPConnectionPool}
+        @param maxPersistentPerHost: Maximum number of idle persistent
+        connections kept per host.
+        @type maxPersistentPerHost: C{int}
+        @param cachedConnectionTimeout: Number of seconds an idle connection
+        is kept before it is closed.
+        @type cachedConnectionTimeout: C{int}
+        @param retryAutomatically: Whether idempotent requests are retried
+        once when a cached connection turns out to be closed.
+        @type retryAutomatically: C{bool}
+        @param cache: Optional cache for GET responses. Pass a
+        L{ResponseCache} to enable caching. Give it a maxStaleness to keep
+        serving expired responses, refreshed in the background, while the
+        registry can't be reached.
+        @type cache: L{ResponseCache}
+        @param coalesceRequests: Whether identical concurrent GET requests
+        share a single HTTP request.
+        @type coalesceRequests: C{bool}
+        @param maxHeartbeatsInFlight: Maximum number of concurrent heartbeat
+        requests sent by the L{HeartbeatScheduler} in self.heartbeats.
+        @type maxHeartbeatsInFlight: C{int}
+        @param rateLimiter: Optional L{RateLimiter} shared by all the
+        sub-clients. Call startRefreshing(client.account) on it to seed it
+        from the account limits.
+        @type rateLimiter: L{RateLimiter}
+        @param instrumentation: Optional L{Instrumentation} which collects
+        latency, status and size metrics of every request. Requests aren't
+        measured if it's not passed.
+        @type instrumentation: L{Instrumentation}
+        @param tokenRefreshMargin: Number of seconds before the auth token
+        expires at which a new one is requested in the background.
+        @type tokenRefreshMargin: C{int}
+        @param maxConcurrentRequests: Maximum number of requests in flight.
+        Requests over the limit are queued. Unlimited by default.
+        @type maxConcurrentRequests: C{int}
+        @param maxConcurrentPerClass: Maximum number of requests in flight
+        per endpoint class ('heartbeat', 'read' or 'write'), e.g.
+        {'write': 5}.
+        @type maxConcurrentPerClass: C{dict}
+        @param maxQueuedRequests: Maximum number of requests waiting for a
+        slot. Requests over it fail with L{QueueFullError}.
+        @type maxQueuedRequests: C{int}
+        @param codec: Codec used to encode and decode JSON, e.g. a
+        L{JSONCodec} wrapping a faster JSON library.
+        @type codec: L{JSONCodec}
+        @param baseUrls: Optional Service Registry URLs, e.g. of several
+        regions, to use instead of baseUrl. Reads go to the fastest healthy
+        one, writes to the first healthy one, and requests fail over to the
+        next one on errors. See L{EndpointSelector}.
+        @type baseUrls: C{list}
+        @param endpointTimeout: Optional number of seconds after which an
+        idempotent request which has no response yet is also sent to the
+        next registry URL.
+        @type endpointTimeout: C{float}
+        @param timeout: Optional number of seconds after which requests fail
+        with L{RequestTimeoutError}. It can be overridden per call with
+        withTimeout() on the sub-clients.
+        @type timeout: C{float}
         """
-        pool = HTTPConnectionPool(reactor)
-        agent = agent or Agent(reactor, pool=pool)
+        if agent is None:
+            if pool is None:
+                pool = StatsHTTPConnectionPool(
+                    reactor,
+                    maxPersistentPerHost=maxPersistentPerHost,
+                    cachedConnectionTimeout=cachedConnectionTimeout,
+                    retryAutomatically=retryAutomatically)
+            agent = Agent(reactor, pool=pool)
+
+        # All the sub-clients and every HeartBeater share self.agent and
+        # therefore the same connection pool.
+        self.pool = pool
         authUrl = DEFAULT_AUTH_URLS.get(region, 'us')
 
         if not authUrl.endswith('/'):
             authUrl += '/'
 
-        self.agent = KeystoneAgent(agent, authUrl, (username, apiKey))
+        self.agent = RefreshingKeystoneAgent(agent, authUrl,
+                                             (username, apiKey),
+                                             refreshMargin=tokenRefreshMargin)
         self.baseUrl = baseUrl
-        self.events = EventsClient(self.agent, self.baseUrl)
-        self.services = ServicesClient(self.agent, self.baseUrl)
-        self.configuration = ConfigurationClient(self.agent, self.baseUrl)
-        self.account = AccountClient(self.agent, self.baseUrl)
+        self.endpoints = None
+
+        if baseUrls:
+            self.endpoints = EndpointSelector(baseUrls,
+                                              attemptTimeout=endpointTimeout)
+            self.baseUrl = self.endpoints.endpoints[0].url
+
+        self.cache = cache
+        self.coalescer = RequestCoalescer() if coalesceRequests else None
+        self.rateLimiter = rateLimiter
+        self.instrumentation = instrumentation
+        self.concurrencyLimiter = None
+
+        if maxConcurrentRequests is not None or maxConcurrentPerClass:
+            self.concurrencyLimiter = ConcurrencyLimiter(
+                maxConcurrentRequests, maxConcurrentPerClass,
+                maxQueuedRequests)
+
+        options = {'cache': cache,
+                   'coalescer': self.coalescer,
+                   'rateLimiter': rateLimiter,
+                   'instrumentation': instrumentation,
+                   'concurrencyLimiter': self.concurrencyLimiter,
+                   'codec': codec,
+                   'endpoints': self.endpoints,
+                   'timeout': timeout}
+        self.events = EventsClient(self.agent, self.baseUrl, **options)
+        self.services = ServicesClient(self.agent, self.baseUrl, **options)
+        self.configuration = ConfigurationClient(self.agent, self.baseUrl,
+                                                 **options)
+        self.account = AccountClient(self.agent, self.baseUrl, **options)
+        self.heartbeats = HeartbeatScheduler(self.services,
+                                             maxHeartbeatsInFlight)
+
+    def createEventsTailer(self, callback, markerPath=None, **kwargs):
+        """
+        Create an L{EventsTailer} which passes every new event to callback.
+        Keyword arguments are passed to L{EventsTailer}. Call start() on the
+        returned tailer to start polling.
+
+        @param markerPath: Optional path of a file in which the position in
+        the feed is saved, so tailing resumes from it after a restart.
+        @type markerPath: C{str}
+        @rtype: L{EventsTailer}
+        """
+        if markerPath is not None:
+            kwargs['store'] = FileMarkerStore(markerPath)
+
+        return EventsTailer(self.events, callback, **kwargs)
+
+    def createServiceCatalog(self, **kwargs):
+        """
+        Create a L{ServiceCatalog} which mirrors the services in memory.
+        Keyword arguments are passed to L{ServiceCatalog}. Call start() on
+        the returned catalog to load it.
+
+        @rtype: L{ServiceCatalog}
+        """
+        return ServiceCatalog(self.services, self.events, **kwargs)
+
+    def createConfigurationWatcher(self, namespace=None, **kwargs):
+        """
+        Create a L{ConfigurationWatcher} which mirrors the configuration
+        values, or the values in a namespace, in memory. Keyword arguments
+        are passed to L{ConfigurationWatcher}. Call start() on the returned
+        watcher to load it.
+
+        @rtype: L{ConfigurationWatcher}
+        """
+        return ConfigurationWatcher(self.configuration, self.events,
+                                    namespace=namespace, **kwargs)
+
+    def getEndpointHealth(self):
+        """
+        Return the health of every Service Registry endpoint, or None if the
+        client only uses baseUrl. See L{EndpointSelector.getHealth}.
+
+        @rtype: C{dict}
+        """
+        if self.endpoints is None:
+            return None
+
+        return self.endpoints.getHealth()
+
+    def getPoolStats(self):
+        """
+        Return connection reuse statistics for the shared connection pool, or
+        None if the pool doesn't keep track of them.
+
+        @rtype: C{dict}
+        """
+        if not hasattr(self.pool, 'getStats'):
+            return None
+
+        return self.pool.getStats()
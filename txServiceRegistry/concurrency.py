@@ -0,0 +1,235 @@
+# Copyright 2012 Rackspace Hosting, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from collections import deque
+
+from twisted.internet.defer import Deferred, fail, maybeDeferred, succeed
+
+ENDPOINT_CLASS_HEARTBEAT = 'heartbeat'
+ENDPOINT_CLASS_READ = 'read'
+ENDPOINT_CLASS_WRITE = 'write'
+
+
+def getEndpointClass(method, path):
+    """
+    Return the class of endpoint a request is made to: heartbeats, other
+    reads and other writes.
+    """
+    if path.endswith('/heartbeat'):
+        return ENDPOINT_CLASS_HEARTBEAT
+
+    if method == 'GET':
+        return ENDPOINT_CLASS_READ
+
+    return ENDPOINT_CLASS_WRITE
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class ConcurrencyLimiter(object):
+    """
+    Limits the number of requests in flight, both in total and per endpoint
+    class. Requests over the limit wait in a FIFO queue, in which requests
+    held back by the limit of their class don't hold up other classes.
+
+    The queue depth and waitForCapacity() let callers which generate large
+    bursts of requests slow down instead of queueing all of them.
+    """
+    def __init__(self, maxConcurrent=None, classLimits=None, maxQueued=None):
+        """
+        @param maxConcurrent: Maximum number of requests in flight, or None
+        for no overall limit.
+        @type maxConcurrent: C{int}
+        @param classLimits: Maximum number of requests in flight per
+        endpoint class, e.g. {'write': 5}.
+        @type classLimits: C{dict}
+        @param maxQueued: Maximum number of waiting requests. Requests over
+        it fail with L{QueueFullError}. Unlimited by default.
+        @type maxQueued: C{int}
+        """
+        self.maxConcurrent = maxConcurrent
+        self.classLimits = classLimits or {}
+        self.maxQueued = maxQueued
+        self._inFlight = 0
+        self._classInFlight = {}
+        self._queue = deque()
+        self._classQueued = {}
+        self._capacityWaiters = []
+        self._stats = {'started': 0,
+                       'queued': 0,
+                       'rejected': 0,
+                       'maxQueueDepth': 0}
+
+    def run(self, endpointClass, function, *args, **kwargs):
+        """
+        Call function once a slot is available for the endpoint class and
+        keep the slot until the Deferred it returns fires.
+
+        @return: A Deferred which fires with the result of the function.
+        @rtype: L{Deferred}
+        """
+        d = self.acquire(endpointClass)
+        d.addCallback(self._run, endpointClass, function, args, kwargs)
+
+        return d
+
+    def acquire(self, endpointClass):
+        """
+        Wait for a slot. release() must be called with the same endpoint
+        class once the request has finished.
+
+        @return: A Deferred which fires once the request may be sent.
+        @rtype: L{Deferred}
+        """
+        if self._canStart(endpointClass):
+            self._start(endpointClass)
+
+            return succeed(None)
+
+        if self.maxQueued is not None and len(self._queue) >= self.maxQueued:
+            self._stats['rejected'] += 1
+
+            return fail(QueueFullError('%s requests are already queued' %
+                                       (len(self._queue))))
+
+        d = Deferred()
+        self._queue.append((endpointClass, d))
+        self._classQueued[endpointClass] = \
+            self._classQueued.get(endpointClass, 0) + 1
+        self._stats['queued'] += 1
+        self._stats['maxQueueDepth'] = max(self._stats['maxQueueDepth'],
+                                           len(self._queue))
+
+        return d
+
+    def release(self, endpointClass):
+        self._inFlight -= 1
+        self._classInFlight[endpointClass] -= 1
+        self._startQueued()
+
+        if self._capacityWaiters:
+            # Waiters check again and wait for the next release if the slot
+            # has been taken.
+            waiters, self._capacityWaiters = self._capacityWaiters, []
+
+            for waiter in waiters:
+                waiter.callback(None)
+
+    def waitForCapacity(self, endpointClass=None):
+        """
+        Return a Deferred which fires as soon as a request could be sent
+        without being queued: immediately if that's already the case,
+        otherwise once a slot frees up which no queued request takes.
+
+        @param endpointClass: Optional endpoint class which must have a free
+        slot. Without one, the queue must be empty.
+        @rtype: L{Deferred}
+        """
+        if self._canStart(endpointClass):
+            return succeed(None)
+
+        d = Deferred()
+        self._capacityWaiters.append(d)
+        d.addCallback(lambda _: self.waitForCapacity(endpointClass))
+
+        return d
+
+    def getQueueDepth(self):
+        return len(self._queue)
+
+    def getInFlight(self, endpointClass=None):
+        if endpointClass is None:
+            return self._inFlight
+
+        return self._classInFlight.get(endpointClass, 0)
+
+    def getStats(self):
+        """
+        Return the number of started, queued and rejected requests, the
+        current and maximum queue depth and the number of requests in flight
+        per endpoint class.
+
+        @rtype: C{dict}
+        """
+        stats = dict(self._stats)
+        stats['queueDepth'] = len(self._queue)
+        stats['inFlight'] = self._inFlight
+        stats['classInFlight'] = dict(self._classInFlight)
+
+        return stats
+
+    def _canStart(self, endpointClass):
+        """
+        Return True if a request of the class can start right away, which
+        requires a free slot and no older request of the same class waiting.
+        """
+        if endpointClass is None:
+            return not self._queue and self._hasCapacity(None)
+
+        return (not self._classQueued.get(endpointClass) and
+                self._hasCapacity(endpointClass))
+
+    def _hasCapacity(self, endpointClass):
+        if self.maxConcurrent is not None and \
+                self._inFlight >= self.maxConcurrent:
+            return False
+
+        limit = self.classLimits.get(endpointClass)
+
+        if limit is not None and \
+                self._classInFlight.get(endpointClass, 0) >= limit:
+            return False
+
+        return True
+
+    def _start(self, endpointClass):
+        self._inFlight += 1
+        self._classInFlight[endpointClass] = \
+            self._classInFlight.get(endpointClass, 0) + 1
+        self._stats['started'] += 1
+
+    def _startQueued(self):
+        """
+        Start the waiting requests which fit, oldest first. A request whose
+        class is at its limit doesn't hold up requests of other classes.
+        """
+        index = 0
+
+        while index < len(self._queue):
+            if self.maxConcurrent is not None and \
+                    self._inFlight >= self.maxConcurrent:
+                return
+
+            endpointClass, d = self._queue[index]
+
+            if self._hasCapacity(endpointClass):
+                del self._queue[index]
+                self._classQueued[endpointClass] -= 1
+                self._start(endpointClass)
+                d.callback(None)
+            else:
+                index += 1
+
+    def _run(self, _, endpointClass, function, args, kwargs):
+        def release(result):
+            self.release(endpointClass)
+
+            return result
+
+        d = maybeDeferred(function, *args, **kwargs)
+        d.addBoth(release)
+
+        return d
@@ -0,0 +1,204 @@
+# Copyright 2012 Rackspace Hosting, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from twisted.internet import reactor
+
+CIRCUIT_CLOSED = 'closed'
+CIRCUIT_OPEN = 'open'
+CIRCUIT_HALF_OPEN = 'halfOpen'
+
+DEFAULT_FAILURE_THRESHOLD = 3
+DEFAULT_RESET_TIMEOUT = 30
+# Weight of a new sample in the moving average of the round trip time.
+RTT_WEIGHT = 0.25
+
+# Requests which can be sent again to another endpoint after any failure.
+# Others are only sent again if they couldn't be sent at all.
+IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'PUT', 'DELETE'])
+
+
+class NoHealthyEndpointError(Exception):
+    pass
+
+
+class RegistryEndpoint(object):
+    """
+    Health of a single registry API endpoint.
+    """
+    __slots__ = ('url', 'index', 'rtt', 'state', 'failures', 'openUntil',
+                 'probing', 'probeStarted', 'requests', 'errors')
+
+    def __init__(self, url, index):
+        self.url = url
+        self.index = index
+        self.rtt = None
+        self.state = CIRCUIT_CLOSED
+        self.failures = 0
+        self.openUntil = None
+        self.probing = False
+        self.probeStarted = None
+        self.requests = 0
+        self.errors = 0
+
+
+class EndpointSelector(object):
+    """
+    Picks the registry endpoint every request is sent to.
+
+    Idempotent requests are sent to the next endpoint when one fails, answers
+    with a 5xx or doesn't answer within attemptTimeout seconds. Other
+    requests are only sent again if they couldn't be sent at all.
+
+    Reads go to the healthy endpoint with the lowest measured round trip
+    time. Endpoints which haven't been measured yet are tried first, so all
+    of them get measured. Writes go to the first healthy endpoint in the
+    order they were given in.
+
+    Every endpoint has a circuit breaker. After failureThreshold failures
+    in a row it opens and the endpoint isn't used for resetTimeout seconds.
+    Then a single request is let through: the circuit closes again if it
+    succeeds and stays open for another resetTimeout otherwise. A probe
+    which hasn't finished after resetTimeout seconds counts as failed, and
+    another one is let through.
+    """
+    def __init__(self, urls, failureThreshold=DEFAULT_FAILURE_THRESHOLD,
+                 resetTimeout=DEFAULT_RESET_TIMEOUT, attemptTimeout=None,
+                 clock=None):
+        """
+        @param urls: Base URLs of the registry API endpoints, in order of
+        preference.
+        @type urls: C{list}
+        @param failureThreshold: Number of failures in a row after which an
+        endpoint isn't used anymore.
+        @type failureThreshold: C{int}
+        @param resetTimeout: Number of seconds before an endpoint which
+        failed is tried again.
+        @type resetTimeout: C{float}
+        @param attemptTimeout: Optional number of seconds after which an
+        idempotent request which has no response from an endpoint yet is
+        also sent to the next one. The first successful response is used and
+        the other request is cancelled.
+        @type attemptTimeout: C{float}
+        @param clock: Provider of IReactorTime, defaults to the reactor.
+        """
+        if not urls:
+            raise ValueError('At least one endpoint URL is required')
+
+        self.failureThreshold = failureThreshold
+        self.resetTimeout = resetTimeout
+        self.attemptTimeout = attemptTimeout
+        self.endpoints = []
+        self._clock = clock or reactor
+
+        for index, url in enumerate(urls):
+            if not url.endswith('/'):
+                url += '/'
+
+            self.endpoints.append(RegistryEndpoint(url, index))
+
+    def seconds(self):
+        return self._clock.seconds()
+
+    def callLater(self, delay, function, *args, **kwargs):
+        return self._clock.callLater(delay, function, *args, **kwargs)
+
+    def choose(self, method, exclude=()):
+        """
+        Return the endpoint a request should be sent to, or None if every
+        endpoint which isn't excluded is unhealthy.
+
+        @param method: HTTP method of the request.
+        @type method: C{str}
+        @param exclude: Endpoints which already failed for this request.
+        @rtype: L{RegistryEndpoint}
+        """
+        now = self._clock.seconds()
+        candidates = [endpoint for endpoint in self.endpoints
+                      if endpoint not in exclude and
+                      self._isAvailable(endpoint, now)]
+
+        if not candidates:
+            return None
+
+        if method == 'GET':
+            endpoint = min(candidates, key=self._getReadKey)
+        else:
+            endpoint = candidates[0]
+
+        if endpoint.state != CIRCUIT_CLOSED:
+            endpoint.state = CIRCUIT_HALF_OPEN
+            endpoint.probing = True
+            endpoint.probeStarted = now
+
+        return endpoint
+
+    def recordSuccess(self, endpoint, rtt):
+        """
+        Record a response from an endpoint which took rtt seconds.
+        """
+        endpoint.requests += 1
+        endpoint.failures = 0
+        endpoint.state = CIRCUIT_CLOSED
+        endpoint.probing = False
+
+        if endpoint.rtt is None:
+            endpoint.rtt = rtt
+        else:
+            endpoint.rtt += RTT_WEIGHT * (rtt - endpoint.rtt)
+
+    def recordFailure(self, endpoint):
+        """
+        Record a request to an endpoint which failed.
+        """
+        endpoint.requests += 1
+        endpoint.errors += 1
+        endpoint.failures += 1
+        endpoint.probing = False
+
+        if endpoint.state == CIRCUIT_HALF_OPEN or \
+                endpoint.failures >= self.failureThreshold:
+            endpoint.state = CIRCUIT_OPEN
+            endpoint.openUntil = self._clock.seconds() + self.resetTimeout
+
+    def getHealth(self):
+        """
+        Return the circuit state, round trip time, number of failures in a
+        row, requests and errors of every endpoint, by URL.
+
+        @rtype: C{dict}
+        """
+        health = {}
+
+        for endpoint in self.endpoints:
+            health[endpoint.url] = {'state': endpoint.state,
+                                    'rtt': endpoint.rtt,
+                                    'failures': endpoint.failures,
+                                    'requests': endpoint.requests,
+                                    'errors': endpoint.errors}
+
+        return health
+
+    def _isAvailable(self, endpoint, now):
+        if endpoint.state == CIRCUIT_CLOSED:
+            return True
+
+        # Only one request at a time may find out if the endpoint is back,
+        # unless it's been stuck for too long.
+        if endpoint.probing:
+            return now >= endpoint.probeStarted + self.resetTimeout
+
+        return now >= endpoint.openUntil
+
+    def _getReadKey(self, endpoint):
+        return (endpoint.rtt is not None, endpoint.rtt, endpoint.index)
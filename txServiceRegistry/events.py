@@ -0,0 +1,283 @@
+# Copyright 2012 Rackspace Hosting, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+
+from twisted.internet import reactor
+from twisted.python import log
+
+DEFAULT_POLL_INTERVAL = 5
+DEFAULT_BACKOFF = 2
+DEFAULT_SYNC_INTERVAL = 1
+
+
+class MemoryMarkerStore(object):
+    """
+    Keeps the marker of an L{EventsTailer} in memory.
+
+    Marker stores have three methods: load() returns the saved marker or
+    None, save(marker) saves a marker and flush() makes sure the last saved
+    marker is durable.
+    """
+    def __init__(self, marker=None):
+        self.marker = marker
+
+    def load(self):
+        return self.marker
+
+    def save(self, marker):
+        self.marker = marker
+
+    def flush(self):
+        pass
+
+
+class FileMarkerStore(object):
+    """
+    Keeps the marker of an L{EventsTailer} in a file, so tailing resumes
+    where it left off after a restart.
+
+    The file is replaced atomically and synced to disk. Saves are batched:
+    the file is written at most once every syncInterval seconds, so a busy
+    feed doesn't cost an fsync per page. Call flush() on shutdown to write
+    the last marker.
+    """
+    def __init__(self, path, syncInterval=DEFAULT_SYNC_INTERVAL, clock=None):
+        """
+        @param path: Path of the file.
+        @type path: C{str}
+        @param syncInterval: Minimum number of seconds between two writes,
+        or 0 to write on every save.
+        @type syncInterval: C{float}
+        @param clock: Provider of IReactorTime, defaults to the reactor.
+        """
+        self.path = path
+        self.syncInterval = syncInterval
+        self.writes = 0
+        self._clock = clock or reactor
+        self._marker = None
+        self._dirty = False
+        self._lastWrite = None
+        self._flushId = None
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as f:
+                marker = f.read().strip()
+        except IOError:
+            return None
+
+        self._marker = marker or None
+
+        return self._marker
+
+    def save(self, marker):
+        if marker == self._marker:
+            return
+
+        self._marker = marker
+        self._dirty = True
+        now = self._clock.seconds()
+
+        if self._lastWrite is None or \
+                now - self._lastWrite >= self.syncInterval:
+            self.flush()
+        elif self._flushId is None:
+            delay = self._lastWrite + self.syncInterval - now
+            self._flushId = self._clock.callLater(delay, self.flush)
+
+    def flush(self):
+        if self._flushId is not None:
+            if self._flushId.active():
+                self._flushId.cancel()
+
+            self._flushId = None
+
+        if not self._dirty:
+            return
+
+        temporaryPath = self.path + '.tmp'
+
+        with open(temporaryPath, 'w') as f:
+            f.write(self._marker or '')
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.rename(temporaryPath, self.path)
+        self._dirty = False
+        self._lastWrite = self._clock.seconds()
+        self.writes += 1
+
+
+class EventsTailer(object):
+    """
+    Polls the events feed starting at a marker and passes every new event to
+    a callback, in order.
+
+    The events feed returns the event the marker points to as the first
+    event of the page, so the last delivered event is remembered and
+    skipped when polling resumes from it.
+
+    If maxInterval is given, polling is adaptive: the tailer polls every
+    interval seconds while events are flowing and backs off towards
+    maxInterval while the feed is idle or failing. If a marker store is
+    given, the ID of the last delivered event is saved to it after every
+    page, and tailing resumes from the saved marker.
+    """
+    def __init__(self, eventsClient, callback, marker=None, limit=None,
+                 interval=DEFAULT_POLL_INTERVAL, maxInterval=None,
+                 backoff=DEFAULT_BACKOFF, store=None, clock=None):
+        """
+        @param eventsClient: Client used to list the events.
+        @type eventsClient: L{EventsClient}
+        @param callback: Called with every new event.
+        @type callback: C{callable}
+        @param marker: ID of the event to start tailing from.
+        @type marker: C{str}
+        @param limit: Maximum number of events requested per page.
+        @type limit: C{int}
+        @param interval: Number of seconds between two polls.
+        @type interval: C{float}
+        @param maxInterval: Maximum number of seconds between two polls when
+        the feed is idle. Defaults to always polling every interval seconds.
+        @type maxInterval: C{float}
+        @param backoff: Factor the interval grows by after every poll which
+        returned no events.
+        @type backoff: C{float}
+        @param store: Optional marker store, such as L{FileMarkerStore}. Its
+        marker takes precedence over the marker argument.
+        @param clock: Provider of IReactorTime, defaults to the reactor.
+        """
+        self.eventsClient = eventsClient
+        self.callback = callback
+        self.store = store
+
+        if store is not None:
+            marker = store.load() or marker
+
+        self.marker = marker
+        self.limit = limit
+        self.interval = interval
+        self.maxInterval = maxInterval
+        self.backoff = backoff
+        self.currentInterval = interval
+        self.lastEventId = marker
+        self.lastPollTime = None
+        self._clock = clock or reactor
+        self._timeoutId = None
+        self._stopped = True
+
+    def poll(self, deliver=True):
+        """
+        Fetch all the events after the current marker.
+
+        @param deliver: If False, events are skipped without being passed
+        to the callback, which fast-forwards the tailer to the end of the
+        feed.
+        @type deliver: C{bool}
+        @return: A Deferred which fires with the number of new events once
+        the last page has been processed.
+        @rtype: L{Deferred}
+        """
+        counter = [0]
+
+        def cbPage(page):
+            for event in page.get('values', []):
+                eventId = event.get('id')
+
+                if eventId is not None and eventId == self.lastEventId:
+                    continue
+
+                if deliver:
+                    self.callback(event)
+
+                counter[0] += 1
+
+                if eventId is not None:
+                    self.lastEventId = eventId
+                    self.marker = eventId
+
+            # The next marker points to an event which hasn't been delivered
+            # yet, so the last delivered event is saved instead.
+            if self.store is not None and self.lastEventId is not None:
+                self.store.save(self.lastEventId)
+
+            nextMarker = (page.get('metadata') or {}).get('next_marker')
+
+            if nextMarker:
+                self.marker = nextMarker
+
+                return fetchPage()
+
+            self.lastPollTime = self._clock.seconds()
+
+            return counter[0]
+
+        def fetchPage():
+            d = self.eventsClient.list(marker=self.marker, limit=self.limit)
+            d.addCallback(cbPage)
+
+            return d
+
+        return fetchPage()
+
+    def seekToEnd(self):
+        """
+        Move the marker to the end of the feed without delivering events.
+        """
+        return self.poll(deliver=False)
+
+    def start(self):
+        """
+        Start polling every interval seconds until stop() is called.
+        """
+        self._stopped = False
+        self._schedule()
+
+    def stop(self):
+        """
+        Stop polling and flush the marker store.
+        """
+        self._stopped = True
+
+        if self._timeoutId and self._timeoutId.active():
+            self._timeoutId.cancel()
+
+        self._timeoutId = None
+
+        if self.store is not None:
+            self.store.flush()
+
+    def _schedule(self):
+        if self._stopped:
+            return
+
+        self._timeoutId = self._clock.callLater(self.currentInterval,
+                                                self._run)
+
+    def _adjustInterval(self, count):
+        if self.maxInterval is None or count:
+            self.currentInterval = self.interval
+        else:
+            self.currentInterval = min(self.currentInterval * self.backoff,
+                                       self.maxInterval)
+
+    def _run(self):
+        self._timeoutId = None
+        d = self.poll()
+        d.addErrback(log.err, 'Polling the events feed failed')
+        d.addCallback(self._adjustInterval)
+        d.addCallback(lambda _: self._schedule())
+
+        return d
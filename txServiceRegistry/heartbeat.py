@@ -0,0 +1,478 @@
+# Copyright 2012 Rackspace Hosting, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import heapq
+import sys
+
+from twisted.internet import reactor
+from twisted.internet.defer import DeferredSemaphore
+from twisted.python import log
+
+DEFAULT_MAX_IN_FLIGHT = 50
+# Number of seconds before a failed heartbeat is retried, as long as there
+# is time left before the service times out.
+DEFAULT_RETRY_DELAY = 1
+# Number of seconds kept in reserve, on top of the round trip time, between
+# the time a heartbeat is sent and the time the service would time out.
+SAFETY_MARGIN = 1
+# Weight of a new sample in the moving average of the round trip time.
+RTT_WEIGHT = 0.25
+
+# Fractional part of the golden ratio. Adding it over and over modulo 1
+# yields phases which are spread evenly over the interval no matter how many
+# services are added.
+GOLDEN_RATIO_FRACTION = 0.6180339887498949
+
+
+def calculateInterval(heartbeatTimeout):
+    """
+    Return the number of seconds between two heartbeats for a service with
+    the given heartbeat timeout.
+    """
+    if heartbeatTimeout < 15:
+        return heartbeatTimeout * 0.6
+    else:
+        return heartbeatTimeout * 0.8
+
+
+class HeartbeatError(Exception):
+    """
+    The API returned an error response to a heartbeat, e.g. because the
+    service has already timed out. The response is available as the
+    response attribute.
+    """
+    def __init__(self, response):
+        Exception.__init__(self, response.get('message') or
+                           response.get('type'))
+        self.response = response
+
+
+def updateRoundTripTime(rtt, sample):
+    """
+    Return the moving average of the round trip time after a new sample.
+    """
+    if rtt is None:
+        return sample
+
+    return rtt + RTT_WEIGHT * (sample - rtt)
+
+
+def getLatestSendTime(deadline, rtt):
+    """
+    Return the latest time at which a heartbeat can be sent so that it
+    still reaches the server before the service times out at deadline.
+    """
+    return deadline - (rtt or 0) - SAFETY_MARGIN
+
+
+def getRetryDelay(deadline, rtt, now, retryDelay=DEFAULT_RETRY_DELAY):
+    """
+    Return the number of seconds to wait before retrying a failed
+    heartbeat, or None if there's no time left to retry before the service
+    times out at deadline. Retries are spread over the time which is left.
+    """
+    remaining = deadline - (rtt or 0) - now
+
+    if remaining <= 0:
+        return None
+
+    return min(retryDelay, remaining / 2.0)
+
+
+def compactToken(token):
+    """
+    Return an ASCII unicode token as a str, which takes about a third of the
+    memory on builds with 4 byte unicode characters.
+    """
+    if isinstance(token, unicode):
+        try:
+            return token.encode('ascii')
+        except UnicodeEncodeError:
+            pass
+
+    return token
+
+
+def getEntrySize(entry):
+    """
+    Return an estimate of the number of bytes used by a heartbeat entry and
+    the values which belong to it alone. Shared objects such as None, small
+    integers and the codec aren't counted.
+    """
+    size = sys.getsizeof(entry)
+
+    for name in HeartbeatEntry.__slots__:
+        value = getattr(entry, name)
+
+        if isinstance(value, (float, basestring)) or \
+                (isinstance(value, (int, long)) and
+                 not -5 <= value <= 256):
+            size += sys.getsizeof(value)
+
+    if entry.template is not None:
+        size += sys.getsizeof(entry.template) + \
+            sys.getsizeof(entry.template.path)
+
+    return size
+
+
+class HeartbeatEntry(object):
+    """
+    Heartbeat state of a single service. Entries use __slots__ since a
+    process can heartbeat tens of thousands of services.
+    """
+    __slots__ = ('serviceId', 'template', 'heartbeatTimeout', 'interval',
+                 'token', 'due', 'sequence', 'pending', 'lastSent', 'lastAck',
+                 'deadline', 'rtt', 'lag', 'maxLag', 'sent', 'failures',
+                 'skipped', 'retries')
+
+    def __init__(self, serviceId, heartbeatTimeout, token, template=None):
+        self.serviceId = serviceId
+        self.template = template
+        self.heartbeatTimeout = heartbeatTimeout
+        self.interval = calculateInterval(heartbeatTimeout)
+        self.token = compactToken(token)
+        self.due = None
+        self.sequence = None
+        self.pending = False
+        self.lastSent = None
+        self.lastAck = None
+        # Time after which the service times out unless a heartbeat reaches
+        # the server.
+        self.deadline = None
+        self.rtt = None
+        self.lag = 0.0
+        self.maxLag = 0.0
+        self.sent = 0
+        self.failures = 0
+        self.skipped = 0
+        self.retries = 0
+
+
+class HeartbeatScheduler(object):
+    """
+    Heartbeats many services from a single timer.
+
+    Services are kept in a heap ordered by the time their next heartbeat is
+    due and only the earliest one has a timer scheduled. Their phases are
+    spread evenly across the heartbeat interval and at most maxInFlight
+    heartbeats are sent at once, so timer count, CPU and connection usage
+    stay flat as the number of services grows.
+
+    The scheduler is the single owner of the heartbeat state. A service
+    costs its L{HeartbeatEntry} and values, its heap item and its share of
+    the entries dict, see getMemoryFootprint(). A L{HeartBeater} costs about
+    five times as much, so it's best dropped once it has been handed to
+    addHeartBeater(). The heartbeater.memory benchmark scenario measures
+    both (about 735 and 3620 bytes on 64-bit CPython 2.7).
+
+    A failed heartbeat is retried after retryDelay seconds as long as it can
+    still reach the server before the service times out, and onAtRisk is
+    called with the service ID and the number of seconds left. Heartbeats
+    are also sent earlier than their interval if the measured round trip
+    time would otherwise make them arrive too late.
+    """
+    def __init__(self, servicesClient, maxInFlight=DEFAULT_MAX_IN_FLIGHT,
+                 clock=None, retryDelay=DEFAULT_RETRY_DELAY, onAtRisk=None):
+        """
+        @param servicesClient: Client used to send the heartbeats.
+        @type servicesClient: L{ServicesClient}
+        @param maxInFlight: Maximum number of concurrent heartbeat requests.
+        @type maxInFlight: C{int}
+        @param clock: Provider of IReactorTime, defaults to the reactor.
+        @param retryDelay: Number of seconds before a failed heartbeat is
+        retried.
+        @type retryDelay: C{float}
+        @param onAtRisk: Optional callable which is called with the service
+        ID and the number of seconds left before the service times out
+        whenever a heartbeat fails. The number is negative if the service
+        has probably timed out already.
+        @type onAtRisk: C{callable}
+        """
+        self.servicesClient = servicesClient
+        self.retryDelay = retryDelay
+        self.onAtRisk = onAtRisk
+        self._clock = clock or reactor
+        self._semaphore = DeferredSemaphore(maxInFlight)
+        self._entries = {}
+        self._heap = []
+        self._sequence = 0
+        self._phase = 0.0
+        self._inFlight = 0
+        self._timeoutId = None
+        self._stopped = True
+
+    def add(self, serviceId, heartbeatTimeout, token):
+        """
+        Start heartbeating a service.
+
+        @param serviceId: ID of the service.
+        @type serviceId: C{str}
+        @param heartbeatTimeout: Heartbeat timeout of the service.
+        @type heartbeatTimeout: C{int}
+        @param token: Token returned when the service was created or last
+        heartbeated.
+        @type token: C{str}
+        """
+        self.remove(serviceId)
+        template = self.servicesClient.getHeartbeatTemplate(serviceId)
+        entry = HeartbeatEntry(serviceId, heartbeatTimeout, token, template)
+        entry.lastAck = self._clock.seconds()
+        entry.deadline = entry.lastAck + heartbeatTimeout
+        self._phase = (self._phase + GOLDEN_RATIO_FRACTION) % 1.0
+        self._entries[serviceId] = entry
+        self._push(entry, entry.lastAck + self._phase * entry.interval)
+        self._reschedule()
+
+        return entry
+
+    def addHeartBeater(self, heartbeater):
+        """
+        Take over heartbeating from a L{HeartBeater} returned by
+        ServicesClient.create(). The HeartBeater must not be started.
+        """
+        return self.add(heartbeater.serviceId, heartbeater.heartbeatTimeout,
+                        heartbeater.nextToken)
+
+    def remove(self, serviceId):
+        """
+        Stop heartbeating a service.
+        """
+        entry = self._entries.pop(serviceId, None)
+
+        if entry is not None:
+            # The heap item is skipped when it comes up.
+            entry.sequence = None
+
+    def start(self):
+        """
+        Start heartbeating all the services. Will continue until stop() is
+        called.
+        """
+        self._stopped = False
+        self._reschedule()
+
+    def stop(self):
+        """
+        Stop heartbeating all the services.
+        """
+        self._stopped = True
+
+        if self._timeoutId is not None and self._timeoutId.active():
+            self._timeoutId.cancel()
+
+        self._timeoutId = None
+
+    def getRoundTripTime(self, serviceId):
+        """
+        Return the moving average of the heartbeat round trip time of a
+        service, or None if no heartbeat has been acknowledged yet.
+        """
+        return self._entries[serviceId].rtt
+
+    def getLag(self, serviceId):
+        """
+        Return the number of seconds the last heartbeat of a service was sent
+        after it was due.
+        """
+        return self._entries[serviceId].lag
+
+    def getStats(self):
+        """
+        Return the number of services, in flight heartbeats, sent, failed,
+        retried and skipped heartbeats, and the mean and maximum lag across
+        services.
+
+        @rtype: C{dict}
+        """
+        entries = self._entries.values()
+        lags = [entry.lag for entry in entries]
+
+        return {'services': len(entries),
+                'inFlight': self._inFlight,
+                'sent': sum([entry.sent for entry in entries]),
+                'failures': sum([entry.failures for entry in entries]),
+                'skipped': sum([entry.skipped for entry in entries]),
+                'retries': sum([entry.retries for entry in entries]),
+                'meanLag': sum(lags) / len(lags) if lags else 0.0,
+                'maxLag': max([entry.maxLag for entry in entries] or [0.0])}
+
+    def getMemoryFootprint(self):
+        """
+        Return an estimate of the mean number of bytes used per service, or
+        None if there are no services.
+
+        @rtype: C{int}
+        """
+        count = len(self._entries)
+
+        if not count:
+            return None
+
+        size = sys.getsizeof(self._entries) + sys.getsizeof(self._heap)
+
+        for entry in self._entries.itervalues():
+            size += getEntrySize(entry)
+
+        for item in self._heap:
+            # The due time is the same float as the one of the entry.
+            size += sys.getsizeof(item)
+
+        return size / count
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, serviceId):
+        return serviceId in self._entries
+
+    def _push(self, entry, due):
+        self._sequence += 1
+        entry.due = due
+        entry.sequence = self._sequence
+        heapq.heappush(self._heap, (due, self._sequence, entry.serviceId))
+
+    def _peek(self):
+        """
+        Return the earliest heap item which still belongs to a service,
+        dropping stale ones.
+        """
+        while self._heap:
+            due, sequence, serviceId = self._heap[0]
+            entry = self._entries.get(serviceId)
+
+            if entry is not None and entry.sequence == sequence:
+                return due, entry
+
+            heapq.heappop(self._heap)
+
+        return None, None
+
+    def _reschedule(self):
+        if self._stopped:
+            return
+
+        due, entry = self._peek()
+
+        if entry is None:
+            if self._timeoutId is not None and self._timeoutId.active():
+                self._timeoutId.cancel()
+
+            self._timeoutId = None
+            return
+
+        delay = max(0, due - self._clock.seconds())
+
+        if self._timeoutId is not None and self._timeoutId.active():
+            if self._timeoutId.getTime() <= due:
+                return
+
+            self._timeoutId.reset(delay)
+        else:
+            self._timeoutId = self._clock.callLater(delay, self._run)
+
+    def _run(self):
+        self._timeoutId = None
+        now = self._clock.seconds()
+
+        while True:
+            due, entry = self._peek()
+
+            if entry is None or due > now:
+                break
+
+            heapq.heappop(self._heap)
+            self._push(entry, due + entry.interval)
+
+            if entry.pending:
+                # The previous heartbeat is still queued or in flight, its
+                # token hasn't been replaced yet.
+                entry.skipped += 1
+                continue
+
+            entry.pending = True
+            self._semaphore.run(self._sendHeartbeat, entry, due)
+
+        self._reschedule()
+
+    def _sendHeartbeat(self, entry, due):
+        now = self._clock.seconds()
+        entry.lag = now - due
+        entry.maxLag = max(entry.maxLag, entry.lag)
+        entry.lastSent = now
+        entry.sent += 1
+        self._inFlight += 1
+
+        def cbHeartbeat(result):
+            if 'token' not in result:
+                raise HeartbeatError(result)
+
+            entry.token = compactToken(result['token'])
+            entry.lastAck = self._clock.seconds()
+            entry.rtt = updateRoundTripTime(entry.rtt,
+                                            entry.lastAck - now)
+            # The server received the heartbeat after it was sent.
+            entry.deadline = now + entry.heartbeatTimeout
+            self._catchUp(entry)
+
+        def ebHeartbeat(failure):
+            entry.failures += 1
+            log.err(failure, 'Heartbeating service %s failed' %
+                    (entry.serviceId))
+            self._retry(entry)
+
+        def cbFinished(_):
+            entry.pending = False
+            self._inFlight -= 1
+
+        d = self.servicesClient.heartbeat(entry.serviceId, entry.token,
+                                          entry.template)
+        d.addCallback(cbHeartbeat)
+        d.addErrback(ebHeartbeat)
+        d.addBoth(cbFinished)
+
+        return d
+
+    def _catchUp(self, entry):
+        """
+        Move the next heartbeat of a service earlier if it would otherwise
+        reach the server after the service has timed out.
+        """
+        if self._entries.get(entry.serviceId) is not entry:
+            return
+
+        latest = getLatestSendTime(entry.deadline, entry.rtt)
+
+        if entry.due > latest:
+            self._push(entry, max(latest, self._clock.seconds()))
+            self._reschedule()
+
+    def _retry(self, entry):
+        if self._entries.get(entry.serviceId) is not entry:
+            return
+
+        now = self._clock.seconds()
+        delay = getRetryDelay(entry.deadline, entry.rtt, now,
+                              self.retryDelay)
+
+        if delay is not None and now + delay < entry.due:
+            entry.retries += 1
+            self._push(entry, now + delay)
+            self._reschedule()
+
+        if self.onAtRisk is not None:
+            try:
+                self.onAtRisk(entry.serviceId, entry.deadline - now)
+            except Exception:
+                log.err(None, 'Heartbeat onAtRisk callback failed')
@@ -0,0 +1,279 @@
+# Copyright 2012 Rackspace Hosting, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from bisect import bisect_left
+
+from twisted.internet import reactor
+from twisted.python import log
+
+# Upper bounds, in seconds, of the latency histogram buckets. The last bucket
+# catches everything slower.
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+
+# Request phases, in the order they happen.
+PHASES = ('queueWait', 'auth', 'response', 'body', 'total')
+
+# Resources of an item which are kept in endpoint names.
+SUB_RESOURCES = ('heartbeat',)
+
+
+def getEndpoint(method, path):
+    """
+    Return the name of the endpoint a request is made to, with the resource
+    ID replaced, e.g. 'POST /services/:id/heartbeat'. IDs can contain
+    slashes, so everything after the collection name but a known sub
+    resource is replaced.
+    """
+    parts = path.split('/')
+
+    if len(parts) > 2:
+        name = parts[:2] + [':id']
+
+        if len(parts) > 3 and parts[-1] in SUB_RESOURCES:
+            name.append(parts[-1])
+
+        parts = name
+
+    return '%s %s' % (method, '/'.join(parts))
+
+
+class Histogram(object):
+    """
+    A fixed bucket histogram of durations.
+    """
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+        if self.min is None or value < self.min:
+            self.min = value
+
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def getPercentile(self, percent):
+        """
+        Return the upper bound of the bucket which holds the given
+        percentile, or the maximum if it falls into the last bucket.
+        """
+        if not self.count:
+            return None
+
+        threshold = self.count * percent / 100.0
+        cumulative = 0
+
+        for index, count in enumerate(self.counts):
+            cumulative += count
+
+            if cumulative >= threshold and count:
+                if index < len(self.buckets):
+                    return min(self.buckets[index], self.max)
+
+                return self.max
+
+        return self.max
+
+    def getStats(self):
+        return {'count': self.count,
+                'mean': self.sum / self.count if self.count else None,
+                'min': self.min,
+                'max': self.max,
+                'p50': self.getPercentile(50),
+                'p99': self.getPercentile(99),
+                'buckets': list(self.counts)}
+
+
+class RequestMetrics(object):
+    """
+    Timings and sizes of a single HTTP request. Durations are in seconds and
+    are None for the phases the request didn't go through.
+    """
+    def __init__(self, method, path, started, retryCount=0):
+        self.method = method
+        self.path = path
+        self.endpoint = getEndpoint(method, path)
+        self.started = started
+        self.retryCount = retryCount
+        self.status = None
+        self.error = None
+        self.bytesIn = 0
+        self.bytesOut = 0
+        self.queueWait = None
+        self.auth = None
+        self.response = None
+        self.body = None
+        self.total = None
+        self.authStarted = None
+        self.responseStarted = None
+        self.bodyStarted = None
+        self.finished = False
+
+
+class EndpointStats(object):
+    """
+    Aggregated metrics of the requests made to one endpoint.
+    """
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.requests = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.retries = 0
+        self.bytesIn = 0
+        self.bytesOut = 0
+        self.statuses = {}
+        self.histograms = dict([(phase, Histogram(buckets))
+                                for phase in PHASES])
+
+    def add(self, metrics):
+        self.requests += 1
+        self.bytesIn += metrics.bytesIn
+        self.bytesOut += metrics.bytesOut
+
+        if metrics.retryCount:
+            self.retries += 1
+
+        if metrics.error is not None:
+            self.errors += 1
+
+        if metrics.status is not None:
+            self.statuses[metrics.status] = \
+                self.statuses.get(metrics.status, 0) + 1
+
+        for phase in PHASES:
+            value = getattr(metrics, phase)
+
+            if value is not None:
+                self.histograms[phase].add(value)
+
+    def getStats(self):
+        stats = {'requests': self.requests,
+                 'errors': self.errors,
+                 'timeouts': self.timeouts,
+                 'retries': self.retries,
+                 'bytesIn': self.bytesIn,
+                 'bytesOut': self.bytesOut,
+                 'statuses': dict(self.statuses)}
+
+        for phase in PHASES:
+            stats[phase] = self.histograms[phase].getStats()
+
+        return stats
+
+
+class Instrumentation(object):
+    """
+    Collects per-endpoint latency histograms, status code counts, byte
+    counts, 401 retries and queue wait times of the requests made by a
+    client, and passes the L{RequestMetrics} of every request to the
+    registered observers.
+
+    Pass an instance to L{Client} to enable it. Clients without one don't
+    measure anything.
+
+    Each request is split into phases: queueWait is the time spent queued
+    in the rate limiter and the concurrency limiter, auth the time spent
+    getting the auth headers, response the time until the response headers
+    arrived (connection setup and server time) and body the time spent
+    receiving and parsing the body.
+    """
+    def __init__(self, buckets=DEFAULT_BUCKETS, clock=None):
+        """
+        @param buckets: Upper bounds of the histogram buckets in seconds.
+        @type buckets: C{tuple}
+        @param clock: Provider of IReactorTime, defaults to the reactor.
+        """
+        self.buckets = buckets
+        self._clock = clock or reactor
+        self._observers = []
+        self._endpoints = {}
+
+    def seconds(self):
+        return self._clock.seconds()
+
+    def addObserver(self, observer):
+        """
+        Register a callable which is called with the L{RequestMetrics} of
+        every finished request.
+        """
+        self._observers.append(observer)
+
+    def removeObserver(self, observer):
+        self._observers.remove(observer)
+
+    def startRequest(self, method, path, retryCount=0):
+        """
+        Return a new L{RequestMetrics} for a request which is about to be
+        sent.
+        """
+        return RequestMetrics(method, path, self.seconds(), retryCount)
+
+    def finishRequest(self, metrics, error=None):
+        """
+        Record a finished request. Requests which have already been recorded
+        are ignored.
+        """
+        if metrics.finished:
+            return
+
+        metrics.finished = True
+        metrics.total = self.seconds() - metrics.started
+
+        if error is not None:
+            metrics.error = error
+
+        self._getStats(metrics.endpoint).add(metrics)
+
+        for observer in self._observers:
+            try:
+                observer(metrics)
+            except Exception:
+                log.err(None, 'Instrumentation observer failed')
+
+    def recordTimeout(self, method, path):
+        """
+        Record a call which failed because its deadline passed. The request
+        itself is recorded by finishRequest() once it has been aborted.
+        """
+        self._getStats(getEndpoint(method, path)).timeouts += 1
+
+    def getStats(self):
+        """
+        Return the aggregated metrics of every endpoint, keyed on the
+        endpoint name.
+
+        @rtype: C{dict}
+        """
+        return dict([(endpoint, stats.getStats())
+                     for endpoint, stats in self._endpoints.iteritems()])
+
+    def reset(self):
+        self._endpoints = {}
+
+    def _getStats(self, endpoint):
+        stats = self._endpoints.get(endpoint)
+
+        if stats is None:
+            stats = self._endpoints[endpoint] = EndpointStats(self.buckets)
+
+        return stats
@@ -0,0 +1,194 @@
+# Copyright 2012 Rackspace Hosting, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from twisted.internet.defer import Deferred, fail, maybeDeferred, succeed
+from twisted.python.failure import Failure
+
+
+class PageIterator(object):
+    """
+    Lazily iterates over all the pages of a list endpoint by following
+    metadata.next_marker.
+
+    Every call to next() returns a Deferred which fires with the values of
+    the next page, or with None once all the pages have been returned. next()
+    should only be called again once the previous Deferred has fired.
+
+    If prefetch is True, the request for the following page is made as soon
+    as a page has been handed out, so the round trip overlaps with the time
+    the consumer spends processing the current page.
+    """
+    def __init__(self, fetchPage, marker=None, limit=None, prefetch=False):
+        """
+        @param fetchPage: Callable which takes a marker and a limit and
+        returns a Deferred which fires with a page (a dict with "values" and
+        "metadata" keys).
+        @type fetchPage: C{callable}
+        @param marker: Marker of the first page.
+        @type marker: C{str}
+        @param limit: Maximum number of values per page.
+        @type limit: C{int}
+        @param prefetch: Whether to fetch the next page in the background.
+        @type prefetch: C{bool}
+        """
+        self.fetchPage = fetchPage
+        self.limit = limit
+        self.prefetch = prefetch
+        self.pageCount = 0
+        self._marker = marker
+        self._exhausted = False
+        # A list which holds the result of the prefetched page once it has
+        # arrived, and the Deferred returned by next() while it hasn't.
+        self._prefetched = None
+        self._prefetchWaiter = None
+
+    def hasMore(self):
+        """
+        Return False once the last page has been fetched.
+        """
+        return not self._exhausted or self._prefetched is not None
+
+    def next(self):
+        """
+        Fetch the next page.
+
+        @return: A Deferred which fires with a C{list} of values, or with
+        None if there are no more pages.
+        @rtype: L{Deferred}
+        """
+        if self._prefetched is not None:
+            prefetched, self._prefetched = self._prefetched, None
+
+            if not prefetched:
+                d = self._prefetchWaiter = Deferred()
+            elif isinstance(prefetched[0], Failure):
+                d = fail(prefetched[0])
+            else:
+                d = succeed(prefetched[0])
+        elif self._exhausted:
+            return succeed(None)
+        else:
+            d = self._fetch()
+
+        if self.prefetch:
+            d.addCallback(self._startPrefetch)
+
+        return d
+
+    def forEach(self, callback):
+        """
+        Call callback with every value of every page. If callback returns a
+        Deferred, the next value is only processed once it has fired.
+
+        @return: A Deferred which fires with the number of values once all
+        of them have been processed.
+        @rtype: L{Deferred}
+        """
+        result = Deferred()
+        state = {'values': iter(()), 'count': 0, 'done': False}
+
+        def cbPage(values):
+            if values is None:
+                state['done'] = True
+            else:
+                state['values'] = iter(values)
+
+        def step():
+            for value in state['values']:
+                state['count'] += 1
+
+                return maybeDeferred(callback, value)
+
+            d = self.next()
+            d.addCallback(cbPage)
+
+            return d
+
+        def finishStep(outcome):
+            if isinstance(outcome, Failure):
+                result.errback(outcome)
+                return False
+
+            return True
+
+        def loop():
+            # Pages and callbacks which complete right away (e.g. pages
+            # served from the cache) are handled in this loop instead of
+            # from their callbacks, so long listings don't recurse once per
+            # page.
+            while not state['done']:
+                outcome = []
+                d = step()
+                d.addBoth(outcome.append)
+
+                if not outcome:
+                    d.addCallback(lambda _: finishStep(outcome[0]) and loop())
+                    return
+
+                if not finishStep(outcome[0]):
+                    return
+
+            result.callback(state['count'])
+
+        loop()
+
+        return result
+
+    def collect(self):
+        """
+        Fetch all the remaining pages.
+
+        @return: A Deferred which fires with a C{list} of all the values.
+        @rtype: L{Deferred}
+        """
+        values = []
+        d = self.forEach(values.append)
+        d.addCallback(lambda _: values)
+
+        return d
+
+    def _fetch(self):
+        d = self.fetchPage(self._marker, self.limit)
+        d.addCallback(self._cbPage)
+
+        return d
+
+    def _cbPage(self, page):
+        self.pageCount += 1
+        metadata = page.get('metadata') or {}
+        self._marker = metadata.get('next_marker')
+
+        if not self._marker:
+            self._exhausted = True
+
+        return page.get('values', [])
+
+    def _startPrefetch(self, values):
+        if not self._exhausted and self._prefetched is None:
+            self._prefetched = prefetched = []
+            self._fetch().addBoth(self._cbPrefetched, prefetched)
+
+        return values
+
+    def _cbPrefetched(self, result, prefetched):
+        # The result, failures included, is kept for the next call to
+        # next(), so a failure nobody asks for isn't reported as unhandled.
+        waiter, self._prefetchWaiter = self._prefetchWaiter, None
+
+        if waiter is None:
+            prefetched.append(result)
+        elif isinstance(result, Failure):
+            waiter.errback(result)
+        else:
+            waiter.callback(result)
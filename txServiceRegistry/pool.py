@@ -0,0 +1,108 @@
+# Copyright 2012 Rackspace Hosting, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from twisted.web.client import HTTPConnectionPool
+
+DEFAULT_MAX_PERSISTENT_PER_HOST = 10
+DEFAULT_CACHED_CONNECTION_TIMEOUT = 240
+
+
+class StatsHTTPConnectionPool(HTTPConnectionPool):
+    """
+    A persistent HTTP connection pool which keeps track of how often
+    connections are reused, so it is possible to verify that TCP and TLS
+    handshakes are amortized over many requests.
+    """
+    def __init__(self, reactor, persistent=True,
+                 maxPersistentPerHost=DEFAULT_MAX_PERSISTENT_PER_HOST,
+                 cachedConnectionTimeout=DEFAULT_CACHED_CONNECTION_TIMEOUT,
+                 retryAutomatically=True):
+        """
+        @param reactor: The reactor used to schedule idle connection
+        eviction.
+        @type reactor: L{IReactorTime}
+        @param persistent: Whether connections should be kept open and
+        reused.
+        @type persistent: C{bool}
+        @param maxPersistentPerHost: The maximum number of idle connections
+        cached for a single host:port destination.
+        @type maxPersistentPerHost: C{int}
+        @param cachedConnectionTimeout: Number of seconds an idle connection
+        stays in the pool before it is evicted and closed.
+        @type cachedConnectionTimeout: C{int}
+        @param retryAutomatically: Whether idempotent requests which fail on
+        a cached connection the server already closed are retried once on a
+        new connection.
+        @type retryAutomatically: C{bool}
+        """
+        HTTPConnectionPool.__init__(self, reactor, persistent)
+        self.maxPersistentPerHost = maxPersistentPerHost
+        self.cachedConnectionTimeout = cachedConnectionTimeout
+        self.retryAutomatically = retryAutomatically
+        self._stats = {'requests': 0,
+                       'created': 0,
+                       'reused': 0,
+                       'evicted': 0,
+                       'dropped': 0}
+
+    def getConnection(self, key, endpoint):
+        self._stats['requests'] += 1
+        created = self._stats['created']
+        d = HTTPConnectionPool.getConnection(self, key, endpoint)
+
+        if self._stats['created'] == created:
+            self._stats['reused'] += 1
+
+        return d
+
+    def _newConnection(self, key, endpoint):
+        self._stats['created'] += 1
+
+        return HTTPConnectionPool._newConnection(self, key, endpoint)
+
+    def _removeConnection(self, key, connection):
+        # Only called when a cached connection has been idle for longer than
+        # cachedConnectionTimeout.
+        self._stats['evicted'] += 1
+
+        return HTTPConnectionPool._removeConnection(self, key, connection)
+
+    def _putConnection(self, key, connection):
+        connections = self._connections.get(key, [])
+
+        if len(connections) == self.maxPersistentPerHost:
+            self._stats['dropped'] += 1
+
+        return HTTPConnectionPool._putConnection(self, key, connection)
+
+    def getStats(self):
+        """
+        Return connection reuse statistics.
+
+        - requests: number of connections handed out by the pool
+        - created: number of new connections opened (including retries)
+        - reused: number of requests served by a cached connection
+        - evicted: number of idle connections closed after
+          cachedConnectionTimeout
+        - dropped: number of connections closed because
+          maxPersistentPerHost idle connections were already cached
+        - cached: number of idle connections currently in the pool
+
+        @rtype: C{dict}
+        """
+        stats = dict(self._stats)
+        stats['cached'] = sum([len(connections) for connections in
+                               self._connections.itervalues()])
+
+        return stats
@@ -0,0 +1,251 @@
+# Copyright 2012 Rackspace Hosting, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from collections import deque
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, succeed
+from twisted.python import log
+
+PRIORITY_HEARTBEAT = 0
+PRIORITY_DEFAULT = 1
+PRIORITY_LIST = 2
+PRIORITIES = (PRIORITY_HEARTBEAT, PRIORITY_DEFAULT, PRIORITY_LIST)
+
+DEFAULT_BURST = 50
+DEFAULT_REFRESH_INTERVAL = 300
+
+WINDOW_UNITS = {
+    'second': 1,
+    'minute': 60,
+    'hour': 60 * 60,
+    'day': 24 * 60 * 60
+}
+
+
+def parseWindow(window):
+    """
+    Parse a rate limit window such as '24.0 hours' into a number of seconds.
+    """
+    amount, unit = window.split()
+    unit = unit.lower().rstrip('s')
+
+    if unit not in WINDOW_UNITS:
+        raise ValueError('Unknown rate limit window unit: %s' % (unit))
+
+    return float(amount) * WINDOW_UNITS[unit]
+
+
+def getPriority(method, path, options=None):
+    """
+    Return the priority class of a request: heartbeats go first and listings
+    go last.
+    """
+    if path.endswith('/heartbeat'):
+        return PRIORITY_HEARTBEAT
+
+    # List methods always pass an options dict, even an empty one.
+    if method == 'GET' and options is not None:
+        return PRIORITY_LIST
+
+    return PRIORITY_DEFAULT
+
+
+class RateLimiter(object):
+    """
+    A token bucket which keeps the requests made by a client under the
+    account rate limit.
+
+    Requests which can't be sent yet are queued instead of failing, and are
+    released in priority order as tokens become available. The rate is
+    seeded from, and periodically refreshed with, AccountClient.getLimits().
+    Until a rate is known requests are not limited.
+    """
+    def __init__(self, rate=None, burst=DEFAULT_BURST, clock=None):
+        """
+        @param rate: Number of requests per second, or None.
+        @type rate: C{float}
+        @param burst: Maximum number of requests which can be sent at once
+        after a quiet period.
+        @type burst: C{int}
+        @param clock: Provider of IReactorTime, defaults to the reactor.
+        """
+        self.rate = rate
+        self.burst = burst
+        self._clock = clock or reactor
+        self._tokens = float(burst)
+        self._lastRefill = self._clock.seconds()
+        self._queues = dict([(priority, deque()) for priority in PRIORITIES])
+        self._timeoutId = None
+        self._refreshId = None
+        self._refreshing = False
+        self._stats = {'acquired': 0,
+                       'queued': 0}
+
+    def setRate(self, rate, remaining=None):
+        """
+        Change the rate.
+
+        @param rate: Number of requests per second, or None to stop limiting.
+        @type rate: C{float}
+        @param remaining: Number of requests left in the current window. The
+        bucket never holds more tokens than that.
+        @type remaining: C{int}
+        """
+        self._refill()
+        self.rate = rate
+
+        if remaining is not None:
+            self._tokens = min(self._tokens, max(0, remaining))
+
+        if self._timeoutId is not None and self._timeoutId.active():
+            self._timeoutId.cancel()
+
+        self._drain()
+
+    def seedFromLimits(self, limits):
+        """
+        Set the rate from the result of AccountClient.getLimits(). If there
+        are several rate windows, the most restrictive one is used.
+        """
+        rate = None
+        remaining = None
+
+        for value in (limits.get('rate') or {}).itervalues():
+            windowRate = value['limit'] / parseWindow(value['window'])
+
+            if rate is None or windowRate < rate:
+                rate = windowRate
+                remaining = value['limit'] - value.get('used', 0)
+
+        if rate is not None:
+            self.setRate(rate, remaining)
+
+        return limits
+
+    def startRefreshing(self, accountClient,
+                        interval=DEFAULT_REFRESH_INTERVAL):
+        """
+        Seed the rate from accountClient.getLimits() now and every interval
+        seconds until stopRefreshing() is called.
+        """
+        def refresh():
+            self._refreshId = None
+            d = accountClient.getLimits()
+            d.addCallback(self.seedFromLimits)
+            d.addErrback(log.err, 'Refreshing the rate limits failed')
+            d.addCallback(lambda _: schedule())
+
+            return d
+
+        def schedule():
+            if self._refreshing:
+                self._refreshId = self._clock.callLater(interval, refresh)
+
+        self._refreshing = True
+
+        return refresh()
+
+    def stopRefreshing(self):
+        self._refreshing = False
+
+        if self._refreshId is not None and self._refreshId.active():
+            self._refreshId.cancel()
+
+        self._refreshId = None
+
+    def acquire(self, priority=PRIORITY_DEFAULT):
+        """
+        Wait for permission to send a request.
+
+        @return: A Deferred which fires once the request may be sent.
+        @rtype: L{Deferred}
+        """
+        if self.rate is None:
+            self._stats['acquired'] += 1
+            return succeed(None)
+
+        self._refill()
+
+        if self._tokens >= 1 and not self.getQueueDepth():
+            self._tokens -= 1
+            self._stats['acquired'] += 1
+            return succeed(None)
+
+        self._stats['queued'] += 1
+        d = Deferred()
+        self._queues[priority].append(d)
+        self._schedule()
+
+        return d
+
+    def getQueueDepth(self):
+        return sum([len(queue) for queue in self._queues.itervalues()])
+
+    def getStats(self):
+        """
+        Return the number of acquired and queued requests, the current queue
+        depth and the number of available tokens.
+
+        @rtype: C{dict}
+        """
+        self._refill()
+        stats = dict(self._stats)
+        stats['queueDepth'] = self.getQueueDepth()
+        stats['tokens'] = self._tokens
+        stats['rate'] = self.rate
+
+        return stats
+
+    def _refill(self):
+        now = self._clock.seconds()
+
+        if self.rate is not None:
+            elapsed = now - self._lastRefill
+            self._tokens = min(float(self.burst),
+                               self._tokens + elapsed * self.rate)
+
+        self._lastRefill = now
+
+    def _nextWaiter(self):
+        for priority in PRIORITIES:
+            if self._queues[priority]:
+                return self._queues[priority].popleft()
+
+        return None
+
+    def _drain(self):
+        self._timeoutId = None
+        self._refill()
+
+        while self.getQueueDepth() and (self.rate is None or
+                                        self._tokens >= 1):
+            if self.rate is not None:
+                self._tokens -= 1
+
+            self._stats['acquired'] += 1
+            self._nextWaiter().callback(None)
+
+        self._schedule()
+
+    def _schedule(self):
+        if not self.getQueueDepth() or not self.rate:
+            return
+
+        delay = max(0, (1 - self._tokens) / self.rate)
+
+        if self._timeoutId is not None and self._timeoutId.active():
+            self._timeoutId.reset(delay)
+        else:
+            self._timeoutId = self._clock.callLater(delay, self._drain)
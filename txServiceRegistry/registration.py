@@ -0,0 +1,383 @@
+# Copyright 2012 Rackspace Hosting, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import random
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, DeferredSemaphore
+from twisted.python import log
+from twisted.python.failure import Failure
+
+from bulk import DEFAULT_MAX_PARALLEL
+from catalog import SERVICE_TIMEOUT, SERVICE_REMOVE
+from events import EventsTailer
+
+SERVICE_EXISTS_ERROR = 'serviceWithThisIdExists'
+
+DEFAULT_INITIAL_DELAY = 1
+DEFAULT_MAX_DELAY = 8
+DEFAULT_MULTIPLIER = 2
+DEFAULT_JITTER = 0.5
+# Services time out after at most 30 seconds without a heartbeat, so an old
+# instance is gone by then.
+DEFAULT_RETRY_TIMEOUT = 30
+DEFAULT_EVENTS_POLL_INTERVAL = 1
+
+
+def isServiceExistsError(result):
+    """
+    Return True if the result of ServicesClient.create() says a service with
+    the same ID still exists.
+    """
+    return isinstance(result, dict) and \
+        result.get('type') == SERVICE_EXISTS_ERROR
+
+
+class RegistrationError(Exception):
+    """
+    The service couldn't be registered. The error response is available as
+    the response attribute.
+    """
+    def __init__(self, response):
+        Exception.__init__(self, response.get('message') or
+                           response.get('type'))
+        self.response = response
+
+
+class RetryStrategy(object):
+    """
+    Exponential backoff with jitter, bounded by a deadline.
+
+    The n-th retry (counting from 0) waits
+    min(maxDelay, initialDelay * multiplier ** n) seconds, shortened by up
+    to the jitter fraction so that clients started together don't retry in
+    lock step. No retry is scheduled past timeout seconds after the first
+    attempt, and the last one happens right at the deadline.
+    """
+    def __init__(self, initialDelay=DEFAULT_INITIAL_DELAY,
+                 maxDelay=DEFAULT_MAX_DELAY, multiplier=DEFAULT_MULTIPLIER,
+                 jitter=DEFAULT_JITTER, timeout=DEFAULT_RETRY_TIMEOUT,
+                 random=random.random):
+        """
+        @param initialDelay: Number of seconds before the first retry.
+        @type initialDelay: C{float}
+        @param maxDelay: Maximum number of seconds between two attempts.
+        @type maxDelay: C{float}
+        @param multiplier: Factor the delay grows by after every retry. Use 1
+        for a fixed delay.
+        @type multiplier: C{float}
+        @param jitter: Fraction of the delay which is randomly taken off,
+        between 0 and 1.
+        @type jitter: C{float}
+        @param timeout: Number of seconds after the first attempt after
+        which there are no more retries.
+        @type timeout: C{float}
+        @param random: Function returning a random float in [0, 1).
+        """
+        self.initialDelay = initialDelay
+        self.maxDelay = maxDelay
+        self.multiplier = multiplier
+        self.jitter = jitter
+        self.timeout = timeout
+        self._random = random
+
+    def getDelay(self, retry):
+        """
+        Return the number of seconds to wait before the given retry,
+        ignoring the deadline.
+        """
+        delay = min(self.maxDelay,
+                    self.initialDelay * (self.multiplier ** retry))
+
+        if self.jitter:
+            delay *= 1 - self.jitter * self._random()
+
+        return delay
+
+    def getNextDelay(self, retry, elapsed):
+        """
+        Return the number of seconds to wait before the given retry, or None
+        if the deadline has passed.
+
+        @param retry: Number of retries made so far.
+        @type retry: C{int}
+        @param elapsed: Number of seconds since the first attempt.
+        @type elapsed: C{float}
+        """
+        remaining = self.timeout - elapsed
+
+        if remaining <= 0:
+            return None
+
+        return min(self.getDelay(retry), remaining)
+
+
+class ServiceRegistration(object):
+    """
+    Registers a single service, retrying while a service with the same ID
+    still exists.
+
+    Retries follow a L{RetryStrategy}. If an events client is given, the
+    events feed is also watched for the service.timeout or service.remove
+    event of the old instance, and the service is registered again as soon
+    as it arrives instead of waiting for the next retry.
+    """
+    def __init__(self, servicesClient, serviceId, heartbeatTimeout,
+                 payload=None, retryStrategy=None, eventsClient=None,
+                 pollInterval=DEFAULT_EVENTS_POLL_INTERVAL, clock=None):
+        """
+        @param servicesClient: Client used to create the service.
+        @type servicesClient: L{ServicesClient}
+        @param serviceId: ID of the service.
+        @type serviceId: C{str}
+        @param heartbeatTimeout: Heartbeat timeout of the service.
+        @type heartbeatTimeout: C{int}
+        @param payload: Optional payload of the service.
+        @type payload: C{dict}
+        @param retryStrategy: Strategy used to schedule retries, defaults to
+        a L{RetryStrategy} with the default parameters.
+        @type retryStrategy: L{RetryStrategy}
+        @param eventsClient: Optional client used to watch the events feed
+        for the removal of the old service.
+        @type eventsClient: L{EventsClient}
+        @param pollInterval: Number of seconds between two polls of the
+        events feed.
+        @type pollInterval: C{float}
+        @param clock: Provider of IReactorTime, defaults to the reactor.
+        """
+        self.servicesClient = servicesClient
+        self.serviceId = serviceId
+        self.heartbeatTimeout = heartbeatTimeout
+        self.payload = payload
+        self.retryStrategy = retryStrategy or RetryStrategy()
+        self.eventsClient = eventsClient
+        self.pollInterval = pollInterval
+        self.attempts = 0
+        self.earlyWakes = 0
+        self._clock = clock or reactor
+        self._started = None
+        self._retryId = None
+        self._tailer = None
+        self._finished = None
+
+    def run(self):
+        """
+        Register the service.
+
+        @return: A Deferred which fires with the (response, L{HeartBeater})
+        tuple returned by create(), or fails with L{RegistrationError}.
+        @rtype: L{Deferred}
+        """
+        self._started = self._clock.seconds()
+        self._finished = Deferred()
+        self._attempt()
+
+        return self._finished
+
+    def _attempt(self):
+        self._retryId = None
+        self.attempts += 1
+        d = self.servicesClient.create(self.serviceId, self.heartbeatTimeout,
+                                       self.payload)
+        d.addCallbacks(self._cbCreate, self._finish)
+
+    def _cbCreate(self, result):
+        if isServiceExistsError(result):
+            elapsed = self._clock.seconds() - self._started
+            delay = self.retryStrategy.getNextDelay(self.attempts - 1,
+                                                    elapsed)
+
+            if delay is not None:
+                self._retryId = self._clock.callLater(delay, self._attempt)
+                self._watchEvents()
+                return
+
+        if isinstance(result, dict):
+            self._finish(RegistrationError(result))
+        else:
+            self._finish(result)
+
+    def _finish(self, result):
+        if self._tailer is not None:
+            self._tailer.stop()
+            self._tailer = None
+
+        if isinstance(result, (Exception, Failure)):
+            self._finished.errback(result)
+        else:
+            self._finished.callback(result)
+
+    def _watchEvents(self):
+        if self.eventsClient is None or self._tailer is not None:
+            return
+
+        self._tailer = tailer = EventsTailer(self.eventsClient,
+                                             self._handleEvent,
+                                             interval=self.pollInterval,
+                                             clock=self._clock)
+
+        def cbSeek(_):
+            # The tailer is dropped once the registration has finished.
+            if self._tailer is tailer:
+                tailer.start()
+
+        d = tailer.seekToEnd()
+        d.addCallback(cbSeek)
+        d.addErrback(log.err, 'Watching the events feed failed')
+
+    def _handleEvent(self, event):
+        if event.get('type') not in (SERVICE_TIMEOUT, SERVICE_REMOVE):
+            return
+
+        if (event.get('payload') or {}).get('id') != self.serviceId:
+            return
+
+        if self._retryId is not None and self._retryId.active():
+            self._retryId.cancel()
+            self.earlyWakes += 1
+            self._attempt()
+
+
+class BulkRegistration(object):
+    """
+    Registers many services at once.
+
+    At most maxParallel services are created at the same time. Services
+    which can't be created yet because a service with the same ID still
+    exists (e.g. the previous instance hasn't timed out) are retried
+    together from a single timer until the timeout has passed.
+    """
+    def __init__(self, servicesClient, services, timeout, retryDelay,
+                 maxParallel=DEFAULT_MAX_PARALLEL, clock=None):
+        """
+        @param servicesClient: Client used to create the services.
+        @type servicesClient: L{ServicesClient}
+        @param services: (serviceId, heartbeatTimeout) or (serviceId,
+        heartbeatTimeout, payload) tuples.
+        @type services: C{list}
+        @param timeout: Number of seconds after which services which still
+        exist aren't retried anymore.
+        @type timeout: C{int}
+        @param retryDelay: Number of seconds between retries, or None to not
+        retry.
+        @type retryDelay: C{int}
+        @param maxParallel: Maximum number of concurrent create requests.
+        @type maxParallel: C{int}
+        @param clock: Provider of IReactorTime, defaults to the reactor.
+        """
+        self.servicesClient = servicesClient
+        self.timeout = timeout
+        self.retryDelay = retryDelay
+        self.results = {}
+        self._clock = clock or reactor
+        self._semaphore = DeferredSemaphore(maxParallel)
+        self._services = []
+        self._arguments = {}
+        self._pending = []
+        self._inFlight = 0
+        self._retryId = None
+        self._deadline = None
+        self._starting = False
+        self._finished = Deferred()
+        self._stats = {'requests': 0,
+                       'retries': 0}
+
+        for service in services:
+            serviceId, heartbeatTimeout = service[:2]
+            payload = service[2] if len(service) > 2 else None
+
+            if serviceId not in self._arguments:
+                self._services.append(serviceId)
+
+            self._arguments[serviceId] = (heartbeatTimeout, payload)
+
+    def run(self):
+        """
+        Register all the services.
+
+        @return: A Deferred which fires with a dict mapping every service ID
+        to a (success, result) tuple. On success, the result is the
+        (response, L{HeartBeater}) tuple returned by create(). Otherwise it
+        is the error response or the L{Failure}.
+        @rtype: L{Deferred}
+        """
+        self._deadline = self._clock.seconds() + self.timeout
+        self._starting = True
+
+        for serviceId in self._services:
+            self._create(serviceId)
+
+        self._starting = False
+        self._checkFinished()
+
+        return self._finished
+
+    def getStats(self):
+        stats = dict(self._stats)
+        stats['pending'] = len(self._pending)
+        stats['inFlight'] = self._inFlight
+        stats['done'] = len(self.results)
+
+        return stats
+
+    def _create(self, serviceId):
+        heartbeatTimeout, payload = self._arguments[serviceId]
+        self._inFlight += 1
+        self._stats['requests'] += 1
+        d = self._semaphore.run(self.servicesClient.create, serviceId,
+                                heartbeatTimeout, payload)
+        d.addCallbacks(self._cbCreate, self._ebCreate,
+                       callbackArgs=(serviceId,), errbackArgs=(serviceId,))
+        d.addCallback(self._cbAttemptFinished)
+
+    def _cbCreate(self, result, serviceId):
+        if isServiceExistsError(result):
+            if self.retryDelay is not None and \
+                    self._clock.seconds() + self.retryDelay <= self._deadline:
+                self._pending.append(serviceId)
+                self._scheduleRetry()
+            else:
+                self.results[serviceId] = (False, result)
+        elif isinstance(result, dict):
+            # Any other error response
+            self.results[serviceId] = (False, result)
+        else:
+            self.results[serviceId] = (True, result)
+
+    def _ebCreate(self, failure, serviceId):
+        self.results[serviceId] = (False, failure)
+
+    def _cbAttemptFinished(self, _):
+        self._inFlight -= 1
+        self._checkFinished()
+
+    def _scheduleRetry(self):
+        if self._retryId is None:
+            self._retryId = self._clock.callLater(self.retryDelay,
+                                                  self._retryPending)
+
+    def _retryPending(self):
+        self._retryId = None
+        pending, self._pending = self._pending, []
+        self._stats['retries'] += len(pending)
+
+        for serviceId in pending:
+            self._create(serviceId)
+
+    def _checkFinished(self):
+        if self._starting or self._inFlight or self._pending or \
+                self._finished.called:
+            return
+
+        self._finished.callback(self.results)
@@ -0,0 +1,259 @@
+# Copyright 2012 Rackspace Hosting, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import random
+
+from twisted.internet.defer import fail, maybeDeferred
+
+
+class NoEndpointsError(Exception):
+    pass
+
+
+class Endpoint(object):
+    """
+    An instance of a service which can be connected to, built from the ip
+    and port in its metadata.
+    """
+    __slots__ = ('serviceId', 'host', 'port', 'region', 'outstanding',
+                 'requests')
+
+    def __init__(self, serviceId, host, port, region=None):
+        self.serviceId = serviceId
+        self.host = host
+        self.port = port
+        self.region = region
+        self.outstanding = 0
+        self.requests = 0
+
+    def __repr__(self):
+        return '<Endpoint %s %s:%s>' % (self.serviceId, self.host, self.port)
+
+
+def getEndpoint(service):
+    """
+    Return the L{Endpoint} of a service, or None if its metadata doesn't
+    contain a valid ip and port.
+    """
+    metadata = service.get('metadata') or {}
+    host = metadata.get('ip')
+
+    try:
+        port = int(metadata.get('port'))
+    except (TypeError, ValueError):
+        return None
+
+    if not host:
+        return None
+
+    return Endpoint(service['id'], host, port, metadata.get('region'))
+
+
+class RoundRobinStrategy(object):
+    """
+    Picks the endpoints one after the other.
+    """
+    def __init__(self):
+        self._next = 0
+
+    def choose(self, endpoints):
+        endpoint = endpoints[self._next % len(endpoints)]
+        self._next += 1
+
+        return endpoint
+
+
+class LeastOutstandingStrategy(object):
+    """
+    Picks the endpoint with the fewest requests in flight. Ties go to the
+    endpoint which has been picked the least.
+    """
+    def choose(self, endpoints):
+        best = endpoints[0]
+
+        for endpoint in endpoints:
+            if (endpoint.outstanding, endpoint.requests) < \
+                    (best.outstanding, best.requests):
+                best = endpoint
+
+        return best
+
+
+class PowerOfTwoChoicesStrategy(object):
+    """
+    Picks two endpoints at random and takes the one with fewer requests in
+    flight. This spreads load almost as well as least outstanding without
+    every client piling onto the same endpoint.
+    """
+    def __init__(self, random=random.random):
+        """
+        @param random: Function returning a random float in [0, 1).
+        """
+        self._random = random
+
+    def choose(self, endpoints):
+        count = len(endpoints)
+
+        if count == 1:
+            return endpoints[0]
+
+        first = int(self._random() * count)
+        # Pick the second one among the others so they're always different.
+        second = (first + 1 + int(self._random() * (count - 1))) % count
+        first, second = endpoints[first], endpoints[second]
+
+        if second.outstanding < first.outstanding:
+            return second
+
+        return first
+
+
+class Resolver(object):
+    """
+    Resolves a tag to the endpoints of the services which have it and picks
+    one of them for every request.
+
+    The endpoints come from a L{ServiceCatalog}, so resolving doesn't make
+    any request. They're only rebuilt when the catalog has changed. If a
+    region is given, endpoints whose metadata.region matches it are
+    preferred, and the others are only used when there's none.
+    """
+    def __init__(self, catalog, tag, strategy=None, region=None):
+        """
+        @param catalog: Started catalog of the services.
+        @type catalog: L{ServiceCatalog}
+        @param tag: Tag of the services.
+        @type tag: C{str}
+        @param strategy: Load balancing strategy, such as
+        L{RoundRobinStrategy} (the default), L{LeastOutstandingStrategy} or
+        L{PowerOfTwoChoicesStrategy}. Any object with a choose(endpoints)
+        method works.
+        @param region: Optional preferred region.
+        @type region: C{str}
+        """
+        self.catalog = catalog
+        self.tag = tag
+        self.strategy = strategy or RoundRobinStrategy()
+        self.region = region
+        self._version = None
+        self._endpoints = {}
+        self._candidates = []
+
+    def getEndpoints(self):
+        """
+        Return the endpoints requests are currently spread across.
+
+        @rtype: C{list}
+        """
+        if self._version != self.catalog.version:
+            self._update()
+
+        return self._candidates
+
+    def resolve(self):
+        """
+        Pick an endpoint.
+
+        @rtype: L{Endpoint}
+        @raise NoEndpointsError: If no service with the tag has an endpoint.
+        """
+        candidates = self.getEndpoints()
+
+        if not candidates:
+            raise NoEndpointsError('No endpoints for tag %s' % (self.tag))
+
+        endpoint = self.strategy.choose(candidates)
+        endpoint.requests += 1
+
+        return endpoint
+
+    def acquire(self):
+        """
+        Pick an endpoint and count a request in flight to it until
+        release() is called with it.
+
+        @rtype: L{Endpoint}
+        """
+        endpoint = self.resolve()
+        endpoint.outstanding += 1
+
+        return endpoint
+
+    def release(self, endpoint):
+        endpoint.outstanding -= 1
+
+    def run(self, function, *args, **kwargs):
+        """
+        Call function(endpoint, *args, **kwargs) with an endpoint which
+        counts as busy until the Deferred it returns fires. The Deferred
+        fails with L{NoEndpointsError} if there's no endpoint.
+
+        @rtype: L{Deferred}
+        """
+        def release(result):
+            self.release(endpoint)
+
+            return result
+
+        try:
+            endpoint = self.acquire()
+        except NoEndpointsError:
+            return fail()
+
+        d = maybeDeferred(function, endpoint, *args, **kwargs)
+        d.addBoth(release)
+
+        return d
+
+    def getStats(self):
+        """
+        Return the number of requests made to and in flight to every
+        endpoint, by service ID.
+
+        @rtype: C{dict}
+        """
+        stats = {}
+
+        for serviceId, endpoint in self._endpoints.iteritems():
+            stats[serviceId] = {'requests': endpoint.requests,
+                                'outstanding': endpoint.outstanding}
+
+        return stats
+
+    def _update(self):
+        endpoints = {}
+
+        for service in self.catalog.listForTag(self.tag):
+            endpoint = getEndpoint(service)
+
+            if endpoint is None:
+                continue
+
+            # Keep the counters of endpoints which haven't changed.
+            old = self._endpoints.get(endpoint.serviceId)
+
+            if old is not None and (old.host, old.port, old.region) == \
+                    (endpoint.host, endpoint.port, endpoint.region):
+                endpoint = old
+
+            endpoints[endpoint.serviceId] = endpoint
+
+        ordered = [endpoints[serviceId] for serviceId in sorted(endpoints)]
+        local = [endpoint for endpoint in ordered
+                 if self.region is not None and
+                 endpoint.region == self.region]
+
+        self._endpoints = endpoints
+        self._candidates = local or ordered
+        self._version = self.catalog.version
@@ -0,0 +1,108 @@
+# Copyright 2012 Rackspace Hosting, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import re
+try:
+    import simplejson as json
+except:
+    import json
+
+# Strings made of these characters are encoded as they are, so they can be
+# put between quotes without going through the encoder. Heartbeat tokens are
+# UUIDs.
+PLAIN_STRING = re.compile(r'^[A-Za-z0-9_.:-]*$')
+
+
+class JSONCodec(object):
+    """
+    Encodes request bodies and decodes response bodies.
+
+    Any pair of functions compatible with json.dumps and json.loads can be
+    plugged in, e.g. from a faster JSON library.
+    """
+    def __init__(self, dumps=json.dumps, loads=json.loads):
+        """
+        @param dumps: Function which encodes an object to a JSON string.
+        @type dumps: C{callable}
+        @param loads: Function which decodes a JSON string.
+        @type loads: C{callable}
+        """
+        self.encode = dumps
+        self.decode = loads
+
+    def encodeString(self, value):
+        """
+        Encode a single string, skipping the encoder for plain strings.
+        """
+        if isinstance(value, basestring) and PLAIN_STRING.match(value):
+            # Only ASCII characters match, so this can't fail.
+            return '"%s"' % (str(value))
+
+        return self.encode(value)
+
+
+DEFAULT_CODEC = JSONCodec()
+
+
+class EncodedBody(object):
+    """
+    A request body which is already encoded and is sent as it is.
+    """
+    __slots__ = ('data',)
+
+    def __init__(self, data):
+        """
+        @param data: The encoded body.
+        @type data: C{str}
+        """
+        self.data = data
+
+
+class HeartbeatTemplate(object):
+    """
+    The pre-rendered heartbeat request of a service.
+
+    The path and the body around the token are built once, so sending a
+    heartbeat only substitutes the token instead of building the path and a
+    payload dict and encoding it every time.
+    """
+    __slots__ = ('path', 'codec')
+
+    def __init__(self, path, codec=DEFAULT_CODEC):
+        """
+        @param path: Path of the heartbeat endpoint of the service.
+        @type path: C{str}
+        @param codec: Codec used to encode tokens which aren't plain
+        strings.
+        @type codec: L{JSONCodec}
+        """
+        self.path = path
+        self.codec = codec
+
+    def render(self, token):
+        """
+        Return the encoded body of a heartbeat with the given token.
+
+        @rtype: C{str}
+        """
+        return '{"token": %s}' % (self.codec.encodeString(token))
+
+    def renderBody(self, token):
+        """
+        Return the body of a heartbeat with the given token, ready to be
+        passed as the payload of a request.
+
+        @rtype: L{EncodedBody}
+        """
+        return EncodedBody(self.render(token))
@@ -21,32 +21,11 @@ import re
 
 from optparse import OptionParser
 
+from mock_routes import HTTP_GET_PATHS, HTTP_POST_PATHS
+
 mock_action = None
 signature = None
 
-HTTP_GET_PATHS = {
-    '/limits': {'fixture_path': 'limits-get.json'},
-    '/events': {'fixture_path': 'events-get.json'},
-    '/configuration': {'fixture_path': 'configuration-get.json'},
-    '/configuration/configId':
-    {'fixture_path': 'configuration-configId-get.json'},
-    '/configuration/api/':
-    {'fixture_path': 'configuration-api-get.json'},
-    '/services': {'fixture_path': 'services-get.json'},
-    '/services/dfw1-db1':
-    {'fixture_path': 'services-dfw1-db1-get.json'},
-    '/services?tag=db': {'fixture_path': 'services-tag-db-get.json'},
-}
-
-HTTP_POST_PATHS = {
-    '/services':
-    {'fixture_path': 'services-post.json',
-     'headers': {'Location': '127.0.0.1/v1.0/7777/services/dfw1-db1'}},
-    '/services/dfw1-db1/heartbeat':
-    {'fixture_path': 'services-dfw1-db1-heartbeat-post.json',
-     'status_code': 200}
-}
-
 usage = 'usage: %prog --port=<port> --fixtures-dir=<fixtures directory>'
 parser = OptionParser(usage=usage)
 parser.add_option("--port", dest='port', default=8881,
@@ -80,6 +59,10 @@ class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
                              headers=headers,
                              body=body)
 
+        body = self._read_fixture('services-not-found-get.json')
+
+        return self._end(status_code=404, body=body)
+
     def do_GET(self):
         return self._setup_response(HTTP_GET_PATHS, 200)
 
@@ -92,6 +75,8 @@ class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
                 {'Location': '127.0.0.1/v1.0/7777/services/dfw1-db1'}
             return self._end(status_code=204, headers=headers)
 
+        return self._end(status_code=204)
+
     def do_DELETE(self):
         return self._end(status_code=204)
 
@@ -0,0 +1,44 @@
+# Copyright 2012 Rackspace Hosting, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Routes served by the mock API servers, relative to the tenant ID. Each
+# route maps to a fixture in fixtures/response/ and optionally a status code
+# and extra headers.
+
+HTTP_GET_PATHS = {
+    '/limits': {'fixture_path': 'limits-get.json'},
+    '/events': {'fixture_path': 'events-get.json'},
+    '/configuration': {'fixture_path': 'configuration-get.json'},
+    '/configuration/configId':
+    {'fixture_path': 'configuration-configId-get.json'},
+    '/configuration/api/':
+    {'fixture_path': 'configuration-api-get.json'},
+    '/services': {'fixture_path': 'services-get.json'},
+    '/services/dfw1-db1':
+    {'fixture_path': 'services-dfw1-db1-get.json'},
+    '/services?tag=db': {'fixture_path': 'services-tag-db-get.json'},
+    '/services?limit=1':
+    {'fixture_path': 'services-get-limit-1-page-1.json'},
+    '/services?marker=dfw1-db1&limit=1':
+    {'fixture_path': 'services-get-with-marker-page-2.json'},
+}
+
+HTTP_POST_PATHS = {
+    '/services':
+    {'fixture_path': 'services-post.json',
+     'headers': {'Location': '127.0.0.1/v1.0/7777/services/dfw1-db1'}},
+    '/services/dfw1-db1/heartbeat':
+    {'fixture_path': 'services-dfw1-db1-heartbeat-post.json',
+     'status_code': 200}
+}
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+
+# Copyright 2012 Rackspace Hosting, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+A Twisted based mock API server which serves the same fixtures as
+mock_http_server.py, but keeps them in memory, supports persistent
+connections and doesn't log every response, so it can be used to measure
+client throughput.
+"""
+
+import os
+
+try:
+    import simplejson as json
+except:
+    import json
+
+from optparse import OptionParser
+
+from twisted.internet import reactor
+from twisted.web.resource import Resource
+from twisted.web.server import Site
+
+from txServiceRegistry.test.mock_routes import HTTP_GET_PATHS, \
+    HTTP_POST_PATHS
+
+FIXTURES_DIR = os.path.join(os.path.dirname(__file__), 'fixtures',
+                            'response')
+NOT_FOUND_FIXTURE = 'services-not-found-get.json'
+HEARTBEAT_FIXTURE = 'services-dfw1-db1-heartbeat-post.json'
+
+
+class MockRegistryResource(Resource):
+    isLeaf = True
+
+    def __init__(self, fixturesDir=FIXTURES_DIR):
+        Resource.__init__(self)
+        self.requestCount = 0
+        self._fixtures = {}
+
+        for name in os.listdir(fixturesDir):
+            if name.endswith('.json'):
+                with open(os.path.join(fixturesDir, name), 'r') as f:
+                    self._fixtures[name] = f.read()
+
+    def _getPath(self, request):
+        # Strip the tenant ID: /<tenantId>/services?tag=db -> /services?tag=db
+        parts = request.uri.split('/', 2)
+
+        return '/' + parts[2] if len(parts) == 3 else '/'
+
+    def _respond(self, request, route, statusCode):
+        self.requestCount += 1
+        request.setResponseCode(route.get('status_code', statusCode))
+        request.setHeader('Content-Type', 'application/json')
+
+        for key, value in route.get('headers', {}).iteritems():
+            request.setHeader(key, value)
+
+        fixturePath = route.get('fixture_path')
+
+        return self._fixtures[fixturePath] if fixturePath else ''
+
+    def render_GET(self, request):
+        route = HTTP_GET_PATHS.get(self._getPath(request))
+
+        if route is None:
+            return self._respond(request, {'fixture_path': NOT_FOUND_FIXTURE},
+                                 404)
+
+        return self._respond(request, route, 200)
+
+    def render_POST(self, request):
+        path = self._getPath(request)
+
+        if path == '/services':
+            serviceId = json.loads(request.content.read())['id']
+            location = '127.0.0.1/v1.0/7777/services/%s' % \
+                (serviceId.encode('utf-8'))
+            route = dict(HTTP_POST_PATHS['/services'])
+            route['headers'] = {'Location': location}
+
+            return self._respond(request, route, 201)
+
+        if path.startswith('/services/') and path.endswith('/heartbeat'):
+            return self._respond(request, {'fixture_path': HEARTBEAT_FIXTURE},
+                                 200)
+
+        return self._respond(request, {'fixture_path': NOT_FOUND_FIXTURE},
+                             404)
+
+    def render_PUT(self, request):
+        return self._respond(request, {}, 204)
+
+    def render_DELETE(self, request):
+        return self._respond(request, {}, 204)
+
+
+class QuietSite(Site):
+    """
+    A Site which doesn't log requests.
+    """
+    def log(self, request):
+        pass
+
+
+def listen(port=0, interface='127.0.0.1', fixturesDir=FIXTURES_DIR):
+    """
+    Start serving the fixtures.
+
+    @return: The listening port.
+    @rtype: L{IListeningPort}
+    """
+    resource = MockRegistryResource(fixturesDir)
+
+    return reactor.listenTCP(port, QuietSite(resource),
+                             interface=interface)
+
+
+def main():
+    usage = 'usage: %prog --port=<port> --fixtures-dir=<fixtures directory>'
+    parser = OptionParser(usage=usage)
+    parser.add_option('--port', dest='port', default=8881, type='int',
+                      help='Port to listen on', metavar='PORT')
+    parser.add_option('--fixtures-dir', dest='fixtures_dir',
+                      default=FIXTURES_DIR,
+                      help='The folder in which JSON fixtures live')
+    (options, args) = parser.parse_args()
+
+    listen(options.port, fixturesDir=options.fixtures_dir)
+    print 'Mock API server listening on 127.0.0.1:%s' % (options.port)
+    reactor.run()
+
+
+if __name__ == '__main__':
+    main()
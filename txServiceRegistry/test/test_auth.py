@@ -0,0 +1,235 @@
+# Copyright 2012 Rackspace Hosting, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+
+try:
+    import simplejson as json
+except:
+    import json
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, succeed
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+from twisted.web.client import Agent
+
+from txKeystone.keystone import KeystoneAuthenticationError
+
+from txServiceRegistry.auth import RefreshingKeystoneAgent, parseExpires
+from txServiceRegistry.client import Client
+
+AUTH_URL = 'https://identity.api.rackspacecloud.com/v2.0/tokens/'
+
+
+def getAuthBody(token, expires):
+    expires = time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime(expires))
+
+    return json.dumps({'access': {'token': {'id': token,
+                                            'expires': expires,
+                                            'tenant': {'id': '7777'}}}})
+
+
+class FakeResponse(object):
+    def __init__(self, code, body=''):
+        self.code = code
+        self.body = body
+
+    def deliverBody(self, protocol):
+        protocol.dataReceived(self.body)
+        protocol.connectionLost(None)
+
+
+class FakeAgent(object):
+    def __init__(self):
+        self.requests = []
+
+    def request(self, method, uri, headers=None, bodyProducer=None):
+        d = Deferred()
+        self.requests.append((method, uri, d))
+
+        return d
+
+    def respond(self, response):
+        self.requests.pop(0)[2].callback(response)
+
+
+class ParseExpiresTests(TestCase):
+    def test_parseExpires(self):
+        self.assertEqual(parseExpires('2012-09-14T18:54:55.000Z'),
+                         1347648895)
+        self.assertEqual(parseExpires('2012-09-14T18:54:55'), 1347648895)
+        self.assertEqual(parseExpires('2012-09-14T13:54:55.000-05:00'),
+                         1347648895)
+        self.assertEqual(parseExpires('2012-09-14T20:54:55+0200'),
+                         1347648895)
+        self.assertEqual(parseExpires('tomorrow'), None)
+        self.assertEqual(parseExpires(None), None)
+
+
+class RefreshingKeystoneAgentTests(TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.clock.advance(1000000)
+        self.fakeAgent = FakeAgent()
+        self.agent = RefreshingKeystoneAgent(self.fakeAgent, AUTH_URL,
+                                             ('user', 'key'),
+                                             refreshMargin=300,
+                                             clock=self.clock)
+        self.addCleanup(self.agent.stopRefreshing)
+
+    def _authenticate(self, token='first', lifetime=3600):
+        body = getAuthBody(token, self.clock.seconds() + lifetime)
+        self.fakeAgent.respond(FakeResponse(200, body))
+
+    def test_concurrent_requests_share_authentication(self):
+        results = []
+
+        for i in range(3):
+            self.agent.getAuthHeaders().addCallback(results.append)
+
+        self.assertEqual(len(self.fakeAgent.requests), 1)
+        self._authenticate()
+        self.assertEqual(len(results), 3)
+        self.assertEqual(results[0], {'X-Auth-Token': 'first',
+                                      'X-Tenant-Id': '7777'})
+        self.assertEqual(self.agent.getStats()['authentications'], 1)
+
+    def test_token_is_refreshed_before_it_expires(self):
+        self.agent.getAuthHeaders()
+        self._authenticate(lifetime=3600)
+
+        self.clock.advance(3299)
+        self.assertEqual(self.fakeAgent.requests, [])
+        self.clock.advance(1)
+        self.assertEqual(len(self.fakeAgent.requests), 1)
+
+        # Requests made during the refresh use the current token.
+        results = []
+        self.agent.getAuthHeaders().addCallback(results.append)
+        self.assertEqual(results[0]['X-Auth-Token'], 'first')
+
+        self._authenticate('second')
+        self.agent.getAuthHeaders().addCallback(results.append)
+        self.assertEqual(results[1]['X-Auth-Token'], 'second')
+        self.assertEqual(self.agent.getStats()['refreshes'], 1)
+
+    def test_failed_refresh_keeps_token_and_retries(self):
+        self.agent.getAuthHeaders()
+        self._authenticate(lifetime=3600)
+        self.clock.advance(3300)
+        self.fakeAgent.respond(FakeResponse(500))
+        self.assertEqual(
+            len(self.flushLoggedErrors(KeystoneAuthenticationError)), 1)
+        self.assertTrue(self.agent.hasValidToken())
+
+        self.clock.advance(30)
+        self.assertEqual(len(self.fakeAgent.requests), 1)
+
+    def test_expired_token_is_not_used(self):
+        self.agent.getAuthHeaders()
+        self._authenticate(lifetime=3600)
+        self.agent.stopRefreshing()
+        self.clock.advance(3600)
+
+        results = []
+        self.agent.getAuthHeaders().addCallback(results.append)
+        self.assertEqual(results, [])
+        self._authenticate('second')
+        self.assertEqual(results[0]['X-Auth-Token'], 'second')
+
+    def test_short_lived_token_is_refreshed_half_way(self):
+        self.agent.getAuthHeaders()
+        self._authenticate(lifetime=100)
+        self.clock.advance(49)
+        self.assertEqual(self.fakeAgent.requests, [])
+        self.clock.advance(1)
+        self.assertEqual(len(self.fakeAgent.requests), 1)
+
+    def test_rejected_credentials_fail_waiters(self):
+        d = self.agent.getAuthHeaders()
+        self.fakeAgent.respond(FakeResponse(401))
+        self.assertFailure(d, KeystoneAuthenticationError)
+        self.assertFalse(self.agent.hasValidToken())
+
+        return d
+
+    def test_invalidateToken(self):
+        self.agent.getAuthHeaders()
+        self._authenticate()
+        self.agent.invalidateToken()
+        self.assertFalse(self.agent.hasValidToken())
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+        self.agent.getAuthHeaders()
+        self.assertEqual(len(self.fakeAgent.requests), 1)
+
+    def test_replaced_token_is_not_invalidated(self):
+        self.agent.getAuthHeaders()
+        self._authenticate('second')
+        self.agent.invalidateToken('first')
+        self.assertTrue(self.agent.hasValidToken())
+
+        self.agent.invalidateToken('second')
+        self.assertFalse(self.agent.hasValidToken())
+
+
+class ClientAuthTests(TestCase):
+    def setUp(self):
+        self.client = Client('user', 'api_key', 'us',
+                             'http://127.0.0.1:8881/', Agent(reactor))
+        self.client.agent._getAuthHeaders = \
+            lambda: succeed({'X-Auth-Token': 'authToken',
+                             'X-Tenant-Id': 'tenantId'})
+
+    def test_401_is_retried_with_the_original_payload(self):
+        request = self.client.agent.request
+        bodies = []
+
+        def fakeRequest(method, uri, headers, bodyProducer):
+            bodies.append(bodyProducer.body)
+
+            if len(bodies) == 1:
+                return succeed(FakeResponse(401))
+
+            return request(method, uri, headers, bodyProducer)
+
+        def cbHeartbeat(result):
+            self.assertTrue('token' in result)
+            self.assertEqual(bodies, ['{"token": "token"}'] * 2)
+
+        self.client.agent.request = fakeRequest
+        d = self.client.services.heartbeat('dfw1-db1', 'token')
+        d.addCallback(cbHeartbeat)
+
+        return d
+
+    def test_401_invalidates_the_rejected_token(self):
+        tokens = []
+        self.client.agent.invalidateToken = tokens.append
+        responses = [FakeResponse(401), FakeResponse(204)]
+        self.client.agent.request = \
+            lambda *args, **kwargs: succeed(responses.pop(0))
+        d = self.client.services.heartbeat('dfw1-db1', 'token')
+        d.addCallback(lambda _: self.assertEqual(tokens, ['authToken']))
+
+        return d
+
+    def test_tenant_url_is_cached(self):
+        services = self.client.services
+        url = services._getTenantUrl('tenantId')
+        self.assertEqual(url, 'http://127.0.0.1:8881/tenantId')
+        self.assertTrue(services._getTenantUrl('tenantId') is url)
+        self.assertEqual(services._getTenantUrl('other'),
+                         'http://127.0.0.1:8881/other')
@@ -0,0 +1,134 @@
+# Copyright 2012 Rackspace Hosting, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, succeed
+from twisted.trial.unittest import TestCase
+from twisted.web.client import Agent
+
+from txServiceRegistry.bulk import isErrorResponse, runMany
+from txServiceRegistry.client import Client
+
+NOT_FOUND = {'type': 'notFoundError', 'code': 404,
+             'message': 'Object "Configuration" with key "missing" does not '
+                        'exist'}
+
+
+class RunManyTests(TestCase):
+    def setUp(self):
+        self.calls = []
+        self.results = []
+
+    def _function(self, key):
+        d = Deferred()
+        self.calls.append((key, d))
+
+        return d
+
+    def test_isErrorResponse(self):
+        self.assertTrue(isErrorResponse(NOT_FOUND))
+        self.assertFalse(isErrorResponse({'id': 'configId', 'value': 'v'}))
+        self.assertFalse(isErrorResponse(True))
+
+    def test_parallelism_is_bounded(self):
+        runMany(self._function, ['a', 'b', 'c'],
+                maxParallel=2).addCallback(self.results.append)
+        self.assertEqual([key for key, d in self.calls], ['a', 'b'])
+
+        self.calls[0][1].callback({'id': 'a'})
+        self.assertEqual([key for key, d in self.calls], ['a', 'b', 'c'])
+
+        self.calls[1][1].callback(NOT_FOUND)
+        self.calls[2][1].errback(ValueError('boom'))
+
+        results = self.results[0]
+        self.assertEqual(results['a'], (True, {'id': 'a'}))
+        self.assertEqual(results['b'], (False, NOT_FOUND))
+        self.assertFalse(results['c'][0])
+        self.assertTrue(results['c'][1].check(ValueError))
+
+    def test_empty(self):
+        runMany(self._function, []).addCallback(self.results.append)
+        self.assertEqual(self.results, [{}])
+
+
+class ConfigurationBulkTests(TestCase):
+    def setUp(self):
+        self.client = Client('user', 'api_key', 'us',
+                             'http://127.0.0.1:8881/', Agent(reactor))
+        self.client.agent._getAuthHeaders = \
+            lambda: succeed({'X-Auth-Token': 'authToken',
+                             'X-Tenant-Id': 'tenantId'})
+
+    def test_getMany(self):
+        def cbResults(results):
+            self.assertEqual(results['configId'],
+                             (True, {'id': 'configId',
+                                     'value': 'test value 123456'}))
+            self.assertFalse(results['missing'][0])
+            self.assertEqual(results['missing'][1]['type'], 'notFoundError')
+
+        d = self.client.configuration.getMany(['configId', 'missing'])
+        d.addCallback(cbResults)
+
+        return d
+
+    def test_getMany_with_namespace(self):
+        requested = []
+        get = self.client.configuration.get
+
+        def trackingGet(configurationId):
+            requested.append(configurationId)
+
+            return get(configurationId)
+
+        def cbResults(results):
+            self.assertEqual(results['/api/key-2'],
+                             (True, {'id': '/api/key-2',
+                                     'value': 'test value 23456'}))
+            self.assertTrue(results['configId'][0])
+            # Only the value outside of the namespace was fetched on its own.
+            self.assertEqual(requested, ['configId'])
+
+        self.client.configuration.get = trackingGet
+        d = self.client.configuration.getMany(['/api/key-2', 'configId'],
+                                              namespace='/api/')
+        d.addCallback(cbResults)
+
+        return d
+
+    def test_getNamespace(self):
+        def cbValues(values):
+            self.assertEqual(values, {'/api/key-1': 'test value 123456',
+                                      '/api/key-2': 'test value 23456'})
+
+        d = self.client.configuration.getNamespace('api')
+        d.addCallback(cbValues)
+
+        return d
+
+    def test_setMany_and_removeMany(self):
+        def cbSet(results):
+            self.assertEqual(results, {'a': (True, True), 'b': (True, True)})
+
+            return self.client.configuration.removeMany(['a', 'b'])
+
+        def cbRemoved(results):
+            self.assertEqual(results, {'a': (True, True), 'b': (True, True)})
+
+        d = self.client.configuration.setMany({'a': '1', 'b': '2'})
+        d.addCallback(cbSet)
+        d.addCallback(cbRemoved)
+
+        return d
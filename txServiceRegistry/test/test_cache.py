@@ -0,0 +1,389 @@
+# Copyright 2012 Rackspace Hosting, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import mock
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, fail, gatherResults, succeed
+from twisted.internet.error import ConnectionRefusedError
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+from twisted.web.client import Agent
+
+from txServiceRegistry.cache import ResponseCache, RequestCoalescer, \
+    NOT_CACHED, getParentPaths, isInvalidatingWrite
+from txServiceRegistry.client import Client
+
+
+class ResponseCacheTests(TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.cache = ResponseCache(ttls={'/services': 10,
+                                         '/services/dfw1-db1': 5,
+                                         '/configuration': 30},
+                                   maxSize=3, clock=self.clock)
+
+    def _set(self, path, value, options=None):
+        self.cache.set(self.cache.getKey(path, options), value)
+
+    def _get(self, path, options=None):
+        return self.cache.get(self.cache.getKey(path, options))
+
+    def test_getKey(self):
+        self.assertEqual(self.cache.getKey('/events'), None)
+        self.assertEqual(self.cache.getKey('/servicesfoo'), None)
+        self.assertEqual(self.cache.getKey('/services',
+                                           {'tag': 'db', 'limit': 3}),
+                         ('/services', (('limit', 3), ('tag', 'db'))))
+
+    def test_longest_prefix_ttl_wins(self):
+        self.assertEqual(self.cache.getTTL('/services'), 10)
+        self.assertEqual(self.cache.getTTL('/services/dfw1-api'), 10)
+        self.assertEqual(self.cache.getTTL('/services/dfw1-db1'), 5)
+        self.assertEqual(self.cache.getTTL('/limits'), None)
+
+    def test_values_expire(self):
+        self._set('/services/dfw1-db1', {'id': 'dfw1-db1'})
+        self.assertEqual(self._get('/services/dfw1-db1'), {'id': 'dfw1-db1'})
+        self.clock.advance(5)
+        self.assertTrue(self._get('/services/dfw1-db1') is NOT_CACHED)
+
+        stats = self.cache.getStats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['expirations'], 1)
+        self.assertEqual(stats['size'], 0)
+
+    def test_values_are_copied(self):
+        value = {'values': [1]}
+        self._set('/services', value)
+        value['values'].append(2)
+        self._get('/services')['values'].append(3)
+        self.assertEqual(self._get('/services'), {'values': [1]})
+
+    def test_options_are_part_of_the_key(self):
+        self._set('/services', 'db', {'tag': 'db'})
+        self.assertTrue(self._get('/services') is NOT_CACHED)
+        self.assertEqual(self._get('/services', {'tag': 'db'}), 'db')
+
+    def test_least_recently_used_is_evicted(self):
+        self._set('/configuration/a', 'a')
+        self._set('/configuration/b', 'b')
+        self._set('/configuration/c', 'c')
+        self._get('/configuration/a')
+        self._set('/configuration/d', 'd')
+
+        self.assertEqual(self._get('/configuration/a'), 'a')
+        self.assertTrue(self._get('/configuration/b') is NOT_CACHED)
+        self.assertEqual(self.cache.getStats()['evictions'], 1)
+        self.assertEqual(len(self.cache), 3)
+
+    def test_invalidate_drops_path_and_parents(self):
+        self.cache.maxSize = 10
+        self._set('/services', 'list')
+        self._set('/services', 'db', {'tag': 'db'})
+        self._set('/services/dfw1-db1', 'db1')
+        self._set('/services/dfw1-api', 'api')
+
+        self.cache.invalidate('/services/dfw1-db1')
+        self.assertTrue(self._get('/services') is NOT_CACHED)
+        self.assertTrue(self._get('/services', {'tag': 'db'}) is NOT_CACHED)
+        self.assertTrue(self._get('/services/dfw1-db1') is NOT_CACHED)
+        self.assertEqual(self._get('/services/dfw1-api'), 'api')
+        self.assertEqual(self.cache.getStats()['invalidations'], 3)
+
+    def test_invalidate_namespace_listing(self):
+        self._set('/configuration/api/', 'api')
+        self._set('/configuration/web/', 'web')
+        self.cache.invalidate('/configuration/api/port')
+        self.assertTrue(self._get('/configuration/api/') is NOT_CACHED)
+        self.assertEqual(self._get('/configuration/web/'), 'web')
+
+    def test_getParentPaths(self):
+        self.assertEqual(getParentPaths('/services/dfw1-db1'),
+                         set(['/', '/services', '/services/',
+                              '/services/dfw1-db1']))
+
+    def test_heartbeats_dont_invalidate(self):
+        self.assertFalse(isInvalidatingWrite('GET', '/services'))
+        self.assertFalse(isInvalidatingWrite('POST',
+                                             '/services/dfw1-db1/heartbeat'))
+        self.assertTrue(isInvalidatingWrite('POST', '/services'))
+        self.assertTrue(isInvalidatingWrite('DELETE', '/services/dfw1-db1'))
+
+
+class StaleResponseCacheTests(TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.path = self.mktemp()
+        self.cache = self._createCache()
+        self.key = self.cache.getKey('/services', {'tag': 'db'})
+
+    def _createCache(self):
+        return ResponseCache(ttls={'/services': 10}, clock=self.clock,
+                             maxStaleness=60, snapshotPath=self.path,
+                             snapshotInterval=5)
+
+    def test_expired_values_are_served_stale(self):
+        self.cache.set(self.key, 'db')
+        self.assertEqual(self.cache.lookup(self.key), ('db', False))
+
+        self.clock.advance(10)
+        self.assertEqual(self.cache.lookup(self.key), ('db', True))
+        # get() only returns fresh values.
+        self.assertTrue(self.cache.get(self.key) is NOT_CACHED)
+
+        self.clock.advance(60)
+        self.assertEqual(self.cache.lookup(self.key), (NOT_CACHED, False))
+
+        stats = self.cache.getStats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['staleHits'], 1)
+        self.assertEqual(stats['expirations'], 1)
+        self.assertEqual(stats['size'], 0)
+
+    def test_one_revalidation_at_a_time(self):
+        self.assertTrue(self.cache.startRevalidation(self.key))
+        self.assertFalse(self.cache.startRevalidation(self.key))
+        self.cache.finishRevalidation(self.key)
+        self.assertTrue(self.cache.startRevalidation(self.key))
+
+    def test_snapshot_writes_are_batched(self):
+        self.cache.set(self.key, 'db')
+        self.cache.set(self.cache.getKey('/services'), 'all')
+        self.assertEqual(self.cache.getStats()['snapshotWrites'], 0)
+
+        self.clock.advance(5)
+        self.assertEqual(self.cache.getStats()['snapshotWrites'], 1)
+
+        # Nothing changed since.
+        self.cache.flush()
+        self.assertEqual(self.cache.getStats()['snapshotWrites'], 1)
+
+    def test_snapshot_is_loaded_on_restart(self):
+        self.cache.set(self.cache.getKey('/services'), {'values': [1]})
+        self.clock.advance(30)
+        self.cache.set(self.key, {'values': [2]})
+        self.cache.flush()
+
+        # The first value expired more than maxStaleness seconds ago.
+        self.clock.advance(45)
+        cache = self._createCache()
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.lookup(self.key), ({'values': [2]}, True))
+
+    def test_invalid_snapshot_is_ignored(self):
+        with open(self.path, 'w') as f:
+            f.write('{')
+
+        self.assertEqual(len(self._createCache()), 0)
+        self.assertEqual(len(self.flushLoggedErrors(ValueError)), 1)
+
+        # Valid JSON, but not a list of entries.
+        for data in ['{}', '[["/services", [], "all"]]', '[1, null]',
+                     '[["/services", [], "all", "soon"]]',
+                     '[["/services", [["tag", ["db"]]], "db", 5]]',
+                     '[[{}, [], "all", 5]]']:
+            with open(self.path, 'w') as f:
+                f.write(data)
+
+            self.assertEqual(len(self._createCache()), 0, data)
+
+        # Valid entries are loaded along with invalid ones.
+        with open(self.path, 'w') as f:
+            f.write('[["/services", [], "all", true], '
+                    '["/services", [["tag", "db"]], "db", 5]]')
+
+        cache = self._createCache()
+        self.assertEqual(cache.lookup(self.key), ('db', False))
+        self.assertEqual(len(cache), 1)
+
+
+class RequestCoalescerTests(TestCase):
+    def setUp(self):
+        self.coalescer = RequestCoalescer()
+        self.calls = []
+
+    def _function(self):
+        d = Deferred()
+        self.calls.append(d)
+
+        return d
+
+    def test_concurrent_calls_share_result(self):
+        results = []
+
+        for i in range(3):
+            self.coalescer.run('key', self._function).addCallback(
+                results.append)
+
+        self.assertEqual(len(self.calls), 1)
+        self.assertTrue(self.coalescer.isInFlight('key'))
+        self.calls[0].callback({'values': []})
+        self.assertEqual(results, [{'values': []}] * 3)
+        # Each caller gets its own copy.
+        self.assertFalse(results[0] is results[1])
+        self.assertFalse(self.coalescer.isInFlight('key'))
+
+        stats = self.coalescer.getStats()
+        self.assertEqual(stats['requests'], 1)
+        self.assertEqual(stats['coalesced'], 2)
+        self.assertEqual(stats['inFlight'], 0)
+
+    def test_different_keys_are_not_coalesced(self):
+        self.coalescer.run('a', self._function)
+        self.coalescer.run('b', self._function)
+        self.assertEqual(len(self.calls), 2)
+
+    def test_failures_are_shared(self):
+        first = self.coalescer.run('key', self._function)
+        second = self.coalescer.run('key', self._function)
+        self.calls[0].errback(ValueError('boom'))
+
+        return gatherResults([self.assertFailure(first, ValueError),
+                              self.assertFailure(second, ValueError)])
+
+    def test_later_calls_are_sent_again(self):
+        self.coalescer.run('key', self._function)
+        self.calls[0].callback(None)
+        self.coalescer.run('key', self._function)
+        self.assertEqual(len(self.calls), 2)
+
+
+class ClientCacheTests(TestCase):
+    def setUp(self):
+        self.cache = ResponseCache()
+        self.client = Client('user', 'api_key', 'us',
+                             'http://127.0.0.1:8881/', Agent(reactor),
+                             cache=self.cache)
+        self.client.agent._getAuthHeaders = \
+            lambda: succeed({'X-Auth-Token': 'authToken',
+                             'X-Tenant-Id': 'tenantId'})
+        self.request = mock.Mock(wraps=self.client.agent.request)
+        self.client.agent.request = self.request
+
+    def test_get_is_served_from_cache(self):
+        def cbSecond(result):
+            self.assertEqual(result['id'], 'configId')
+            self.assertEqual(self.request.call_count, 1)
+            self.assertEqual(self.cache.getStats()['hits'], 1)
+
+        d = self.client.configuration.get('configId')
+        d.addCallback(lambda _: self.client.configuration.get('configId'))
+        d.addCallback(cbSecond)
+
+        return d
+
+    def test_concurrent_gets_are_coalesced(self):
+        def cbResults(results):
+            self.assertEqual([r['id'] for r in results], ['dfw1-db1'] * 3)
+            self.assertEqual(self.request.call_count, 1)
+
+        self.cache.ttls = {}
+        d = gatherResults([self.client.services.get('dfw1-db1')
+                           for i in range(3)])
+        d.addCallback(cbResults)
+
+        return d
+
+    def test_set_invalidates_cache(self):
+        def cbSecond(result):
+            self.assertEqual(self.request.call_count, 3)
+            self.assertEqual(self.cache.getStats()['invalidations'], 1)
+
+        d = self.client.configuration.get('configId')
+        d.addCallback(lambda _: self.client.configuration.set('configId', 1))
+        d.addCallback(lambda _: self.client.configuration.get('configId'))
+        d.addCallback(cbSecond)
+
+        return d
+
+    def test_heartbeats_leave_cache_in_place(self):
+        def cbHeartbeat(result):
+            self.assertEqual(len(self.cache), 2)
+            self.assertEqual(self.cache.getStats()['invalidations'], 0)
+
+        d = self.client.services.list()
+        d.addCallback(lambda _: self.client.services.get('dfw1-db1'))
+        d.addCallback(lambda _: self.client.services.heartbeat('dfw1-db1',
+                                                               'token'))
+        d.addCallback(cbHeartbeat)
+
+        return d
+
+    def test_error_responses_are_not_cached(self):
+        d = self.client.services.get('missing')
+        d.addCallback(lambda _: self.assertEqual(len(self.cache), 0))
+
+        return d
+
+    def test_events_are_not_cached(self):
+        d = self.client.events.list()
+        d.addCallback(lambda _: self.assertEqual(len(self.cache), 0))
+
+        return d
+
+
+class ClientStaleCacheTests(TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.cache = ResponseCache(clock=self.clock, maxStaleness=60)
+        self.client = Client('user', 'api_key', 'us',
+                             'http://127.0.0.1:8881/', Agent(reactor),
+                             cache=self.cache)
+        self.client.agent._getAuthHeaders = \
+            lambda: succeed({'X-Auth-Token': 'authToken',
+                             'X-Tenant-Id': 'tenantId'})
+        self.key = self.cache.getKey('/services/dfw1-db1')
+        self.cache.set(self.key, {'id': 'dfw1-db1', 'stale': True})
+        self.clock.advance(15)
+
+    def test_stale_value_is_served_and_refreshed(self):
+        refreshed = Deferred()
+        finishRevalidation = self.cache.finishRevalidation
+
+        def finish(key):
+            finishRevalidation(key)
+            refreshed.callback(None)
+
+        def cbRefreshed(_):
+            self.assertEqual(self.cache.lookup(self.key)[0]['id'],
+                             'dfw1-db1')
+            self.assertEqual(self.cache.lookup(self.key)[1], False)
+            self.assertFalse('stale' in self.cache.get(self.key))
+
+        self.cache.finishRevalidation = finish
+        results = []
+        self.client.services.get('dfw1-db1').addCallback(results.append)
+        self.assertEqual(results, [{'id': 'dfw1-db1', 'stale': True}])
+        refreshed.addCallback(cbRefreshed)
+
+        return refreshed
+
+    def test_stale_value_is_served_while_registry_is_down(self):
+        self.client.agent.request = \
+            lambda *args, **kwargs: fail(ConnectionRefusedError())
+        results = []
+
+        for i in range(2):
+            self.client.services.get('dfw1-db1').addCallback(results.append)
+
+        self.assertEqual(results, [{'id': 'dfw1-db1', 'stale': True}] * 2)
+        self.assertEqual(len(self.flushLoggedErrors(ConnectionRefusedError)),
+                         2)
+        # The value is kept until it is older than the maximum staleness.
+        self.clock.advance(60)
+        d = self.client.services.get('dfw1-db1')
+
+        return self.assertFailure(d, ConnectionRefusedError)
@@ -0,0 +1,146 @@
+# Copyright 2012 Rackspace Hosting, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from twisted.internet.defer import succeed
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+
+from txServiceRegistry.catalog import ServiceCatalog, TagIndex
+from txServiceRegistry.pagination import PageIterator
+from txServiceRegistry.test.test_events import FakeEventsClient
+
+SERVICES = [
+    {'id': 'dfw1-api', 'tags': ['api'], 'metadata': {}},
+    {'id': 'dfw1-db1', 'tags': ['db', 'mysql'],
+     'metadata': {'region': 'dfw'}}
+]
+
+
+class FakeServicesClient(object):
+    def __init__(self, services):
+        self.services = services
+        self.listCalls = 0
+
+    def list(self, marker=None, limit=None):
+        self.listCalls += 1
+
+        return succeed({'values': list(self.services),
+                        'metadata': {'next_marker': None}})
+
+    def iterAll(self, marker=None, limit=None, prefetch=False):
+        return PageIterator(self.list, marker, limit, prefetch)
+
+
+class TagIndexTests(TestCase):
+    def setUp(self):
+        self.index = TagIndex()
+
+        for service in SERVICES:
+            self.index.add(service)
+
+    def test_lookups(self):
+        self.assertEqual(self.index.getIdsForTag('db'), set(['dfw1-db1']))
+        self.assertEqual(self.index.getIdsForTag('missing'), set())
+        self.assertEqual(self.index.getIdsForMetadata('region', 'dfw'),
+                         set(['dfw1-db1']))
+        self.assertEqual(sorted(self.index.getTags()),
+                         ['api', 'db', 'mysql'])
+
+    def test_remove_drops_empty_keys(self):
+        self.index.remove(SERVICES[1])
+        self.assertEqual(self.index.getIdsForTag('db'), set())
+        self.assertEqual(self.index.getIdsForMetadata('region', 'dfw'),
+                         set())
+        self.assertEqual(self.index.getTags(), ['api'])
+
+    def test_metadata_indexing_can_be_disabled(self):
+        index = TagIndex(indexMetadata=False)
+        index.add(SERVICES[1])
+        self.assertEqual(index.getIdsForTag('db'), set(['dfw1-db1']))
+        self.assertEqual(index.getIdsForMetadata('region', 'dfw'), set())
+
+
+class ServiceCatalogTests(TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.services = FakeServicesClient(SERVICES)
+        self.events = FakeEventsClient([
+            {'id': '1', 'type': 'service.join',
+             'payload': {'id': 'old', 'tags': ['db']}}])
+        self.catalog = ServiceCatalog(self.services, self.events,
+                                      pollInterval=5, clock=self.clock)
+        self.catalog.start()
+        self.addCleanup(self.catalog.stop)
+
+    def test_start_loads_snapshot(self):
+        self.assertEqual(len(self.catalog), 2)
+        self.assertEqual(self.catalog.get('dfw1-db1')['tags'],
+                         ['db', 'mysql'])
+        self.assertEqual(self.catalog.get('missing'), None)
+        # Events which happened before the snapshot are not replayed.
+        self.assertFalse('old' in self.catalog)
+
+    def test_listForTag(self):
+        self.assertEqual([s['id'] for s in self.catalog.listForTag('db')],
+                         ['dfw1-db1'])
+        self.assertEqual(self.catalog.listForTag('cache'), [])
+
+    def test_listForMetadata(self):
+        services = self.catalog.listForMetadata('region', 'dfw')
+        self.assertEqual([s['id'] for s in services], ['dfw1-db1'])
+
+    def test_join_replaces_indexed_service(self):
+        self.catalog.handleEvent(
+            {'type': 'service.join',
+             'payload': {'id': 'dfw1-db1', 'tags': ['cache'],
+                         'metadata': {}}})
+        self.assertEqual(self.catalog.listForTag('db'), [])
+        self.assertEqual([s['id'] for s in self.catalog.listForTag('cache')],
+                         ['dfw1-db1'])
+        self.assertEqual(self.catalog.listForMetadata('region', 'dfw'), [])
+
+    def test_events_update_catalog(self):
+        self.events.events.extend([
+            {'id': '2', 'type': 'service.join',
+             'payload': {'id': 'dfw1-cache', 'tags': ['cache']}},
+            {'id': '3', 'type': 'service.timeout',
+             'payload': {'id': 'dfw1-api'}},
+            {'id': '4', 'type': 'service.remove',
+             'payload': {'id': 'dfw1-db1'}},
+            {'id': '5', 'type': 'configuration_value.update',
+             'payload': {'configuration_value_id': 'foo'}}])
+        self.clock.advance(5)
+
+        self.assertEqual(self.catalog.getServiceIds(), ['dfw1-cache'])
+        self.assertEqual(self.catalog.listForTag('db'), [])
+        self.assertEqual(len(self.catalog.listForTag('cache')), 1)
+        self.assertEqual(self.services.listCalls, 1)
+
+    def test_staleness(self):
+        self.assertFalse(self.catalog.isStale())
+        self.assertEqual(self.catalog.getStaleness(), 0)
+
+        self.events.error = ValueError('boom')
+        self.clock.advance(15)
+        self.flushLoggedErrors(ValueError)
+        self.assertEqual(self.catalog.getStaleness(), 15)
+        self.assertFalse(self.catalog.isStale())
+
+        self.clock.advance(5)
+        self.flushLoggedErrors(ValueError)
+        self.assertTrue(self.catalog.isStale())
+
+        self.events.error = None
+        self.clock.advance(5)
+        self.assertFalse(self.catalog.isStale())
@@ -15,11 +15,14 @@
 import mock
 
 from twisted.internet import reactor
-from twisted.internet.defer import succeed
+from twisted.internet.defer import Deferred, gatherResults, succeed
+from twisted.internet.task import Clock
 from twisted.trial.unittest import TestCase
 from twisted.web.client import Agent
 
-from txServiceRegistry.client import Client, HeartBeater
+from txServiceRegistry.client import Client, HeartBeater, \
+    RequestTimeoutError
+from txServiceRegistry.instrumentation import Instrumentation
 
 TOKENS = ['6bc8d050-f86a-11e1-a89e-ca2ffe480b20']
 EXPECTED_METADATA = \
@@ -62,6 +65,7 @@ class ServiceRegistryClientTests(TestCase):
             self.assertTrue(isinstance(result[1], HeartBeater))
             self.assertEqual(result[1].heartbeatInterval, 12.0)
             self.assertEqual(result[1].nextToken, TOKENS[0])
+            self.assertEqual(result[1].serviceId, 'dfw1-db1')
 
         d = self.client.services.create('dfw1-db1', 15)
         d.addCallback(service_assert)
@@ -121,6 +125,62 @@ class ServiceRegistryClientTests(TestCase):
 
         return d
 
+    def test_list_services_streaming(self):
+        values = []
+
+        def services_assert(result):
+            self.assertEqual(result['values'], [])
+            self.assertTrue('metadata' in result)
+            self.assertEqual([value['id'] for value in values],
+                             ['dfw1-api', 'dfw1-db1'])
+            self.assertEqual(values[1]['metadata'], EXPECTED_METADATA)
+
+        d = self.client.services.list(valueCallback=values.append)
+        d.addCallback(services_assert)
+
+        return d
+
+    def test_list_events_streaming(self):
+        values = []
+
+        def events_assert(result):
+            self.assertEqual(result['values'], [])
+            self.assertEqual(len(values), 3)
+            self.assertEqual(values[0]['type'], 'service.join')
+
+        d = self.client.events.list(valueCallback=values.append)
+        d.addCallback(events_assert)
+
+        return d
+
+    def test_iterAll_services_follows_next_marker(self):
+        def services_assert(result):
+            self.assertEqual([value['id'] for value in result],
+                             ['dfw1-api', 'dfw1-db1'])
+            self.assertEqual(iterator.pageCount, 2)
+
+        iterator = self.client.services.iterAll(limit=1, prefetch=True)
+        d = iterator.collect()
+        d.addCallback(services_assert)
+
+        return d
+
+    def test_service_catalog(self):
+        catalog = self.client.createServiceCatalog(pollInterval=60)
+        self.addCleanup(catalog.stop)
+
+        def catalog_assert(result):
+            self.assertEqual(len(catalog), 2)
+            self.assertEqual(catalog.get('dfw1-db1')['metadata'],
+                             EXPECTED_METADATA)
+            self.assertEqual([s['id'] for s in catalog.listForTag('db')],
+                             ['dfw1-db1'])
+
+        d = catalog.start()
+        d.addCallback(catalog_assert)
+
+        return d
+
     def test_listForTag(self):
         def services_for_tag_assert(result):
             self.assertEqual(result['values'][0]['id'], 'dfw1-db1')
@@ -226,3 +286,156 @@ class ServiceRegistryClientTests(TestCase):
                                    options={'tag': 'someTag',
                                             'marker': 'someMarker',
                                             'limit': 3})
+
+
+class FakeTransport(object):
+    def __init__(self):
+        self.stopped = False
+
+    def stopProducing(self):
+        self.stopped = True
+
+
+class FakeResponse(object):
+    """
+    A response whose body is delivered right away, or never if body is
+    None.
+    """
+    code = 200
+
+    def __init__(self, body=None):
+        self.body = body
+        self.transport = FakeTransport()
+        self.protocol = None
+
+    def deliverBody(self, protocol):
+        self.protocol = protocol
+        protocol.makeConnection(self.transport)
+
+        if self.body is not None:
+            protocol.dataReceived(self.body)
+            protocol.connectionLost(None)
+
+
+class RequestTimeoutTests(TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.instrumentation = Instrumentation()
+        self.client = self.createClient()
+        self.requests = []
+
+    def createClient(self, **kwargs):
+        client = Client('user', 'api_key', 'us', 'http://127.0.0.1:8881/',
+                        Agent(reactor), instrumentation=self.instrumentation,
+                        timeout=5, **kwargs)
+        client.agent._getAuthHeaders = \
+            lambda: succeed({'X-Auth-Token': 'authToken',
+                             'X-Tenant-Id': 'tenantId'})
+        client.agent.request = self.fakeRequest
+        client.configuration._clock = self.clock
+
+        return client
+
+    def fakeRequest(self, *args, **kwargs):
+        d = Deferred()
+        self.requests.append(d)
+
+        return d
+
+    def test_hanging_request_is_aborted(self):
+        d = self.client.configuration.get('configId')
+
+        self.clock.advance(4.9)
+        self.assertFalse(d.called)
+        self.clock.advance(0.1)
+        self.assertFailure(d, RequestTimeoutError)
+        self.assertTrue(self.requests[0].called)
+
+        stats = self.instrumentation.getStats()['GET /configuration/:id']
+        self.assertEqual(stats['timeouts'], 1)
+        self.assertEqual(stats['requests'], 1)
+        self.assertEqual(stats['errors'], 1)
+
+        # A late response is dropped.
+        self.requests[0].callback(FakeResponse())
+
+        return d
+
+    def test_stalled_body_closes_connection(self):
+        response = FakeResponse()
+        d = self.client.configuration.get('configId')
+        self.requests[0].callback(response)
+
+        self.clock.advance(5)
+        self.assertTrue(response.transport.stopped)
+
+        return self.assertFailure(d, RequestTimeoutError)
+
+    def test_slots_are_released_on_timeout(self):
+        client = self.createClient(maxConcurrentRequests=2)
+        limiter = client.concurrencyLimiter
+        timedOut = [client.configuration.get(configId)
+                    for configId in ('first', 'second', 'third')]
+        self.assertEqual(len(self.requests), 2)
+        self.assertEqual(limiter.getQueueDepth(), 1)
+
+        self.clock.advance(5)
+        self.assertEqual(limiter.getInFlight(), 0)
+        self.assertEqual(limiter.getQueueDepth(), 0)
+
+        d = client.configuration.get('fourth')
+        self.assertEqual(limiter.getInFlight(), 1)
+        self.requests[-1].callback(FakeResponse('{"id": "fourth"}'))
+        d.addCallback(lambda result: self.assertEqual(result['id'],
+                                                      'fourth'))
+
+        return gatherResults([self.assertFailure(timeout,
+                                                 RequestTimeoutError)
+                              for timeout in timedOut] + [d])
+
+    def test_coalesced_callers_have_own_deadlines(self):
+        results = []
+        default = self.client.configuration.get('configId')
+        short = self.client.configuration.withTimeout(1).get('configId')
+        unlimited = self.client.configuration.withTimeout(None).get(
+            'configId')
+        unlimited.addCallback(results.append)
+        self.assertEqual(len(self.requests), 1)
+        self.assertEqual(self.client.configuration.timeout, 5)
+
+        self.clock.advance(1)
+        self.assertFailure(short, RequestTimeoutError)
+        self.assertFalse(default.called)
+
+        self.clock.advance(4)
+        self.assertFailure(default, RequestTimeoutError)
+
+        # The request isn't aborted while a caller still waits for it.
+        self.clock.advance(60)
+        self.requests[0].callback(FakeResponse('{"id": "configId"}'))
+        self.assertEqual(results, [{'id': 'configId'}])
+
+        return gatherResults([short, default])
+
+    def test_queued_request_is_not_sent(self):
+        client = self.createClient(maxConcurrentRequests=1)
+        client.configuration.withTimeout(None).get('first')
+        second = client.configuration.get('second')
+        self.clock.advance(5)
+        self.requests[0].callback(FakeResponse('{"id": "first"}'))
+        self.assertEqual(len(self.requests), 1)
+
+        return self.assertFailure(second, RequestTimeoutError)
+
+    def test_timeout_is_cancelled_on_response(self):
+        # Trial fails the test if the timeout is left pending.
+        client = Client('user', 'api_key', 'us', 'http://127.0.0.1:8881/',
+                        Agent(reactor), timeout=5)
+        client.agent._getAuthHeaders = \
+            lambda: succeed({'X-Auth-Token': 'authToken',
+                             'X-Tenant-Id': 'tenantId'})
+        d = client.configuration.get('configId')
+        d.addCallback(lambda result: self.assertEqual(result['id'],
+                                                      'configId'))
+
+        return d
@@ -0,0 +1,165 @@
+# Copyright 2012 Rackspace Hosting, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, succeed
+from twisted.trial.unittest import TestCase
+from twisted.web.client import Agent
+
+from txServiceRegistry.client import Client
+from txServiceRegistry.concurrency import ConcurrencyLimiter, \
+    QueueFullError, getEndpointClass
+
+
+class FakeNoContentResponse(object):
+    code = 204
+
+
+class ConcurrencyLimiterTests(TestCase):
+    def setUp(self):
+        self.limiter = ConcurrencyLimiter(maxConcurrent=3,
+                                          classLimits={'write': 2})
+        self.calls = []
+
+    def _function(self, name):
+        d = Deferred()
+        self.calls.append((name, d))
+
+        return d
+
+    def _finish(self, name):
+        for index, (callName, d) in enumerate(self.calls):
+            if callName == name:
+                del self.calls[index]
+                d.callback(name)
+                return
+
+    def _started(self):
+        return [name for name, d in self.calls]
+
+    def test_getEndpointClass(self):
+        self.assertEqual(getEndpointClass('POST', '/services/a/heartbeat'),
+                         'heartbeat')
+        self.assertEqual(getEndpointClass('GET', '/services'), 'read')
+        self.assertEqual(getEndpointClass('PUT', '/services/a'), 'write')
+
+    def test_total_limit(self):
+        results = []
+
+        for i in range(5):
+            d = self.limiter.run('read', self._function, i)
+            d.addCallback(results.append)
+
+        self.assertEqual(self._started(), [0, 1, 2])
+        self.assertEqual(self.limiter.getQueueDepth(), 2)
+
+        self._finish(1)
+        self.assertEqual(results, [1])
+        self.assertEqual(self._started(), [0, 2, 3])
+        self.assertEqual(self.limiter.getStats()['maxQueueDepth'], 2)
+
+    def test_class_limit_does_not_block_other_classes(self):
+        for i in range(3):
+            self.limiter.run('write', self._function, 'write-%s' % (i))
+
+        self.limiter.run('read', self._function, 'read')
+        self.assertEqual(self._started(), ['write-0', 'write-1', 'read'])
+        self.assertEqual(self.limiter.getInFlight('write'), 2)
+
+        self._finish('read')
+        self.assertEqual(self._started(), ['write-0', 'write-1'])
+
+        self._finish('write-0')
+        self.assertEqual(self._started(), ['write-1', 'write-2'])
+
+    def test_failures_release_the_slot(self):
+        def failing():
+            raise ValueError('boom')
+
+        limiter = ConcurrencyLimiter(maxConcurrent=1)
+        d = limiter.run('read', failing)
+        self.assertFailure(d, ValueError)
+        self.assertEqual(limiter.getInFlight(), 0)
+
+        return d
+
+    def test_queue_full(self):
+        limiter = ConcurrencyLimiter(maxConcurrent=1, maxQueued=1)
+        limiter.run('write', self._function, 0)
+        limiter.run('write', self._function, 1)
+        d = limiter.run('write', self._function, 2)
+        self.assertFailure(d, QueueFullError)
+        self.assertEqual(limiter.getStats()['rejected'], 1)
+
+        return d
+
+    def test_waitForCapacity(self):
+        fired = []
+        self.limiter.waitForCapacity().addCallback(fired.append)
+        self.assertEqual(len(fired), 1)
+
+        for i in range(4):
+            self.limiter.run('read', self._function, i)
+
+        self.limiter.waitForCapacity().addCallback(fired.append)
+        self._finish(0)
+        # The slot went to the queued request.
+        self.assertEqual(len(fired), 1)
+
+        self._finish(1)
+        self.assertEqual(len(fired), 2)
+
+
+class ClientConcurrencyTests(TestCase):
+    def setUp(self):
+        self.client = Client('user', 'api_key', 'us',
+                             'http://127.0.0.1:8881/', Agent(reactor),
+                             maxConcurrentPerClass={'write': 2})
+        self.client.agent._getAuthHeaders = \
+            lambda: succeed({'X-Auth-Token': 'authToken',
+                             'X-Tenant-Id': 'tenantId'})
+        self.requests = []
+
+        def fakeRequest(method, uri, headers, bodyProducer):
+            d = Deferred()
+            self.requests.append(d)
+
+            return d
+
+        self.client.agent.request = fakeRequest
+
+    def test_updates_are_limited(self):
+        results = []
+
+        for i in range(5):
+            d = self.client.services.update('service-%s' % (i), {})
+            d.addCallback(results.append)
+
+        limiter = self.client.concurrencyLimiter
+        self.assertEqual(len(self.requests), 2)
+        self.assertEqual(limiter.getQueueDepth(), 3)
+
+        # Reads aren't held up by the queued writes.
+        self.client.services.get('dfw1-db1')
+        self.assertEqual(len(self.requests), 3)
+
+        self.requests.pop(0).callback(FakeNoContentResponse())
+        self.assertEqual(results, [True])
+        self.assertEqual(limiter.getInFlight('write'), 2)
+        self.assertEqual(limiter.getQueueDepth(), 2)
+
+    def test_sub_clients_share_the_limiter(self):
+        self.assertTrue(self.client.services.concurrencyLimiter is
+                        self.client.configuration.concurrencyLimiter)
+        self.assertTrue(Client('user', 'api_key').concurrencyLimiter is None)
@@ -0,0 +1,255 @@
+# Copyright 2012 Rackspace Hosting, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, succeed
+from twisted.internet.error import ConnectionRefusedError
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+from twisted.web.client import Agent
+
+from txServiceRegistry.client import Client, RequestTimeoutError
+from txServiceRegistry.endpoints import EndpointSelector, \
+    NoHealthyEndpointError
+from txServiceRegistry.utils import ResponseDiscarder
+
+DFW = 'http://dfw.example.com/v1.0/'
+LON = 'http://lon.example.com/v1.0/'
+# Nothing listens on the discard port, so connections are refused.
+REFUSED = 'http://127.0.0.1:9/'
+MOCK = 'http://127.0.0.1:8881/'
+
+
+class EndpointSelectorTests(TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.selector = EndpointSelector([DFW, LON.rstrip('/')],
+                                         failureThreshold=2,
+                                         resetTimeout=30, clock=self.clock)
+        self.dfw, self.lon = self.selector.endpoints
+
+    def test_urls_end_with_slash(self):
+        self.assertEqual(self.lon.url, LON)
+        self.assertRaises(ValueError, EndpointSelector, [])
+
+    def test_reads_go_to_fastest_endpoint(self):
+        # Unmeasured endpoints are tried first.
+        self.assertTrue(self.selector.choose('GET') is self.dfw)
+        self.selector.recordSuccess(self.dfw, 0.08)
+        self.assertTrue(self.selector.choose('GET') is self.lon)
+        self.selector.recordSuccess(self.lon, 0.01)
+        self.assertTrue(self.selector.choose('GET') is self.lon)
+
+        # Writes keep going to the first endpoint.
+        self.assertTrue(self.selector.choose('POST') is self.dfw)
+
+    def test_moving_average(self):
+        self.selector.recordSuccess(self.dfw, 0.1)
+        self.selector.recordSuccess(self.dfw, 0.5)
+        self.assertAlmostEqual(self.dfw.rtt, 0.2)
+
+    def test_exclude(self):
+        self.assertTrue(self.selector.choose('POST', (self.dfw,)) is
+                        self.lon)
+        self.assertEqual(self.selector.choose('POST',
+                                              (self.dfw, self.lon)), None)
+
+    def test_circuit_breaker(self):
+        self.selector.recordFailure(self.dfw)
+        self.assertTrue(self.selector.choose('POST') is self.dfw)
+        self.selector.recordFailure(self.dfw)
+        self.assertEqual(self.dfw.state, 'open')
+        self.assertTrue(self.selector.choose('POST') is self.lon)
+
+        # A single request is let through after the reset timeout.
+        self.clock.advance(30)
+        self.assertTrue(self.selector.choose('POST') is self.dfw)
+        self.assertEqual(self.dfw.state, 'halfOpen')
+        self.assertTrue(self.selector.choose('POST') is self.lon)
+
+        # It fails, so the circuit opens again right away.
+        self.selector.recordFailure(self.dfw)
+        self.assertEqual(self.dfw.state, 'open')
+        self.clock.advance(30)
+        self.selector.choose('POST')
+        self.selector.recordSuccess(self.dfw, 0.05)
+        self.assertEqual(self.selector.getHealth()[DFW],
+                         {'state': 'closed', 'rtt': 0.05, 'failures': 0,
+                          'requests': 4, 'errors': 3})
+
+    def test_stuck_probe_is_replaced(self):
+        self.selector.recordFailure(self.dfw)
+        self.selector.recordFailure(self.dfw)
+        self.clock.advance(30)
+        self.assertTrue(self.selector.choose('POST') is self.dfw)
+
+        # The probe never finishes.
+        self.clock.advance(29)
+        self.assertTrue(self.selector.choose('POST') is self.lon)
+        self.clock.advance(1)
+        self.assertTrue(self.selector.choose('POST') is self.dfw)
+        self.assertEqual(self.dfw.state, 'halfOpen')
+        self.selector.recordSuccess(self.dfw, 0.05)
+        self.assertEqual(self.dfw.state, 'closed')
+
+
+class FakeResponse(object):
+    def __init__(self, code, body):
+        self.code = code
+        self.body = body
+        self.protocol = None
+
+    def deliverBody(self, protocol):
+        self.protocol = protocol
+        protocol.dataReceived(self.body)
+        protocol.connectionLost(None)
+
+
+class ClientFailoverTests(TestCase):
+    def setUp(self):
+        self.client = Client('user', 'api_key', 'us', agent=Agent(reactor),
+                             baseUrls=[REFUSED, MOCK])
+        self.client.agent._getAuthHeaders = \
+            lambda: succeed({'X-Auth-Token': 'authToken',
+                             'X-Tenant-Id': 'tenantId'})
+
+    def test_sub_clients_share_the_selector(self):
+        self.assertTrue(self.client.services.endpoints is
+                        self.client.endpoints)
+        self.assertEqual(Client('user', 'api_key').getEndpointHealth(), None)
+
+    def test_failover(self):
+        def cbResult(result):
+            self.assertEqual(result['id'], 'dfw1-db1')
+            health = self.client.getEndpointHealth()
+            self.assertEqual(health[REFUSED]['errors'], 1)
+            self.assertEqual(health[MOCK]['requests'], 1)
+            self.assertTrue(health[MOCK]['rtt'] is not None)
+
+        d = self.client.services.get('dfw1-db1')
+        d.addCallback(cbResult)
+
+        return d
+
+    def test_writes_fail_over_when_not_sent(self):
+        d = self.client.services.update('dfw1-db1', {'metadata': {}})
+        d.addCallback(self.assertEqual, True)
+
+        return d
+
+    def test_no_healthy_endpoint(self):
+        client = Client('user', 'api_key', 'us', agent=Agent(reactor),
+                        baseUrls=[REFUSED])
+        client.agent._getAuthHeaders = self.client.agent._getAuthHeaders
+        client.endpoints.failureThreshold = 1
+
+        def cbRefused(_):
+            # The circuit of the only endpoint is open now.
+            d = client.services.get('dfw1-db1')
+
+            return self.assertFailure(d, NoHealthyEndpointError)
+
+        d = client.services.get('dfw1-db1')
+        self.assertFailure(d, ConnectionRefusedError)
+        d.addCallback(cbRefused)
+
+        return d
+
+
+class FakeAgentFailoverTests(TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.client = Client('user', 'api_key', 'us', agent=Agent(reactor),
+                             baseUrls=[DFW, LON], endpointTimeout=5)
+        self.client.endpoints._clock = self.clock
+        self.client.agent._getAuthHeaders = \
+            lambda: succeed({'X-Auth-Token': 'authToken',
+                             'X-Tenant-Id': 'tenantId'})
+        self.client.agent.request = self.request
+        self.requests = []
+
+    def request(self, method, uri, headers=None, bodyProducer=None):
+        d = Deferred()
+        self.requests.append((uri, d))
+
+        return d
+
+    def test_reads_fail_over_on_5xx(self):
+        results = []
+        self.client.services.get('dfw1-db1').addCallback(results.append)
+        unavailable = FakeResponse(503, '{"type": "unavailable"}')
+        self.requests[0][1].callback(unavailable)
+
+        self.assertTrue(isinstance(unavailable.protocol, ResponseDiscarder))
+        self.assertTrue(self.requests[1][0].startswith(LON))
+        self.requests[1][1].callback(FakeResponse(200, '{"id": "dfw1-db1"}'))
+        self.assertEqual(results, [{'id': 'dfw1-db1'}])
+
+    def test_writes_dont_fail_over_on_5xx(self):
+        results = []
+        self.client.services.create('dfw1-db1', 30).addCallback(
+            results.append)
+        self.requests[0][1].callback(
+            FakeResponse(503, '{"type": "unavailable"}'))
+
+        self.assertEqual(len(self.requests), 1)
+        self.assertEqual(results, [{'type': 'unavailable'}])
+
+    def test_reads_fail_over_on_timeout(self):
+        results = []
+        self.client.services.get('dfw1-db1').addCallback(results.append)
+        self.clock.advance(5)
+        self.assertEqual(len(self.requests), 2)
+        self.requests[1][1].callback(FakeResponse(200, '{"id": "dfw1-db1"}'))
+        self.assertEqual(results, [{'id': 'dfw1-db1'}])
+
+        # The request to the slow endpoint is cancelled.
+        self.assertTrue(self.requests[0][1].called)
+        self.assertEqual(self.client.getEndpointHealth()[DFW]['errors'], 1)
+
+    def test_slow_endpoint_can_answer_first(self):
+        results = []
+        self.client.services.get('dfw1-db1').addCallback(results.append)
+        self.clock.advance(5)
+        self.assertEqual(len(self.requests), 2)
+        self.requests[0][1].callback(FakeResponse(200, '{"id": "dfw1-db1"}'))
+        self.assertEqual(results, [{'id': 'dfw1-db1'}])
+        self.assertTrue(self.requests[1][1].called)
+
+    def test_slow_endpoint_is_used_if_next_one_fails(self):
+        results = []
+        self.client.services.get('dfw1-db1').addCallback(results.append)
+        self.clock.advance(5)
+        unavailable = FakeResponse(503, '{"type": "unavailable"}')
+        self.requests[1][1].callback(unavailable)
+        self.assertTrue(isinstance(unavailable.protocol, ResponseDiscarder))
+        self.assertEqual(results, [])
+
+        self.requests[0][1].callback(FakeResponse(200, '{"id": "dfw1-db1"}'))
+        self.assertEqual(results, [{'id': 'dfw1-db1'}])
+
+    def test_write_timeout_is_recorded_as_failure(self):
+        client = Client('user', 'api_key', 'us', agent=Agent(reactor),
+                        baseUrls=[DFW, LON], timeout=5)
+        client.services._clock = self.clock
+        client.agent._getAuthHeaders = self.client.agent._getAuthHeaders
+        client.agent.request = self.request
+        d = client.services.create('dfw1-db1', 30)
+        self.clock.advance(5)
+
+        self.assertTrue(self.requests[0][1].called)
+        self.assertEqual(len(self.requests), 1)
+        self.assertEqual(client.getEndpointHealth()[DFW]['errors'], 1)
+
+        return self.assertFailure(d, RequestTimeoutError)
@@ -0,0 +1,184 @@
+# Copyright 2012 Rackspace Hosting, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from twisted.internet.defer import succeed, fail
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+
+from txServiceRegistry.events import EventsTailer, FileMarkerStore, \
+    MemoryMarkerStore
+
+
+def event(eventId, eventType='service.join', serviceId='dfw1-db1'):
+    return {'id': eventId, 'type': eventType, 'payload': {'id': serviceId}}
+
+
+class FakeEventsClient(object):
+    """
+    Serves a list of events the way the API does: the page starts at the
+    event the marker points to.
+    """
+    def __init__(self, events=None, pageSize=2):
+        self.events = events or []
+        self.pageSize = pageSize
+        self.calls = []
+        self.error = None
+
+    def list(self, marker=None, limit=None):
+        self.calls.append(marker)
+
+        if self.error:
+            return fail(self.error)
+
+        ids = [e['id'] for e in self.events]
+        start = ids.index(marker) if marker in ids else 0
+        values = self.events[start:start + self.pageSize]
+        rest = self.events[start + self.pageSize:]
+        nextMarker = rest[0]['id'] if rest else None
+
+        return succeed({'values': values,
+                        'metadata': {'next_marker': nextMarker}})
+
+
+class EventsTailerTests(TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.client = FakeEventsClient([event('1'), event('2'),
+                                        event('3')])
+        self.received = []
+        self.tailer = EventsTailer(self.client, self.received.append,
+                                   interval=5, clock=self.clock)
+
+    def _ids(self):
+        return [e['id'] for e in self.received]
+
+    def test_poll_delivers_all_pages_in_order(self):
+        counts = []
+        self.tailer.poll().addCallback(counts.append)
+        self.assertEqual(self._ids(), ['1', '2', '3'])
+        self.assertEqual(counts, [3])
+        self.assertEqual(self.tailer.marker, '3')
+
+    def test_poll_resumes_after_last_event(self):
+        self.tailer.poll()
+        self.client.events.append(event('4'))
+        self.tailer.poll()
+        self.assertEqual(self._ids(), ['1', '2', '3', '4'])
+
+    def test_seekToEnd_skips_existing_events(self):
+        self.tailer.seekToEnd()
+        self.assertEqual(self.received, [])
+        self.client.events.append(event('4'))
+        self.tailer.poll()
+        self.assertEqual(self._ids(), ['4'])
+
+    def test_start_polls_every_interval(self):
+        self.tailer.start()
+        self.assertEqual(self.client.calls, [])
+        self.clock.advance(5)
+        self.assertEqual(self._ids(), ['1', '2', '3'])
+        self.assertEqual(self.tailer.lastPollTime, 5)
+
+        self.client.events.append(event('4'))
+        self.clock.advance(5)
+        self.assertEqual(self._ids(), ['1', '2', '3', '4'])
+
+        self.tailer.stop()
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_polling_continues_after_errors(self):
+        self.client.error = ValueError('boom')
+        self.tailer.start()
+        self.clock.advance(5)
+        self.assertEqual(len(self.flushLoggedErrors(ValueError)), 1)
+
+        self.client.error = None
+        self.clock.advance(5)
+        self.assertEqual(self._ids(), ['1', '2', '3'])
+        self.tailer.stop()
+
+    def test_adaptive_polling(self):
+        tailer = EventsTailer(self.client, self.received.append, interval=1,
+                              maxInterval=4, clock=self.clock)
+        tailer.start()
+        self.clock.advance(1)
+        self.assertEqual(len(self.received), 3)
+        self.assertEqual(tailer.currentInterval, 1)
+
+        for expected in [2, 4, 4]:
+            self.clock.advance(tailer.currentInterval)
+            self.assertEqual(tailer.currentInterval, expected)
+
+        self.client.events.append(event('4'))
+        self.clock.advance(4)
+        self.assertEqual(len(self.received), 4)
+        self.assertEqual(tailer.currentInterval, 1)
+        tailer.stop()
+
+    def test_store_resumes_after_last_delivered_event(self):
+        store = MemoryMarkerStore()
+        tailer = EventsTailer(self.client, self.received.append,
+                              store=store, clock=self.clock)
+        tailer.poll()
+        self.assertEqual(store.marker, '3')
+
+        self.client.events.extend([event('4'), event('5')])
+        received = []
+        EventsTailer(self.client, received.append, store=store,
+                     clock=self.clock).poll()
+        self.assertEqual([e['id'] for e in received], ['4', '5'])
+        self.assertEqual(store.marker, '5')
+
+
+class FileMarkerStoreTests(TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.path = self.mktemp()
+        self.store = FileMarkerStore(self.path, syncInterval=1,
+                                     clock=self.clock)
+
+    def test_load_missing_file(self):
+        self.assertEqual(self.store.load(), None)
+
+    def test_saves_are_batched(self):
+        self.store.save('1')
+        self.assertEqual(self.store.writes, 1)
+
+        self.store.save('2')
+        self.store.save('3')
+        self.assertEqual(self.store.writes, 1)
+        self.assertEqual(FileMarkerStore(self.path).load(), '1')
+
+        self.clock.advance(1)
+        self.assertEqual(self.store.writes, 2)
+        self.assertEqual(FileMarkerStore(self.path).load(), '3')
+
+    def test_flush(self):
+        self.store.save('1')
+        self.store.save('2')
+        self.store.flush()
+        self.assertEqual(self.store.writes, 2)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.assertEqual(FileMarkerStore(self.path).load(), '2')
+
+    def test_tailer_flushes_on_stop(self):
+        client = FakeEventsClient([event('1'), event('2'), event('3')])
+        tailer = EventsTailer(client, lambda event: None, store=self.store,
+                              clock=self.clock)
+        tailer.start()
+        self.clock.advance(5)
+        tailer.stop()
+        self.assertEqual(FileMarkerStore(self.path).load(), '3')
+        self.assertEqual(EventsTailer(client, None, store=self.store).marker,
+                         '3')
@@ -0,0 +1,324 @@
+# Copyright 2012 Rackspace Hosting, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import gc
+import sys
+
+from twisted.internet.defer import Deferred
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+
+from txServiceRegistry.client import HeartBeater, ServicesClient
+from txServiceRegistry.heartbeat import HeartbeatEntry, \
+    HeartbeatScheduler, compactToken, getLatestSendTime, getRetryDelay, \
+    updateRoundTripTime
+from txServiceRegistry.serialization import HeartbeatTemplate
+
+# Maximum number of bytes used per heartbeated service.
+MEMORY_BUDGET_PER_SERVICE = 1024
+
+
+def getReachableSize(*roots):
+    """
+    Return the number of bytes used by roots and everything reachable from
+    them through containers, heartbeat entries and templates. Every object
+    is counted once. Other objects, such as classes and the codec, are
+    counted but not walked.
+    """
+    seen = set()
+    size = 0
+    remaining = list(roots)
+
+    while remaining:
+        value = remaining.pop()
+
+        if id(value) in seen:
+            continue
+
+        seen.add(id(value))
+        size += sys.getsizeof(value)
+
+        if isinstance(value, (dict, list, tuple, HeartbeatEntry,
+                              HeartbeatTemplate)):
+            remaining.extend(gc.get_referents(value))
+
+    return size
+
+
+class FakeServicesClient(object):
+    def __init__(self):
+        self.requests = []
+
+    def heartbeat(self, serviceId, token, template=None):
+        d = Deferred()
+        self.requests.append((serviceId, token, d))
+
+        return d
+
+    def getHeartbeatTemplate(self, serviceId):
+        return None
+
+    def respond(self, index=0, token='next'):
+        serviceId, oldToken, d = self.requests.pop(index)
+        d.callback({'token': token})
+
+    def fail(self, index=0):
+        serviceId, oldToken, d = self.requests.pop(index)
+        d.errback(ValueError('boom'))
+
+
+class HeartbeatPolicyTests(TestCase):
+    def test_updateRoundTripTime(self):
+        self.assertEqual(updateRoundTripTime(None, 0.4), 0.4)
+        self.assertEqual(updateRoundTripTime(0.4, 0.8), 0.5)
+
+    def test_getLatestSendTime(self):
+        self.assertEqual(getLatestSendTime(30, None), 29)
+        self.assertEqual(getLatestSendTime(30, 2), 27)
+
+    def test_getRetryDelay(self):
+        self.assertEqual(getRetryDelay(30, 0, 20), 1)
+        self.assertEqual(getRetryDelay(30, 1, 28), 0.5)
+        self.assertEqual(getRetryDelay(30, 1, 29), None)
+
+
+class HeartbeatSchedulerTests(TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.client = FakeServicesClient()
+        self.scheduler = HeartbeatScheduler(self.client, maxInFlight=2,
+                                            clock=self.clock)
+        self.addCleanup(self.scheduler.stop)
+
+    def test_single_timer_for_all_services(self):
+        for i in range(100):
+            self.scheduler.add('service-%s' % (i), 30, 'token')
+
+        self.scheduler.start()
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+
+    def test_heartbeats_are_spread_across_interval(self):
+        self.scheduler = HeartbeatScheduler(self.client, maxInFlight=1000,
+                                            clock=self.clock)
+
+        for i in range(100):
+            self.scheduler.add('service-%s' % (i), 10, 'token')
+
+        self.scheduler.start()
+        # The interval is 6 seconds, every second should see roughly a sixth
+        # of the services.
+        counts = []
+
+        for second in range(6):
+            self.clock.advance(1)
+            counts.append(len(self.client.requests))
+
+            while self.client.requests:
+                self.client.respond()
+
+        self.assertEqual(sum(counts), 100)
+        self.assertTrue(min(counts) >= 14, counts)
+        self.assertTrue(max(counts) <= 19, counts)
+
+    def test_token_is_replaced_after_heartbeat(self):
+        self.scheduler.add('dfw1-db1', 10, 'first')
+        self.scheduler.start()
+        self.clock.advance(6)
+        self.assertEqual(self.client.requests[0][:2], ('dfw1-db1', 'first'))
+        self.client.respond(token='second')
+
+        self.clock.advance(6)
+        self.assertEqual(self.client.requests[0][:2], ('dfw1-db1', 'second'))
+        self.assertEqual(self.scheduler.getStats()['sent'], 2)
+
+    def test_in_flight_heartbeats_are_capped(self):
+        for i in range(5):
+            self.scheduler.add('service-%s' % (i), 10, 'token')
+
+        self.scheduler.start()
+        self.clock.advance(6)
+        self.assertEqual(len(self.client.requests), 2)
+        self.assertEqual(self.scheduler.getStats()['inFlight'], 2)
+
+        self.clock.advance(1)
+        self.client.respond()
+        self.assertEqual(len(self.client.requests), 2)
+        serviceId = self.client.requests[-1][0]
+        self.assertTrue(self.scheduler.getLag(serviceId) > 0)
+        self.assertTrue(self.scheduler.getStats()['maxLag'] > 0)
+
+    def test_pending_heartbeat_is_not_sent_twice(self):
+        self.scheduler.add('dfw1-db1', 10, 'token')
+        self.scheduler.start()
+        self.clock.advance(6)
+        self.clock.advance(6)
+        self.assertEqual(len(self.client.requests), 1)
+        self.assertEqual(self.scheduler.getStats()['skipped'], 1)
+
+    def test_failed_heartbeats_are_counted(self):
+        self.scheduler.add('dfw1-db1', 10, 'token')
+        self.scheduler.start()
+        self.clock.advance(6)
+        self.client.requests.pop()[2].errback(ValueError('boom'))
+        self.assertEqual(len(self.flushLoggedErrors(ValueError)), 1)
+        self.assertEqual(self.scheduler.getStats()['failures'], 1)
+
+        self.clock.advance(6)
+        self.assertEqual(len(self.client.requests), 1)
+
+    def test_remove_and_stop(self):
+        self.scheduler.add('a', 10, 'token')
+        self.scheduler.add('b', 10, 'token')
+        self.scheduler.start()
+        self.scheduler.remove('a')
+        self.clock.advance(6)
+        self.assertEqual([r[0] for r in self.client.requests], ['b'])
+        self.assertFalse('a' in self.scheduler)
+
+        self.scheduler.stop()
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_addHeartBeater(self):
+        heartbeater = HeartBeater(None, 'http://127.0.0.1/', 'dfw1-db1', 15)
+        heartbeater.nextToken = 'token'
+        entry = self.scheduler.addHeartBeater(heartbeater)
+        self.assertEqual(entry.serviceId, 'dfw1-db1')
+        self.assertEqual(entry.token, 'token')
+        self.assertEqual(entry.interval, heartbeater.heartbeatInterval)
+
+    def test_compactToken(self):
+        token = compactToken(u'6bc8d050-f86a-11e1-a89e-ca2ffe480b20')
+        self.assertTrue(isinstance(token, str))
+        self.assertEqual(compactToken(u'caf\xe9'), u'caf\xe9')
+        self.assertEqual(compactToken(None), None)
+
+    def test_memory_per_service_is_under_budget(self):
+        scheduler = HeartbeatScheduler(ServicesClient(None,
+                                                      'http://127.0.0.1/'),
+                                       clock=self.clock)
+        self.assertEqual(scheduler.getMemoryFootprint(), None)
+
+        for i in range(1000):
+            entry = scheduler.add('dfw1-service-%05d' % (i), 30,
+                                  u'6bc8d050-f86a-11e1-a89e-%012d' % (i))
+
+        self.assertFalse(hasattr(entry, '__dict__'))
+        self.assertTrue(entry.template is not None)
+
+        measured = getReachableSize(scheduler._entries,
+                                    scheduler._heap) / 1000
+        self.assertTrue(measured < MEMORY_BUDGET_PER_SERVICE, measured)
+
+        # The estimate in the stats stays close to the real size.
+        estimate = scheduler.getMemoryFootprint()
+        self.assertTrue(abs(estimate - measured) < measured / 4,
+                        (estimate, measured))
+
+    def _failFirstHeartbeat(self, timeout):
+        atRisk = []
+        self.scheduler.onAtRisk = lambda *args: atRisk.append(args)
+        self.scheduler.add('dfw1-db1', timeout, 'token')
+        self.scheduler.start()
+        self.clock.advance(self.clock.getDelayedCalls()[0].getTime())
+        self.client.fail()
+        self.flushLoggedErrors(ValueError)
+
+        return atRisk
+
+    def test_failed_heartbeat_is_retried_within_timeout(self):
+        atRisk = self._failFirstHeartbeat(10)
+        sent = self.clock.seconds()
+        self.assertEqual(atRisk, [('dfw1-db1', 10 - sent)])
+
+        self.clock.advance(1)
+        self.assertEqual(len(self.client.requests), 1)
+        self.assertEqual(self.scheduler.getStats()['retries'], 1)
+
+        self.client.respond()
+        self.assertEqual(self.scheduler._entries['dfw1-db1'].deadline,
+                         sent + 1 + 10)
+
+    def test_no_retry_after_timeout(self):
+        self.scheduler.add('dfw1-db1', 10, 'token')
+        self.scheduler.start()
+        self.clock.advance(12)
+        self.client.fail()
+        self.flushLoggedErrors(ValueError)
+        self.assertEqual(self.scheduler.getStats()['retries'], 0)
+
+    def test_error_responses_are_failures(self):
+        self.scheduler.add('dfw1-db1', 10, 'token')
+        self.scheduler.start()
+        self.clock.advance(6)
+        self.client.requests.pop()[2].callback({'type': 'notFoundError',
+                                                'code': 404})
+        self.assertEqual(len(self.flushLoggedErrors()), 1)
+        self.assertEqual(self.scheduler.getStats()['failures'], 1)
+        self.assertEqual(self.scheduler._entries['dfw1-db1'].token, 'token')
+
+    def test_slow_round_trips_move_heartbeats_earlier(self):
+        entry = self.scheduler.add('dfw1-db1', 30, 'token')
+        self.scheduler.start()
+        self.clock.advance(entry.due)
+        sent = self.clock.seconds()
+        self.clock.advance(5)
+        self.client.respond()
+
+        self.assertEqual(self.scheduler.getRoundTripTime('dfw1-db1'), 5)
+        # Due after 24 seconds, but it must be sent before the 30 second
+        # timeout minus the round trip time and the safety margin.
+        self.assertEqual(entry.due, sent + 30 - 5 - 1)
+
+
+class HeartBeaterTests(TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.atRisk = []
+        self.heartbeater = HeartBeater(None, 'http://127.0.0.1/', 'dfw1-db1',
+                                       10, clock=self.clock,
+                                       onAtRisk=lambda *args:
+                                       self.atRisk.append(args))
+        self.heartbeater.nextToken = 'token'
+        self.requests = []
+
+        def request(method, path, payload=None):
+            d = Deferred()
+            self.requests.append((path, payload.data, d))
+
+            return d
+
+        self.heartbeater.request = request
+        self.addCleanup(self.heartbeater.stop)
+
+    def test_heartbeats_use_template(self):
+        self.heartbeater.start()
+        self.assertEqual(self.requests[0][:2],
+                         ('/services/dfw1-db1/heartbeat',
+                          '{"token": "token"}'))
+
+        self.requests.pop()[2].callback({'token': 'next'})
+        self.assertEqual(self.heartbeater.nextToken, 'next')
+        self.clock.advance(6)
+        self.assertEqual(self.requests[0][1], '{"token": "next"}')
+
+    def test_failed_heartbeat_is_retried(self):
+        self.heartbeater.start()
+        self.clock.advance(2)
+        self.requests.pop()[2].errback(ValueError('boom'))
+        self.assertEqual(len(self.flushLoggedErrors(ValueError)), 1)
+        self.assertEqual(self.atRisk, [('dfw1-db1', 8)])
+
+        self.clock.advance(1)
+        self.assertEqual(len(self.requests), 1)
+        self.assertEqual(self.heartbeater.failures, 1)
@@ -0,0 +1,194 @@
+# Copyright 2012 Rackspace Hosting, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from twisted.internet import reactor
+from twisted.internet.defer import succeed
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+from twisted.web.client import Agent
+
+from txServiceRegistry.client import Client
+from txServiceRegistry.instrumentation import Instrumentation, Histogram, \
+    getEndpoint
+from txServiceRegistry.ratelimit import RateLimiter
+
+
+class FakeUnauthorizedResponse(object):
+    code = 401
+
+
+class HistogramTests(TestCase):
+    def test_percentiles(self):
+        histogram = Histogram(buckets=(0.01, 0.1, 1.0))
+
+        for i in range(98):
+            histogram.add(0.005)
+
+        histogram.add(0.05)
+        histogram.add(3.0)
+        stats = histogram.getStats()
+        self.assertEqual(stats['count'], 100)
+        self.assertEqual(stats['buckets'], [98, 1, 0, 1])
+        self.assertEqual(stats['p50'], 0.01)
+        self.assertEqual(stats['p99'], 0.1)
+        self.assertEqual(histogram.getPercentile(100), 3.0)
+        self.assertEqual(stats['min'], 0.005)
+        self.assertEqual(stats['max'], 3.0)
+
+    def test_empty(self):
+        stats = Histogram().getStats()
+        self.assertEqual(stats['count'], 0)
+        self.assertEqual(stats['p50'], None)
+        self.assertEqual(stats['mean'], None)
+
+
+class InstrumentationTests(TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.instrumentation = Instrumentation(clock=self.clock)
+
+    def test_getEndpoint(self):
+        self.assertEqual(getEndpoint('GET', '/services'), 'GET /services')
+        self.assertEqual(getEndpoint('GET', '/services/dfw1-db1'),
+                         'GET /services/:id')
+        self.assertEqual(getEndpoint('POST', '/services/dfw1-db1/heartbeat'),
+                         'POST /services/:id/heartbeat')
+        self.assertEqual(getEndpoint('PUT', '/configuration/dfw/db/port'),
+                         'PUT /configuration/:id')
+
+    def test_finishRequest(self):
+        observed = []
+        self.instrumentation.addObserver(observed.append)
+        metrics = self.instrumentation.startRequest('GET', '/services/a')
+        metrics.status = 200
+        self.clock.advance(2)
+        self.instrumentation.finishRequest(metrics)
+        # Finishing twice doesn't count the request twice.
+        self.instrumentation.finishRequest(metrics)
+
+        self.assertEqual(observed, [metrics])
+        self.assertEqual(metrics.total, 2)
+        stats = self.instrumentation.getStats()['GET /services/:id']
+        self.assertEqual(stats['requests'], 1)
+        self.assertEqual(stats['statuses'], {200: 1})
+        self.assertEqual(stats['total']['max'], 2)
+        self.assertEqual(stats['queueWait']['count'], 0)
+
+    def test_failing_observer_is_logged(self):
+        def observer(metrics):
+            raise ValueError('boom')
+
+        self.instrumentation.addObserver(observer)
+        metrics = self.instrumentation.startRequest('GET', '/services')
+        self.instrumentation.finishRequest(metrics)
+        self.assertEqual(len(self.flushLoggedErrors(ValueError)), 1)
+        self.assertEqual(
+            self.instrumentation.getStats()['GET /services']['requests'], 1)
+
+
+class ClientInstrumentationTests(TestCase):
+    def setUp(self):
+        self.instrumentation = Instrumentation()
+        self.observed = []
+        self.instrumentation.addObserver(self.observed.append)
+        self.client = Client('user', 'api_key', 'us',
+                             'http://127.0.0.1:8881/', Agent(reactor),
+                             instrumentation=self.instrumentation)
+        self.client.agent._getAuthHeaders = \
+            lambda: succeed({'X-Auth-Token': 'authToken',
+                             'X-Tenant-Id': 'tenantId'})
+
+    def test_get_is_measured(self):
+        def cbGet(result):
+            metrics = self.observed[0]
+            self.assertEqual(metrics.endpoint, 'GET /configuration/:id')
+            self.assertEqual(metrics.status, 200)
+            self.assertTrue(metrics.bytesIn > 0)
+            self.assertEqual(metrics.bytesOut, 0)
+            self.assertEqual(metrics.queueWait, None)
+
+            for phase in ('auth', 'response', 'body', 'total'):
+                self.assertTrue(getattr(metrics, phase) >= 0, phase)
+
+            stats = self.instrumentation.getStats()
+            self.assertEqual(stats['GET /configuration/:id']['statuses'],
+                             {200: 1})
+
+        d = self.client.configuration.get('configId')
+        d.addCallback(cbGet)
+
+        return d
+
+    def test_post_and_errors_are_measured(self):
+        def cbHeartbeat(result):
+            self.assertEqual(self.observed[0].status, 200)
+            self.assertEqual(self.observed[0].bytesOut,
+                             len('{"token": "token"}'))
+
+        def cbGet(result):
+            stats = self.instrumentation.getStats()['GET /services/:id']
+            self.assertEqual(stats['statuses'], {404: 1})
+
+        d = self.client.services.heartbeat('dfw1-db1', 'token')
+        d.addCallback(cbHeartbeat)
+        d.addCallback(lambda _: self.client.services.get('missing'))
+        d.addCallback(cbGet)
+
+        return d
+
+    def test_401_retries_are_counted(self):
+        request = self.client.agent.request
+        responses = [FakeUnauthorizedResponse()]
+
+        def fakeRequest(*args, **kwargs):
+            if responses:
+                return succeed(responses.pop())
+
+            return request(*args, **kwargs)
+
+        def cbGet(result):
+            self.assertEqual([m.status for m in self.observed], [401, 200])
+            self.assertEqual([m.retryCount for m in self.observed], [0, 1])
+            stats = self.instrumentation.getStats()['GET /configuration/:id']
+            self.assertEqual(stats['retries'], 1)
+            self.assertEqual(stats['statuses'], {200: 1, 401: 1})
+
+        self.client.agent.request = fakeRequest
+        d = self.client.configuration.get('configId')
+        d.addCallback(cbGet)
+
+        return d
+
+    def test_queue_wait_is_measured(self):
+        self.client.services.rateLimiter = RateLimiter()
+        d = self.client.services.get('dfw1-db1')
+        d.addCallback(lambda _: self.assertTrue(
+            self.observed[0].queueWait >= 0))
+
+        return d
+
+    def test_failures_are_recorded(self):
+        def cbFailed(failure):
+            self.assertEqual(self.observed[0].error, 'ValueError')
+            self.assertEqual(
+                self.instrumentation.getStats()['GET /limits']['errors'], 1)
+
+        def fail(*args, **kwargs):
+            raise ValueError('boom')
+
+        self.client.agent.request = fail
+        d = self.client.account.getLimits()
+        d.addCallbacks(lambda _: self.fail('Expected a failure'), cbFailed)
+
+        return d
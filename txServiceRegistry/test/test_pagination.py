@@ -0,0 +1,155 @@
+# Copyright 2012 Rackspace Hosting, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sys
+
+from twisted.internet.defer import Deferred, succeed
+from twisted.trial.unittest import TestCase
+
+from txServiceRegistry.pagination import PageIterator
+
+PAGES = {
+    None: {'values': [1, 2], 'metadata': {'next_marker': 'b'}},
+    'b': {'values': [3, 4], 'metadata': {'next_marker': 'c'}},
+    'c': {'values': [5], 'metadata': {'next_marker': None}}
+}
+
+
+class FakeEndpoint(object):
+    def __init__(self):
+        self.requests = []
+
+    def fetchPage(self, marker, limit):
+        d = Deferred()
+        self.requests.append((marker, limit, d))
+
+        return d
+
+    def respond(self, index=-1):
+        marker, limit, d = self.requests[index]
+        d.callback(PAGES[marker])
+
+
+class PageIteratorTests(TestCase):
+    def setUp(self):
+        self.endpoint = FakeEndpoint()
+
+    def test_pages_are_fetched_lazily(self):
+        iterator = PageIterator(self.endpoint.fetchPage, limit=2)
+        results = []
+
+        iterator.next().addCallback(results.append)
+        self.assertEqual(len(self.endpoint.requests), 1)
+        self.endpoint.respond()
+        self.assertEqual(results, [[1, 2]])
+        self.assertEqual(len(self.endpoint.requests), 1)
+
+        iterator.next().addCallback(results.append)
+        self.assertEqual(self.endpoint.requests[-1][:2], ('b', 2))
+        self.endpoint.respond()
+        iterator.next().addCallback(results.append)
+        self.endpoint.respond()
+        self.assertFalse(iterator.hasMore())
+
+        iterator.next().addCallback(results.append)
+        self.assertEqual(results, [[1, 2], [3, 4], [5], None])
+        self.assertEqual(len(self.endpoint.requests), 3)
+        self.assertEqual(iterator.pageCount, 3)
+
+    def test_prefetch_requests_next_page(self):
+        iterator = PageIterator(self.endpoint.fetchPage, prefetch=True)
+        results = []
+
+        iterator.next().addCallback(results.append)
+        self.endpoint.respond()
+        self.assertEqual(results, [[1, 2]])
+        # The second page is requested before the consumer asks for it, but
+        # only one page ahead.
+        self.assertEqual(len(self.endpoint.requests), 2)
+        self.endpoint.respond()
+        self.assertEqual(len(self.endpoint.requests), 2)
+
+        iterator.next().addCallback(results.append)
+        self.assertEqual(results, [[1, 2], [3, 4]])
+        self.assertEqual(self.endpoint.requests[-1][0], 'c')
+
+    def test_collect(self):
+        iterator = PageIterator(self.endpoint.fetchPage, prefetch=True)
+        results = []
+
+        iterator.collect().addCallback(results.append)
+
+        while not results:
+            self.endpoint.respond()
+
+        self.assertEqual(results, [[1, 2, 3, 4, 5]])
+
+    def test_forEach_waits_for_callback(self):
+        iterator = PageIterator(self.endpoint.fetchPage)
+        pending = []
+        count = []
+
+        def callback(value):
+            d = Deferred()
+            pending.append((value, d))
+
+            return d
+
+        iterator.forEach(callback).addCallback(count.append)
+        self.endpoint.respond()
+        self.assertEqual([value for value, d in pending], [1])
+
+        pending[0][1].callback(None)
+        pending[1][1].callback(None)
+        self.assertEqual(len(self.endpoint.requests), 2)
+
+    def test_errors_are_propagated(self):
+        iterator = PageIterator(self.endpoint.fetchPage)
+        d = iterator.collect()
+        self.endpoint.requests[0][2].errback(ValueError('boom'))
+
+        return self.assertFailure(d, ValueError)
+
+    def test_prefetch_failure_is_kept(self):
+        iterator = PageIterator(self.endpoint.fetchPage, prefetch=True)
+        iterator.next()
+        self.endpoint.respond()
+        # Nobody waits for the second page yet.
+        self.endpoint.requests[1][2].errback(ValueError('boom'))
+
+        return self.assertFailure(iterator.next(), ValueError)
+
+    def test_pending_prefetch_failure(self):
+        iterator = PageIterator(self.endpoint.fetchPage, prefetch=True)
+        iterator.next()
+        self.endpoint.respond()
+        d = iterator.next()
+        self.endpoint.requests[1][2].errback(ValueError('boom'))
+
+        return self.assertFailure(d, ValueError)
+
+    def test_synchronous_pages_dont_recurse(self):
+        pageCount = sys.getrecursionlimit() * 2
+
+        def fetchPage(marker, limit):
+            index = int(marker or 0) + 1
+            nextMarker = str(index) if index < pageCount else None
+
+            return succeed({'values': [index],
+                            'metadata': {'next_marker': nextMarker}})
+
+        iterator = PageIterator(fetchPage, prefetch=True)
+        results = []
+        iterator.collect().addCallback(results.append)
+        self.assertEqual(results, [range(1, pageCount + 1)])
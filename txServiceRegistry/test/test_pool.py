@@ -0,0 +1,114 @@
+# Copyright 2012 Rackspace Hosting, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import mock
+
+from twisted.internet.defer import succeed
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+
+from txServiceRegistry.client import Client
+from txServiceRegistry.pool import StatsHTTPConnectionPool
+
+KEY = ('https', 'dfw.registry.api.rackspacecloud.com', 443)
+
+
+class FakeConnection(object):
+    state = 'QUIESCENT'
+
+    def __init__(self):
+        self.transport = mock.Mock()
+
+
+class FakeEndpoint(object):
+    def connect(self, factory):
+        return succeed(FakeConnection())
+
+
+class StatsHTTPConnectionPoolTests(TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.pool = StatsHTTPConnectionPool(self.clock,
+                                            maxPersistentPerHost=1,
+                                            cachedConnectionTimeout=10,
+                                            retryAutomatically=False)
+        self.endpoint = FakeEndpoint()
+
+    def _getConnection(self):
+        result = []
+        self.pool.getConnection(KEY, self.endpoint).addCallback(result.append)
+
+        return result[0]
+
+    def test_options_are_applied(self):
+        self.assertEqual(self.pool.maxPersistentPerHost, 1)
+        self.assertEqual(self.pool.cachedConnectionTimeout, 10)
+        self.assertFalse(self.pool.retryAutomatically)
+
+    def test_cached_connection_is_reused(self):
+        connection = self._getConnection()
+        self.pool._putConnection(KEY, connection)
+        self.assertTrue(self._getConnection() is connection)
+
+        stats = self.pool.getStats()
+        self.assertEqual(stats['requests'], 2)
+        self.assertEqual(stats['created'], 1)
+        self.assertEqual(stats['reused'], 1)
+        self.assertEqual(stats['cached'], 0)
+
+    def test_idle_connection_is_evicted(self):
+        connection = self._getConnection()
+        self.pool._putConnection(KEY, connection)
+        self.assertEqual(self.pool.getStats()['cached'], 1)
+
+        self.clock.advance(10)
+        stats = self.pool.getStats()
+        self.assertEqual(stats['evicted'], 1)
+        self.assertEqual(stats['cached'], 0)
+        connection.transport.loseConnection.assert_called_with()
+
+    def test_connections_over_per_host_limit_are_dropped(self):
+        first = self._getConnection()
+        second = self._getConnection()
+        self.pool._putConnection(KEY, first)
+        self.pool._putConnection(KEY, second)
+
+        stats = self.pool.getStats()
+        self.assertEqual(stats['dropped'], 1)
+        self.assertEqual(stats['cached'], 1)
+
+
+class ClientPoolTests(TestCase):
+    def test_client_creates_configured_pool(self):
+        client = Client('user', 'api_key', maxPersistentPerHost=50,
+                        cachedConnectionTimeout=60, retryAutomatically=False)
+        self.assertTrue(isinstance(client.pool, StatsHTTPConnectionPool))
+        self.assertEqual(client.pool.maxPersistentPerHost, 50)
+        self.assertEqual(client.pool.cachedConnectionTimeout, 60)
+        self.assertFalse(client.pool.retryAutomatically)
+        self.assertEqual(client.getPoolStats()['requests'], 0)
+
+    def test_sub_clients_share_the_pool(self):
+        client = Client('user', 'api_key')
+        agent = client.agent.agent
+        self.assertTrue(agent._pool is client.pool)
+
+        for subClient in (client.events, client.services,
+                          client.configuration, client.account):
+            self.assertTrue(subClient.agent is client.agent)
+
+    def test_pool_is_not_created_when_agent_is_passed(self):
+        client = Client('user', 'api_key', agent=mock.Mock())
+        self.assertEqual(client.pool, None)
+        self.assertEqual(client.getPoolStats(), None)
@@ -0,0 +1,131 @@
+# Copyright 2012 Rackspace Hosting, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import mock
+
+from twisted.internet.defer import succeed
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+
+from txServiceRegistry.client import Client
+from txServiceRegistry.ratelimit import RateLimiter, parseWindow, \
+    getPriority, PRIORITY_HEARTBEAT, PRIORITY_DEFAULT, PRIORITY_LIST
+
+LIMITS = {'rate': {'/.*': {'window': '24.0 hours', 'used': 0,
+                           'limit': 86400}},
+          'resource': {}}
+
+
+class RateLimitHelpersTests(TestCase):
+    def test_parseWindow(self):
+        self.assertEqual(parseWindow('24.0 hours'), 86400)
+        self.assertEqual(parseWindow('1 minute'), 60)
+        self.assertEqual(parseWindow('30 seconds'), 30)
+        self.assertRaises(ValueError, parseWindow, '3 fortnights')
+
+    def test_getPriority(self):
+        self.assertEqual(getPriority('POST', '/services/a/heartbeat'),
+                         PRIORITY_HEARTBEAT)
+        self.assertEqual(getPriority('GET', '/services/a'), PRIORITY_DEFAULT)
+        self.assertEqual(getPriority('PUT', '/services/a', None),
+                         PRIORITY_DEFAULT)
+        self.assertEqual(getPriority('GET', '/services', {}), PRIORITY_LIST)
+
+
+class RateLimiterTests(TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.limiter = RateLimiter(burst=2, clock=self.clock)
+        self.granted = []
+
+    def _acquire(self, name, priority=PRIORITY_DEFAULT):
+        self.limiter.acquire(priority).addCallback(
+            lambda _: self.granted.append(name))
+
+    def test_unlimited_until_seeded(self):
+        for i in range(10):
+            self._acquire(i)
+
+        self.assertEqual(len(self.granted), 10)
+
+    def test_requests_are_queued_not_failed(self):
+        self.limiter.setRate(1)
+
+        for name in 'abcd':
+            self._acquire(name)
+
+        self.assertEqual(self.granted, ['a', 'b'])
+        self.assertEqual(self.limiter.getQueueDepth(), 2)
+        self.clock.advance(1)
+        self.assertEqual(self.granted, ['a', 'b', 'c'])
+        self.clock.advance(1)
+        self.assertEqual(self.granted, ['a', 'b', 'c', 'd'])
+        self.assertEqual(self.limiter.getStats()['queued'], 2)
+
+    def test_queue_is_released_in_priority_order(self):
+        self.limiter.setRate(1, remaining=0)
+        self._acquire('list', PRIORITY_LIST)
+        self._acquire('get', PRIORITY_DEFAULT)
+        self._acquire('heartbeat', PRIORITY_HEARTBEAT)
+
+        self.clock.advance(1)
+        self.assertEqual(self.granted, ['heartbeat'])
+        self.clock.advance(1)
+        self.clock.advance(1)
+        self.assertEqual(self.granted, ['heartbeat', 'get', 'list'])
+
+    def test_seedFromLimits(self):
+        self.limiter.seedFromLimits(LIMITS)
+        self.assertEqual(self.limiter.rate, 1.0)
+
+        limits = {'rate': {'/.*': {'window': '1 hour', 'used': 3600,
+                                   'limit': 3600}}}
+        self.limiter.seedFromLimits(limits)
+        self._acquire('a')
+        self.assertEqual(self.granted, [])
+        self.clock.advance(1)
+        self.assertEqual(self.granted, ['a'])
+
+    def test_startRefreshing(self):
+        account = mock.Mock()
+        account.getLimits.side_effect = lambda: succeed(LIMITS)
+        self.limiter.startRefreshing(account, interval=60)
+        self.assertEqual(self.limiter.rate, 1.0)
+
+        self.clock.advance(60)
+        self.assertEqual(account.getLimits.call_count, 2)
+
+        self.limiter.stopRefreshing()
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+class ClientRateLimiterTests(TestCase):
+    def test_requests_wait_for_the_limiter(self):
+        clock = Clock()
+        limiter = RateLimiter(rate=1, burst=1, clock=clock)
+        agent = mock.Mock()
+        agent.request.side_effect = \
+            lambda *args, **kwargs: succeed(mock.Mock(code=204))
+        client = Client('user', 'api_key', agent=agent, rateLimiter=limiter)
+        client.agent._getAuthHeaders = \
+            lambda: succeed({'X-Auth-Token': 'authToken',
+                             'X-Tenant-Id': 'tenantId'})
+
+        client.configuration.remove('a')
+        client.services.remove('b')
+        self.assertEqual(agent.request.call_count, 1)
+        self.assertTrue(client.services.rateLimiter is limiter)
+
+        clock.advance(1)
+        self.assertEqual(agent.request.call_count, 2)
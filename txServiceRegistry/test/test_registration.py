@@ -0,0 +1,243 @@
+# Copyright 2012 Rackspace Hosting, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, succeed
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+from twisted.web.client import Agent
+
+from txServiceRegistry.client import Client, HeartBeater
+from txServiceRegistry.registration import BulkRegistration, \
+    ServiceRegistration, RetryStrategy, RegistrationError, \
+    isServiceExistsError
+from txServiceRegistry.test.test_events import FakeEventsClient
+
+SERVICE_EXISTS = {'type': 'serviceWithThisIdExists', 'code': 409,
+                  'message': 'Service with this id already exists'}
+
+
+class FakeServicesClient(object):
+    def __init__(self):
+        self.requests = []
+
+    def create(self, serviceId, heartbeatTimeout, payload=None):
+        d = Deferred()
+        self.requests.append((serviceId, heartbeatTimeout, payload, d))
+
+        return d
+
+    def respond(self, serviceId, result):
+        for index, request in enumerate(self.requests):
+            if request[0] == serviceId:
+                del self.requests[index]
+                request[3].callback(result)
+                return
+
+        raise KeyError(serviceId)
+
+    def getRequested(self):
+        return [request[0] for request in self.requests]
+
+
+class BulkRegistrationTests(TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.client = FakeServicesClient()
+        self.results = []
+
+    def _register(self, services, timeout=30, retryDelay=2, maxParallel=2):
+        registration = BulkRegistration(self.client, services, timeout,
+                                        retryDelay, maxParallel,
+                                        clock=self.clock)
+        registration.run().addCallback(self.results.append)
+
+        return registration
+
+    def test_isServiceExistsError(self):
+        self.assertTrue(isServiceExistsError(SERVICE_EXISTS))
+        self.assertFalse(isServiceExistsError({'type': 'validationError'}))
+        self.assertFalse(isServiceExistsError(({'token': 't'}, None)))
+
+    def test_parallelism_is_bounded(self):
+        self._register([('a', 30), ('b', 30, {'tags': ['db']}), ('c', 30)])
+        self.assertEqual(self.client.getRequested(), ['a', 'b'])
+        self.assertEqual(self.client.requests[1][2], {'tags': ['db']})
+
+        self.client.respond('a', ({'token': 'a'}, 'heartbeater-a'))
+        self.assertEqual(self.client.getRequested(), ['b', 'c'])
+
+        self.client.respond('b', ({'token': 'b'}, 'heartbeater-b'))
+        self.client.respond('c', {'type': 'validationError'})
+        self.assertEqual(self.results, [{
+            'a': (True, ({'token': 'a'}, 'heartbeater-a')),
+            'b': (True, ({'token': 'b'}, 'heartbeater-b')),
+            'c': (False, {'type': 'validationError'})}])
+
+    def test_existing_services_are_retried_on_one_timer(self):
+        registration = self._register([('a', 30), ('b', 30), ('c', 30)],
+                                      maxParallel=10)
+        self.client.respond('a', SERVICE_EXISTS)
+        self.clock.advance(1)
+        self.client.respond('b', SERVICE_EXISTS)
+        self.client.respond('c', ({'token': 'c'}, None))
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+
+        self.clock.advance(1)
+        self.assertEqual(self.client.getRequested(), ['a', 'b'])
+        self.assertEqual(registration.getStats()['retries'], 2)
+
+        self.client.respond('a', ({'token': 'a'}, None))
+        self.client.respond('b', ({'token': 'b'}, None))
+        self.assertEqual(sorted(self.results[0].keys()), ['a', 'b', 'c'])
+
+    def test_retries_stop_after_timeout(self):
+        self._register([('a', 30)], timeout=5)
+
+        for i in range(3):
+            self.client.respond('a', SERVICE_EXISTS)
+            self.clock.advance(2)
+
+        self.assertEqual(self.client.requests, [])
+        self.assertEqual(self.results, [{'a': (False, SERVICE_EXISTS)}])
+
+    def test_failures_are_reported(self):
+        self._register([('a', 30)])
+        self.client.requests[0][3].errback(ValueError('boom'))
+        success, failure = self.results[0]['a']
+        self.assertFalse(success)
+        self.assertTrue(failure.check(ValueError))
+
+    def test_no_retries_without_retryDelay(self):
+        self._register([('a', 30)], retryDelay=None)
+        self.client.respond('a', SERVICE_EXISTS)
+        self.assertEqual(self.results, [{'a': (False, SERVICE_EXISTS)}])
+
+    def test_empty(self):
+        self._register([])
+        self.assertEqual(self.results, [{}])
+
+
+class RetryStrategyTests(TestCase):
+    def test_exponential_backoff(self):
+        strategy = RetryStrategy(initialDelay=1, maxDelay=8, jitter=0)
+        self.assertEqual([strategy.getDelay(i) for i in range(5)],
+                         [1, 2, 4, 8, 8])
+
+    def test_jitter(self):
+        strategy = RetryStrategy(initialDelay=4, jitter=0.5,
+                                 random=lambda: 0.5)
+        self.assertEqual(strategy.getDelay(0), 3)
+
+    def test_deadline(self):
+        strategy = RetryStrategy(initialDelay=4, jitter=0, timeout=10)
+        self.assertEqual(strategy.getNextDelay(0, 0), 4)
+        self.assertEqual(strategy.getNextDelay(1, 4), 6)
+        self.assertEqual(strategy.getNextDelay(2, 10), None)
+
+
+class ServiceRegistrationTests(TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.client = FakeServicesClient()
+        self.results = []
+        self.strategy = RetryStrategy(initialDelay=1, maxDelay=4, jitter=0,
+                                      timeout=10)
+
+    def _register(self, eventsClient=None):
+        registration = ServiceRegistration(self.client, 'a', 30,
+                                           retryStrategy=self.strategy,
+                                           eventsClient=eventsClient,
+                                           pollInterval=0.5,
+                                           clock=self.clock)
+        registration.run().addBoth(self.results.append)
+
+        return registration
+
+    def test_retries_back_off(self):
+        registration = self._register()
+        times = []
+
+        while not self.results:
+            times.append(self.clock.seconds())
+            self.client.respond('a', SERVICE_EXISTS)
+
+            if self.clock.getDelayedCalls():
+                self.clock.advance(self.clock.getDelayedCalls()[0].getTime() -
+                                   self.clock.seconds())
+
+        self.assertEqual(times, [0, 1, 3, 7, 10])
+        self.assertEqual(registration.attempts, 5)
+        self.assertTrue(self.results[0].check(RegistrationError))
+        self.assertEqual(self.results[0].value.response, SERVICE_EXISTS)
+
+    def test_success(self):
+        self._register()
+        self.client.respond('a', SERVICE_EXISTS)
+        self.clock.advance(1)
+        self.client.respond('a', ({'token': 'a'}, 'heartbeater'))
+        self.assertEqual(self.results, [({'token': 'a'}, 'heartbeater')])
+
+    def test_other_errors_are_not_retried(self):
+        self._register()
+        self.client.respond('a', {'type': 'validationError'})
+        self.assertTrue(self.results[0].check(RegistrationError))
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_event_wakes_up_retry(self):
+        eventsClient = FakeEventsClient([{'id': '1', 'type': 'service.join',
+                                          'payload': {'id': 'b'}}])
+        registration = self._register(eventsClient)
+        self.client.respond('a', SERVICE_EXISTS)
+        self.clock.advance(1)
+        self.client.respond('a', SERVICE_EXISTS)
+        self.assertEqual(self.client.requests, [])
+
+        eventsClient.events.append({'id': '2', 'type': 'service.timeout',
+                                    'payload': {'id': 'b'}})
+        eventsClient.events.append({'id': '3', 'type': 'service.timeout',
+                                    'payload': {'id': 'a'}})
+        # The next poll happens before the 2 second retry.
+        self.clock.advance(0.5)
+        self.assertEqual(self.client.getRequested(), ['a'])
+        self.assertEqual(registration.earlyWakes, 1)
+
+        self.client.respond('a', ({'token': 'a'}, 'heartbeater'))
+        self.assertEqual(len(self.results), 1)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+class ClientBulkRegistrationTests(TestCase):
+    def setUp(self):
+        self.client = Client('user', 'api_key', 'us',
+                             'http://127.0.0.1:8881/', Agent(reactor))
+        self.client.agent._getAuthHeaders = \
+            lambda: succeed({'X-Auth-Token': 'authToken',
+                             'X-Tenant-Id': 'tenantId'})
+
+    def test_registerMany(self):
+        def cbRegistered(results):
+            self.assertEqual(sorted(results.keys()), ['dfw1-api', 'dfw1-db1'])
+
+            for serviceId, (success, result) in results.iteritems():
+                self.assertTrue(success)
+                self.assertTrue(isinstance(result[1], HeartBeater))
+                self.assertEqual(result[1].serviceId, serviceId)
+                self.assertEqual(result[1].nextToken, result[0]['token'])
+
+        d = self.client.services.registerMany([('dfw1-db1', 15),
+                                               ('dfw1-api', 30, {})])
+        d.addCallback(cbRegistered)
+
+        return d
@@ -0,0 +1,121 @@
+# Copyright 2012 Rackspace Hosting, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from twisted.internet.defer import Deferred
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+
+from txServiceRegistry.catalog import ServiceCatalog
+from txServiceRegistry.resolver import LeastOutstandingStrategy, \
+    NoEndpointsError, PowerOfTwoChoicesStrategy, getEndpoint
+from txServiceRegistry.test.test_catalog import FakeServicesClient
+from txServiceRegistry.test.test_events import FakeEventsClient
+
+
+def service(serviceId, ip='10.0.0.1', port='3306', region='dfw'):
+    return {'id': serviceId, 'tags': ['db'],
+            'metadata': {'ip': ip, 'port': port, 'region': region}}
+
+
+SERVICES = [service('db1', '10.0.0.1'), service('db2', '10.0.0.2'),
+            service('db3', '10.1.0.3', region='ord'),
+            {'id': 'api', 'tags': ['api'], 'metadata': {}}]
+
+
+class ResolverTests(TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.events = FakeEventsClient()
+        self.catalog = ServiceCatalog(FakeServicesClient(SERVICES),
+                                      self.events, pollInterval=5,
+                                      clock=self.clock)
+        self.catalog.start()
+        self.addCleanup(self.catalog.stop)
+
+    def _resolve(self, resolver, count):
+        return [resolver.resolve().serviceId for i in range(count)]
+
+    def test_getEndpoint(self):
+        endpoint = getEndpoint(SERVICES[0])
+        self.assertEqual((endpoint.host, endpoint.port, endpoint.region),
+                         ('10.0.0.1', 3306, 'dfw'))
+        self.assertEqual(getEndpoint(SERVICES[3]), None)
+        self.assertEqual(getEndpoint(service('x', port='http')), None)
+
+    def test_round_robin(self):
+        resolver = self.catalog.createResolver('db')
+        self.assertEqual(self._resolve(resolver, 4),
+                         ['db1', 'db2', 'db3', 'db1'])
+
+    def test_no_endpoints(self):
+        resolver = self.catalog.createResolver('api')
+        self.assertRaises(NoEndpointsError, resolver.resolve)
+
+        return self.assertFailure(resolver.run(lambda endpoint: None),
+                                  NoEndpointsError)
+
+    def test_region_affinity(self):
+        resolver = self.catalog.createResolver('db', region='ord')
+        self.assertEqual(self._resolve(resolver, 2), ['db3', 'db3'])
+
+        self.catalog.handleEvent({'type': 'service.remove',
+                                  'payload': {'id': 'db3'}})
+        # Other regions are used when the preferred one has no endpoints.
+        self.assertEqual(self._resolve(resolver, 2), ['db1', 'db2'])
+
+    def test_endpoints_follow_the_catalog(self):
+        resolver = self.catalog.createResolver('db')
+        endpoints = resolver.getEndpoints()
+        self.assertTrue(resolver.getEndpoints() is endpoints)
+
+        self.events.events.append({'id': '1', 'type': 'service.join',
+                                   'payload': service('db4', '10.0.0.4')})
+        self.clock.advance(5)
+        self.assertEqual([e.serviceId for e in resolver.getEndpoints()],
+                         ['db1', 'db2', 'db3', 'db4'])
+        # Unchanged endpoints are kept, with their counters.
+        self.assertTrue(resolver.getEndpoints()[0] is endpoints[0])
+
+    def test_least_outstanding(self):
+        resolver = self.catalog.createResolver(
+            'db', strategy=LeastOutstandingStrategy())
+        requests = []
+
+        def request(endpoint):
+            d = Deferred()
+            requests.append((endpoint.serviceId, d))
+
+            return d
+
+        for i in range(4):
+            resolver.run(request)
+
+        self.assertEqual([serviceId for serviceId, d in requests],
+                         ['db1', 'db2', 'db3', 'db1'])
+
+        requests[1][1].callback(None)
+        resolver.run(request)
+        self.assertEqual(requests[-1][0], 'db2')
+        self.assertEqual(resolver.getStats()['db1'],
+                         {'requests': 2, 'outstanding': 2})
+
+    def test_power_of_two_choices(self):
+        randoms = [0.0, 0.0, 0.0, 0.99]
+        strategy = PowerOfTwoChoicesStrategy(random=lambda: randoms.pop(0))
+        resolver = self.catalog.createResolver('db', strategy=strategy)
+        first = resolver.acquire()
+        self.assertEqual(first.serviceId, 'db1')
+
+        # db1 and db3 are compared, db1 is busy.
+        self.assertEqual(resolver.acquire().serviceId, 'db3')
@@ -0,0 +1,117 @@
+# Copyright 2012 Rackspace Hosting, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+
+from twisted.internet import reactor
+from twisted.internet.defer import succeed
+from twisted.trial.unittest import TestCase
+from twisted.web.client import Agent
+
+from txServiceRegistry.client import Client
+from txServiceRegistry.serialization import EncodedBody, HeartbeatTemplate, \
+    JSONCodec
+
+TOKEN = '6bc8d050-f86a-11e1-a89e-ca2ffe480b20'
+
+
+class CountingCodec(JSONCodec):
+    def __init__(self):
+        JSONCodec.__init__(self, self._dumps, self._loads)
+        self.encoded = []
+        self.decoded = 0
+
+    def _dumps(self, value):
+        self.encoded.append(value)
+
+        return json.dumps(value)
+
+    def _loads(self, value):
+        self.decoded += 1
+
+        return json.loads(value)
+
+
+class HeartbeatTemplateTests(TestCase):
+    def setUp(self):
+        self.codec = CountingCodec()
+        self.template = HeartbeatTemplate('/services/a/heartbeat',
+                                          self.codec)
+
+    def test_render_plain_token(self):
+        body = self.template.render(unicode(TOKEN))
+        self.assertTrue(isinstance(body, str))
+        self.assertEqual(json.loads(body), {'token': TOKEN})
+        # Plain tokens don't go through the encoder.
+        self.assertEqual(self.codec.encoded, [])
+
+    def test_render_escapes_other_tokens(self):
+        for token in ['a"b', u'caf\xe9', 'a\\b', None]:
+            self.assertEqual(json.loads(self.template.render(token)),
+                             {'token': token})
+
+        self.assertEqual(len(self.codec.encoded), 4)
+
+    def test_renderBody(self):
+        body = self.template.renderBody(TOKEN)
+        self.assertTrue(isinstance(body, EncodedBody))
+        self.assertEqual(body.data, self.template.render(TOKEN))
+
+
+class ClientCodecTests(TestCase):
+    def setUp(self):
+        self.codec = CountingCodec()
+        self.client = Client('user', 'api_key', 'us',
+                             'http://127.0.0.1:8881/', Agent(reactor),
+                             codec=self.codec)
+        self.client.agent._getAuthHeaders = \
+            lambda: succeed({'X-Auth-Token': 'authToken',
+                             'X-Tenant-Id': 'tenantId'})
+
+    def test_codec_is_shared(self):
+        self.assertTrue(self.client.services.codec is self.codec)
+        self.assertTrue(self.client.configuration.codec is self.codec)
+
+    def test_codec_encodes_and_decodes(self):
+        def cbCreated(result):
+            self.assertEqual(result[1].codec, self.codec)
+            self.assertEqual(self.codec.encoded[0]['id'], 'dfw1-db1')
+            self.assertEqual(self.codec.decoded, 1)
+
+        d = self.client.services.create('dfw1-db1', 30)
+        d.addCallback(cbCreated)
+
+        return d
+
+    def test_heartbeat_with_template(self):
+        template = self.client.services.getHeartbeatTemplate('dfw1-db1')
+        self.assertEqual(template.path, '/services/dfw1-db1/heartbeat')
+
+        def cbHeartbeat(result):
+            self.assertEqual(result['token'], TOKEN)
+            self.assertEqual(self.codec.encoded, [])
+
+        d = self.client.services.heartbeat('dfw1-db1', TOKEN, template)
+        d.addCallback(cbHeartbeat)
+
+        return d
+
+    def test_string_payloads_are_encoded(self):
+        # Only EncodedBody payloads are sent as they are.
+        d = self.client.configuration.request('PUT', '/configuration/configId',
+                                              payload='value')
+        d.addCallback(lambda _: self.assertEqual(self.codec.encoded,
+                                                 ['value']))
+
+        return d
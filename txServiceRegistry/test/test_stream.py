@@ -0,0 +1,94 @@
+# Copyright 2012 Rackspace Hosting, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+try:
+    import simplejson as json
+except:
+    import json
+
+from twisted.trial.unittest import TestCase
+
+from txServiceRegistry.utils import ValuesStreamDecoder
+
+FIXTURES_DIR = os.path.join(os.path.dirname(__file__), 'fixtures',
+                            'response')
+
+
+def readFixture(name):
+    with open(os.path.join(FIXTURES_DIR, name), 'r') as f:
+        return f.read()
+
+
+class ValuesStreamDecoderTests(TestCase):
+    def _decode(self, body, chunkSize):
+        values = []
+        decoder = ValuesStreamDecoder(values.append)
+
+        for i in range(0, len(body), chunkSize):
+            decoder.feed(body[i:i + chunkSize])
+
+        return values, decoder.finish()
+
+    def test_values_match_json_load(self):
+        for name in ['services-get.json', 'events-get.json',
+                     'configuration-get.json']:
+            body = readFixture(name)
+            expected = json.loads(body)
+
+            for chunkSize in [1, 3, 7, len(body)]:
+                values, envelope = self._decode(body, chunkSize)
+                self.assertEqual(values, expected['values'])
+                self.assertEqual(envelope['values'], [])
+                self.assertEqual(envelope['metadata'], expected['metadata'])
+
+    def test_values_are_delivered_before_body_is_complete(self):
+        values = []
+        decoder = ValuesStreamDecoder(values.append)
+        decoder.feed('{"values": [{"id": "a"}, {"id"')
+        self.assertEqual(values, [{'id': 'a'}])
+        decoder.feed(': "b"}], "metadata": {"count": 2}}')
+        self.assertEqual(values, [{'id': 'a'}, {'id': 'b'}])
+        self.assertEqual(decoder.count, 2)
+        self.assertEqual(decoder.finish(),
+                         {'values': [], 'metadata': {'count': 2}})
+
+    def test_strings_with_special_characters(self):
+        body = json.dumps({'metadata': {'note': 'values: [1, 2]'},
+                           'values': [{'id': 'a\\"],{'},
+                                      {'id': '\\\\'}]})
+
+        for chunkSize in [1, 2, len(body)]:
+            values, envelope = self._decode(body, chunkSize)
+            self.assertEqual(values, [{'id': 'a\\"],{'}, {'id': '\\\\'}])
+            self.assertEqual(envelope['metadata'],
+                             {'note': 'values: [1, 2]'})
+
+    def test_only_top_level_values_are_streamed(self):
+        body = '{"metadata": {"values": [1]}, "values": [[1, 2], 3]}'
+        values, envelope = self._decode(body, 4)
+        self.assertEqual(values, [[1, 2], 3])
+        self.assertEqual(envelope, {'metadata': {'values': [1]},
+                                    'values': []})
+
+    def test_body_without_values_is_returned_whole(self):
+        body = readFixture('services-dfw1-db1-get.json')
+        values, envelope = self._decode(body, 5)
+        self.assertEqual(values, [])
+        self.assertEqual(envelope, json.loads(body))
+
+    def test_truncated_body_raises(self):
+        decoder = ValuesStreamDecoder(lambda value: None)
+        decoder.feed('{"values": [{"id": "a"}')
+        self.assertRaises(ValueError, decoder.finish)
@@ -0,0 +1,160 @@
+# Copyright 2012 Rackspace Hosting, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from twisted.internet import reactor
+from twisted.internet.defer import succeed
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+from twisted.web.client import Agent
+
+from txServiceRegistry.client import Client
+from txServiceRegistry.pagination import PageIterator
+from txServiceRegistry.test.test_events import FakeEventsClient
+from txServiceRegistry.watcher import ConfigurationWatcher
+
+
+def update(eventId, configurationId, newValue):
+    return {'id': eventId, 'type': 'configuration_value.update',
+            'payload': {'configuration_value_id': configurationId,
+                        'old_value': None, 'new_value': newValue}}
+
+
+def remove(eventId, configurationId):
+    return {'id': eventId, 'type': 'configuration_value.remove',
+            'payload': {'configuration_value_id': configurationId}}
+
+
+class FakeConfigurationClient(object):
+    def __init__(self, values):
+        self.values = values
+        self.listCalls = []
+
+    def list(self, marker=None, limit=None, namespace=None):
+        self.listCalls.append(namespace)
+        values = [{'id': key, 'value': value}
+                  for key, value in sorted(self.values.items())]
+
+        return succeed({'values': values,
+                        'metadata': {'next_marker': None}})
+
+    def iterAll(self, marker=None, limit=None, prefetch=False):
+        return PageIterator(self.list, marker, limit, prefetch)
+
+    def iterAllForNamespace(self, namespace, marker=None, limit=None,
+                            prefetch=False):
+        def listFunction(marker, limit):
+            return self.list(marker, limit, namespace)
+
+        return PageIterator(listFunction, marker, limit, prefetch)
+
+
+class ConfigurationWatcherTests(TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.configuration = FakeConfigurationClient(
+            {'/api/flag': 'on', '/api/limit': '10', '/db/host': 'db1'})
+        self.events = FakeEventsClient([update('1', '/api/old', 'x')])
+        self.changes = []
+        self.watcher = ConfigurationWatcher(self.configuration, self.events,
+                                            namespace='api', pollInterval=5,
+                                            refreshInterval=60,
+                                            clock=self.clock)
+        self.watcher.start()
+        self.addCleanup(self.watcher.stop)
+        self.watcher.addObserver(
+            lambda *change: self.changes.append(change))
+
+    def test_start_loads_namespace(self):
+        self.assertEqual(self.watcher.getValues(),
+                         {'/api/flag': 'on', '/api/limit': '10'})
+        self.assertEqual(self.configuration.listCalls, ['api'])
+        self.assertEqual(self.watcher.get('/api/flag'), 'on')
+        self.assertEqual(self.watcher.get('/api/missing', 'off'), 'off')
+        self.assertFalse('/api/old' in self.watcher)
+
+    def test_events_update_snapshot(self):
+        self.events.events.extend([
+            update('2', '/api/flag', 'off'),
+            update('3', '/db/host', 'db2'),
+            remove('4', '/api/limit'),
+            update('5', '/api/new', 'yes'),
+            {'id': '6', 'type': 'service.join', 'payload': {'id': 'a'}}])
+        self.clock.advance(5)
+
+        self.assertEqual(self.watcher.getValues(),
+                         {'/api/flag': 'off', '/api/new': 'yes'})
+        self.assertEqual(self.changes,
+                         [('/api/flag', 'on', 'off'),
+                          ('/api/limit', '10', None),
+                          ('/api/new', None, 'yes')])
+        self.assertEqual(len(self.configuration.listCalls), 1)
+
+    def test_unchanged_values_are_not_notified(self):
+        self.watcher.handleEvent(update('2', '/api/flag', 'on'))
+        self.assertEqual(self.changes, [])
+
+    def test_refresh_notifies_missed_changes(self):
+        self.configuration.values = {'/api/flag': 'off', '/api/other': '1'}
+        self.clock.advance(60)
+
+        self.assertEqual(len(self.configuration.listCalls), 2)
+        self.assertEqual(sorted(self.changes),
+                         [('/api/flag', 'on', 'off'),
+                          ('/api/limit', '10', None),
+                          ('/api/other', None, '1')])
+
+    def test_observer_errors_are_logged(self):
+        def failing(*change):
+            raise ValueError('boom')
+
+        self.watcher.addObserver(failing)
+        self.watcher.handleEvent(update('2', '/api/flag', 'off'))
+        self.assertEqual(len(self.flushLoggedErrors(ValueError)), 1)
+        self.assertEqual(len(self.changes), 1)
+
+        self.watcher.removeObserver(failing)
+        self.watcher.handleEvent(update('3', '/api/flag', 'on'))
+        self.assertEqual(self.flushLoggedErrors(ValueError), [])
+
+    def test_stop_cancels_refresh(self):
+        self.watcher.stop()
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_staleness(self):
+        self.assertFalse(self.watcher.isStale())
+        self.events.error = ValueError('boom')
+        self.clock.advance(20)
+        self.flushLoggedErrors(ValueError)
+        self.assertTrue(self.watcher.isStale())
+
+
+class ClientConfigurationWatcherTests(TestCase):
+    def test_createConfigurationWatcher(self):
+        client = Client('user', 'api_key', 'us', 'http://127.0.0.1:8881/',
+                        Agent(reactor))
+        client.agent._getAuthHeaders = \
+            lambda: succeed({'X-Auth-Token': 'authToken',
+                             'X-Tenant-Id': 'tenantId'})
+        watcher = client.createConfigurationWatcher('/api/',
+                                                    pollInterval=60)
+        self.addCleanup(watcher.stop)
+
+        def cbStarted(result):
+            self.assertEqual(result, 2)
+            self.assertEqual(watcher.get('/api/key-2'), 'test value 23456')
+
+        d = watcher.start()
+        d.addCallback(cbStarted)
+
+        return d
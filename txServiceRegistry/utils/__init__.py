@@ -12,6 +12,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from utils import StringProducer
+from utils import StringProducer, ResponseDiscarder, discardResponse
+from stream import ValuesStreamDecoder
 
-__all__ = ['StringProducer']
+__all__ = ['StringProducer', 'ResponseDiscarder', 'discardResponse',
+           'ValuesStreamDecoder']
@@ -0,0 +1,144 @@
+# Copyright 2012 Rackspace Hosting, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import re
+try:
+    import simplejson as json
+except:
+    import json
+
+# Characters which can change the nesting level or string state of a JSON
+# document. Everything in between is copied without being looked at.
+SPECIAL_CHARACTERS = re.compile(r'[\[\]{},"\\]')
+
+ENVELOPE = 0
+VALUES = 1
+
+
+class ValuesStreamDecoder(object):
+    """
+    Incrementally decodes a paginated API response body.
+
+    Every entry of the top level "values" array is decoded as soon as its
+    last byte has been fed and is passed to valueCallback. Only the entry
+    which is currently being received is buffered, so peak memory is bounded
+    by the size of a single entry instead of the whole page.
+
+    Everything outside of the "values" array (the envelope, e.g. "metadata")
+    is buffered and decoded by finish(), which returns the envelope with an
+    empty "values" list.
+    """
+    def __init__(self, valueCallback, key='values', decode=json.loads):
+        """
+        @param valueCallback: Called with every decoded entry.
+        @type valueCallback: C{callable}
+        @param key: Name of the top level array which is streamed.
+        @type key: C{str}
+        @param decode: Function used to decode a single entry and the
+        envelope.
+        @type decode: C{callable}
+        """
+        self.valueCallback = valueCallback
+        self.decode = decode
+        self.count = 0
+        self._keyPattern = re.compile(r'"%s"\s*:\s*$' % (re.escape(key)))
+        self._envelope = []
+        self._entry = []
+        self._mode = ENVELOPE
+        self._depth = 0
+        self._inString = False
+        self._escapeNext = False
+        self._streamed = False
+
+    def feed(self, data):
+        """
+        Feed the next chunk of the response body.
+
+        @param data: Response body bytes.
+        @type data: C{str}
+        """
+        start = 0
+        skip = 0 if self._escapeNext else -1
+        self._escapeNext = False
+
+        for match in SPECIAL_CHARACTERS.finditer(data):
+            position = match.start()
+
+            if position == skip:
+                continue
+
+            character = data[position]
+
+            if self._inString:
+                if character == '"':
+                    self._inString = False
+                elif character == '\\':
+                    skip = position + 1
+
+                    if skip == len(data):
+                        self._escapeNext = True
+            elif character == '"':
+                self._inString = True
+            elif character in '{[':
+                if (character == '[' and self._mode == ENVELOPE and
+                        self._depth == 1 and not self._streamed and
+                        self._isValuesKey(data[start:position])):
+                    self._envelope.append(data[start:position + 1])
+                    start = position + 1
+                    self._mode = VALUES
+                    self._streamed = True
+
+                self._depth += 1
+            elif character in '}]':
+                if self._mode == VALUES and self._depth == 2:
+                    self._entry.append(data[start:position])
+                    self._emitEntry()
+                    start = position
+                    self._mode = ENVELOPE
+
+                self._depth -= 1
+            elif character == ',':
+                if self._mode == VALUES and self._depth == 2:
+                    self._entry.append(data[start:position])
+                    self._emitEntry()
+                    start = position + 1
+
+        if self._mode == VALUES:
+            self._entry.append(data[start:])
+        else:
+            self._envelope.append(data[start:])
+
+    def finish(self):
+        """
+        Decode and return the envelope once the whole body has been fed.
+
+        @return: The decoded envelope with an empty "values" list.
+        @rtype: C{dict}
+        """
+        if self._depth != 0 or self._inString:
+            raise ValueError('Response body is truncated')
+
+        return self.decode(''.join(self._envelope))
+
+    def _isValuesKey(self, pending):
+        return self._keyPattern.search(''.join(self._envelope) + pending)
+
+    def _emitEntry(self):
+        text = ''.join(self._entry).strip()
+        self._entry = []
+
+        if text:
+            value = self.decode(text)
+            self.count += 1
+            self.valueCallback(value)
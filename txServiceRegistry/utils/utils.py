@@ -13,6 +13,7 @@
 # limitations under the License.
 
 from twisted.internet.defer import succeed
+from twisted.internet.protocol import Protocol
 from twisted.web.iweb import IBodyProducer
 from zope.interface import implements
 
@@ -33,3 +34,30 @@ class StringProducer(object):
 
     def stopProducing(self):
         pass
+
+
+class ResponseDiscarder(Protocol):
+    """
+    Reads and drops the body of a response which isn't used, so its
+    connection can go back to the pool. If abort is True, the connection is
+    closed instead.
+    """
+    def __init__(self, abort=False):
+        self.abort = abort
+
+    def connectionMade(self):
+        if self.abort:
+            self.transport.stopProducing()
+
+    def dataReceived(self, data):
+        pass
+
+    def connectionLost(self, reason):
+        pass
+
+
+def discardResponse(response, abort=False):
+    """
+    Drop the body of a response, see L{ResponseDiscarder}.
+    """
+    response.deliverBody(ResponseDiscarder(abort))
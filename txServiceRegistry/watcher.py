@@ -0,0 +1,260 @@
+# Copyright 2012 Rackspace Hosting, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from twisted.internet import reactor
+from twisted.python import log
+
+from events import EventsTailer, DEFAULT_POLL_INTERVAL
+
+CONFIGURATION_VALUE_UPDATE = 'configuration_value.update'
+CONFIGURATION_VALUE_REMOVE = 'configuration_value.remove'
+
+# Events can be missed (e.g. when they're trimmed from the feed while the
+# feed can't be reached), so the snapshot is also reloaded every so often.
+DEFAULT_REFRESH_INTERVAL = 300
+
+
+class ConfigurationWatcher(object):
+    """
+    An in-memory snapshot of the configuration values, or of the values in
+    one namespace, which is kept current from the events feed.
+
+    Reads are dictionary lookups. Observers are called with
+    (configurationId, oldValue, newValue) for every value which changes,
+    newValue being None if the value has been removed. The snapshot is also
+    reloaded every refreshInterval seconds, and observers are called for
+    whatever changed since the last one.
+    """
+    def __init__(self, configurationClient, eventsClient, namespace=None,
+                 pollInterval=DEFAULT_POLL_INTERVAL,
+                 refreshInterval=DEFAULT_REFRESH_INTERVAL, maxStaleness=None,
+                 pageLimit=None, clock=None):
+        """
+        @param configurationClient: Client used to load the snapshot.
+        @type configurationClient: L{ConfigurationClient}
+        @param eventsClient: Client used to tail the events feed.
+        @type eventsClient: L{EventsClient}
+        @param namespace: Optional namespace to watch, e.g. '/api/'. All the
+        configuration values are watched by default.
+        @type namespace: C{str}
+        @param pollInterval: Number of seconds between two events polls.
+        @type pollInterval: C{float}
+        @param refreshInterval: Number of seconds between two reloads of the
+        snapshot, or None to only load it once.
+        @type refreshInterval: C{float}
+        @param maxStaleness: Number of seconds without a successful sync
+        after which the snapshot is considered stale. Defaults to three poll
+        intervals.
+        @type maxStaleness: C{float}
+        @param pageLimit: Page size used to load the snapshot.
+        @type pageLimit: C{int}
+        @param clock: Provider of IReactorTime, defaults to the reactor.
+        """
+        self.configurationClient = configurationClient
+        self.namespace = namespace
+        self.refreshInterval = refreshInterval
+        self.maxStaleness = maxStaleness or pollInterval * 3
+        self.pageLimit = pageLimit
+        self.lastSnapshotTime = None
+        self._clock = clock or reactor
+        self._values = {}
+        self._observers = []
+        self._refreshId = None
+        self._running = False
+        self._prefix = None
+
+        if namespace is not None:
+            self._prefix = '/%s/' % (namespace.strip('/'))
+
+        self.tailer = EventsTailer(eventsClient, self.handleEvent,
+                                   interval=pollInterval, clock=self._clock)
+
+    def start(self):
+        """
+        Load the snapshot and start following the events feed.
+
+        @return: A Deferred which fires once the snapshot has been loaded.
+        @rtype: L{Deferred}
+        """
+        # Same as for the service catalog, events which happen while the
+        # snapshot is being loaded are replayed on top of it.
+        self._running = True
+        d = self.tailer.seekToEnd()
+        d.addCallback(lambda _: self.refresh())
+        d.addCallback(self._cbStarted)
+
+        return d
+
+    def stop(self):
+        """
+        Stop following the events feed and reloading the snapshot.
+        """
+        self._running = False
+        self.tailer.stop()
+
+        if self._refreshId and self._refreshId.active():
+            self._refreshId.cancel()
+
+        self._refreshId = None
+
+    def refresh(self):
+        """
+        Reload the snapshot and notify the observers of the differences.
+
+        @return: A Deferred which fires with the number of values.
+        @rtype: L{Deferred}
+        """
+        def cbValues(values):
+            snapshot = {}
+
+            for value in values:
+                if self._matches(value.get('id')):
+                    snapshot[value['id']] = value.get('value')
+
+            for configurationId in self._values.keys():
+                if configurationId not in snapshot:
+                    self._remove(configurationId)
+
+            for configurationId, value in snapshot.iteritems():
+                self._set(configurationId, value)
+
+            self.lastSnapshotTime = self._clock.seconds()
+
+            return len(snapshot)
+
+        if self.namespace is None:
+            iterator = self.configurationClient.iterAll(limit=self.pageLimit,
+                                                        prefetch=True)
+        else:
+            iterator = self.configurationClient.iterAllForNamespace(
+                self.namespace, limit=self.pageLimit, prefetch=True)
+
+        d = iterator.collect()
+        d.addCallback(cbValues)
+
+        return d
+
+    def handleEvent(self, event):
+        """
+        Apply a single event from the events feed to the snapshot.
+        """
+        eventType = event.get('type')
+        payload = event.get('payload') or {}
+        configurationId = payload.get('configuration_value_id')
+
+        if not self._matches(configurationId):
+            return
+
+        if eventType == CONFIGURATION_VALUE_UPDATE:
+            self._set(configurationId, payload.get('new_value'))
+        elif eventType == CONFIGURATION_VALUE_REMOVE:
+            self._remove(configurationId)
+
+    def addObserver(self, observer):
+        """
+        Call observer(configurationId, oldValue, newValue) whenever a value
+        changes.
+        """
+        self._observers.append(observer)
+
+    def removeObserver(self, observer):
+        self._observers.remove(observer)
+
+    def get(self, configurationId, default=None):
+        """
+        Return the value with the given ID, or default if it doesn't exist.
+        """
+        return self._values.get(configurationId, default)
+
+    def getValues(self):
+        """
+        Return a copy of the snapshot as a dict mapping IDs to values.
+        """
+        return dict(self._values)
+
+    def getStaleness(self):
+        """
+        Return the number of seconds since the snapshot was last known to be
+        in sync with the registry, or None if it was never synced.
+        """
+        lastSync = max(self.lastSnapshotTime, self.tailer.lastPollTime)
+
+        if lastSync is None:
+            return None
+
+        return self._clock.seconds() - lastSync
+
+    def isStale(self):
+        staleness = self.getStaleness()
+
+        return staleness is None or staleness > self.maxStaleness
+
+    def __len__(self):
+        return len(self._values)
+
+    def __contains__(self, configurationId):
+        return configurationId in self._values
+
+    def _cbStarted(self, result):
+        if not self._running:
+            return result
+
+        self.tailer.start()
+        self._scheduleRefresh()
+
+        return result
+
+    def _scheduleRefresh(self):
+        if self.refreshInterval is None or not self._running:
+            return
+
+        self._refreshId = self._clock.callLater(self.refreshInterval,
+                                                self._runRefresh)
+
+    def _runRefresh(self):
+        self._refreshId = None
+        d = self.refresh()
+        d.addErrback(log.err, 'Reloading the configuration failed')
+        d.addCallback(lambda _: self._scheduleRefresh())
+
+        return d
+
+    def _matches(self, configurationId):
+        if configurationId is None:
+            return False
+
+        return self._prefix is None or configurationId.startswith(self._prefix)
+
+    def _set(self, configurationId, value):
+        oldValue = self._values.get(configurationId)
+
+        if configurationId in self._values and oldValue == value:
+            return
+
+        self._values[configurationId] = value
+        self._notify(configurationId, oldValue, value)
+
+    def _remove(self, configurationId):
+        if configurationId not in self._values:
+            return
+
+        oldValue = self._values.pop(configurationId)
+        self._notify(configurationId, oldValue, None)
+
+    def _notify(self, configurationId, oldValue, newValue):
+        for observer in list(self._observers):
+            try:
+                observer(configurationId, oldValue, newValue)
+            except Exception:
+                log.err(None, 'Configuration observer failed')